@@ -0,0 +1,80 @@
+"""
+Instance-wide catalog reads in a single round-trip per metric.
+
+Instead of `USE [db]` + query for every database, the per-database query is
+written against three-part names ({db}.sys.*) and expanded into one UNION ALL
+statement covering every user database.
+"""
+
+# Offline, restoring or inaccessible databases would make the whole UNION fail
+USER_DATABASES_SQL = """
+    SELECT name
+    FROM sys.databases
+    WHERE database_id > 4  -- skip master, tempdb, model, msdb
+      AND state_desc = 'ONLINE'
+      AND HAS_DBACCESS(name) = 1
+    ORDER BY name
+"""
+
+
+def quote_name(name):
+    return "[" + name.replace("]", "]]") + "]"
+
+
+def quote_literal(value):
+    return "N'" + value.replace("'", "''") + "'"
+
+
+def list_user_databases(connection):
+    cursor = connection.cursor()
+    cursor.execute(USER_DATABASES_SQL)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def build_union_sql(per_db_sql, databases, wrapper_sql="{union}"):
+    """
+    per_db_sql uses {db} (bracketed name, for [db].sys.* references) and
+    {db_name} (N'' literal, for DB_ID() and the output column).
+    wrapper_sql receives the generated statement as {union}.
+    """
+    parts = [
+        per_db_sql.format(db=quote_name(db), db_name=quote_literal(db))
+        for db in databases
+    ]
+    return wrapper_sql.format(union="\nUNION ALL\n".join(parts))
+
+
+def fetch_columnar(cursor):
+    """Read the current result set as {column: [values]}."""
+    columns = [desc[0] for desc in cursor.description]
+    data = {col: [] for col in columns}
+    appenders = [data[col].append for col in columns]
+    for row in cursor.fetchall():
+        for append, value in zip(appenders, row):
+            append(value)
+    return data
+
+
+def columnar_rows(data):
+    """Iterate a columnar result as one dict per row."""
+    columns = list(data)
+    if not columns:
+        return
+    for values in zip(*(data[col] for col in columns)):
+        yield dict(zip(columns, values))
+
+
+def collect(connection, per_db_sql, wrapper_sql="{union}", databases=None, columns=()):
+    """
+    Run per_db_sql for every user database in one statement and return columnar results.
+    `columns` names the expected result columns so an empty instance still
+    yields the right (empty) shape.
+    """
+    if databases is None:
+        databases = list_user_databases(connection)
+    if not databases:
+        return {col: [] for col in columns}
+
+    cursor = connection.cursor()
+    cursor.execute(build_union_sql(per_db_sql, databases, wrapper_sql))
+    return fetch_columnar(cursor)
@@ -1,11 +1,19 @@
 import pyodbc
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
 
+# Pool settings (SQL_POOL_SIZE=0 disables pooling and opens a new session per call)
+POOL_SIZE = int(os.getenv("SQL_POOL_SIZE", "10"))
+POOL_TIMEOUT = float(os.getenv("SQL_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = float(os.getenv("SQL_POOL_RECYCLE", "1800"))
+POOL_PING_AFTER = float(os.getenv("SQL_POOL_PING_AFTER", "30"))
 
-def get_connection():
+
+def _build_conn_str():
     server = os.getenv("SQL_SERVER")
     database = os.getenv("SQL_DATABASE")
     use_windows_auth = os.getenv("USE_WINDOWS_AUTH", "false").lower() == "true"
@@ -17,6 +25,221 @@ def get_connection():
         password = os.getenv("SQL_PASSWORD")
         conn_str = f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={server};DATABASE={database};UID={user};PWD={password};"
 
-    # connection = pyodbc.connect(conn_str)
+    return conn_str
+
+
+class PooledConnection:
+    """
+    Thin proxy around a pyodbc connection checked out from ConnectionPool.
+    Works as a drop-in replacement: `with get_connection() as conn:` commits
+    (or rolls back on error) and gives the session back to the pool instead of leaking it.
+    """
+
+    def __init__(self, pool, raw, created_at):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_raw", raw)
+        object.__setattr__(self, "_created_at", created_at)
+        object.__setattr__(self, "_released", False)
+
+    def __getattr__(self, name):
+        if self._released:
+            raise pyodbc.ProgrammingError("Connection already returned to the pool")
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        # e.g. connection.autocommit = True / connection.timeout = 60
+        setattr(self._raw, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._released:
+            try:
+                if exc_type is None and not self._raw.autocommit:
+                    self._raw.commit()
+            finally:
+                self.close()
+        return False
+
+    def close(self):
+        if self._released:
+            return
+        object.__setattr__(self, "_released", True)
+        self._pool._release(self._raw, self._created_at)
+
+
+class ConnectionPool:
+    def __init__(self, conn_str, size=POOL_SIZE, timeout=POOL_TIMEOUT, recycle=POOL_RECYCLE,
+                 ping_after=POOL_PING_AFTER, default_db=None):
+        self.conn_str = conn_str
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.default_db = default_db
+
+        self._idle = []          # [(raw_connection, created_at, returned_at)]
+        self._open = 0           # idle + checked out
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "failed_health_checks": 0,
+            "reset_errors": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+        }
+
+    def _connect(self):
+        raw = pyodbc.connect(self.conn_str)
+        with self._cond:
+            self._stats["created"] += 1
+        return raw, time.monotonic()
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, raw, returned_at):
+        # Only ping sessions that sat idle for a while; fresh ones are trusted
+        if time.monotonic() - returned_at < self.ping_after:
+            return True
+        try:
+            cursor = raw.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        start = time.monotonic()
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    raw, created_at, returned_at = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    raw = None
+                    break
+
+                waited = True
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise TimeoutError(f"No SQL connection available after {self.timeout}s (pool size {self.size})")
+                self._cond.wait(remaining)
+
+            wait_time = time.monotonic() - start
+            self._stats["checkouts"] += 1
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_time_total"] += wait_time
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+
+        # Network work happens outside the lock
+        try:
+            if raw is not None:
+                expired = self.recycle and time.monotonic() - created_at > self.recycle
+                if expired or not self._is_healthy(raw, returned_at):
+                    with self._cond:
+                        self._stats["recycled"] += 1
+                        if not expired:
+                            self._stats["failed_health_checks"] += 1
+                    self._discard(raw)
+                    raw = None
+
+            if raw is None:
+                raw, created_at = self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+        return PooledConnection(self, raw, created_at)
+
+    def _reset(self, raw):
+        """Undo whatever the route did to the session: open transaction, autocommit, USE [db], timeout."""
+        if not raw.autocommit:
+            raw.rollback()
+        raw.autocommit = False
+        raw.timeout = 0
+        if self.default_db:
+            cursor = raw.cursor()
+            cursor.execute(f"USE [{self.default_db.replace(']', ']]')}];")
+            cursor.close()
+
+    def _release(self, raw, created_at):
+        try:
+            self._reset(raw)
+            healthy = True
+        except Exception as e:
+            print(f"⚠️ Dropping pooled connection, reset failed: {e}")
+            healthy = False
+
+        with self._cond:
+            if healthy:
+                self._idle.append((raw, created_at, time.monotonic()))
+            else:
+                self._stats["reset_errors"] += 1
+                self._open -= 1
+            self._cond.notify()
+
+        if not healthy:
+            self._discard(raw)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for raw, _, _ in idle:
+            self._discard(raw)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self.size
+            stats["open"] = self._open
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._open - len(self._idle)
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["waits"] if stats["waits"] else 0.0
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(_build_conn_str(), default_db=os.getenv("SQL_DATABASE"))
+    return _pool
+
+
+def get_connection():
+    if POOL_SIZE <= 0:
+        return pyodbc.connect(_build_conn_str())
+
+    return get_pool().acquire()
+
 
-    return pyodbc.connect(conn_str)
+def get_pool_stats():
+    if POOL_SIZE <= 0:
+        return {"size": 0, "enabled": False}
+    stats = get_pool().stats()
+    stats["enabled"] = True
+    return stats
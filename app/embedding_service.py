@@ -0,0 +1,263 @@
+"""
+Optional embedding server shared by every worker process.
+
+    EMBEDDING_SERVICE_ADDR=unix:/tmp/sp_optimizer_embed.sock python -m app.embedding_service
+    EMBEDDING_SERVICE_ADDR=127.0.0.1:8765 python -m app.embedding_service
+
+Workers (and create_faiss.py) call get_embedder(): with EMBEDDING_SERVICE_ADDR set they get a thin
+client that sends texts to the server, otherwise the model is loaded in-process as before.
+Concurrent requests are micro-batched into a single model.encode call.
+
+Wire format, both directions: 4-byte big-endian header length, JSON header, optional payload.
+    request   {"op": "encode", "texts": [...]}  |  {"op": "ping"}
+    response  {"shape": [n, dim]} + n*dim float32 bytes  |  {"ok": true}  |  {"error": "..."}
+"""
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from dotenv import load_dotenv
+load_dotenv(override=True)
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+EMBEDDING_SERVICE_ADDR = os.getenv("EMBEDDING_SERVICE_ADDR", "")
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))              # texts per model.encode call
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))         # wait for more requests to join a batch
+EMBED_CLIENT_TIMEOUT = float(os.getenv("EMBED_CLIENT_TIMEOUT", "60"))  # seconds
+CLIENT_CHUNK = 1024  # texts per request, so a full create_faiss.py build stays within the timeout
+
+_HEADER = struct.Struct(">I")
+
+
+def parse_addr(addr):
+    """"unix:/path.sock" -> (AF_UNIX, path); "host:port" -> (AF_INET, (host, port))"""
+    if addr.startswith("unix:"):
+        return socket.AF_UNIX, addr[len("unix:"):]
+    host, _, port = addr.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("embedding service closed the connection")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _send_message(sock, header, payload=b""):
+    raw = json.dumps(header).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(raw)) + raw + payload)
+
+
+def _recv_header(sock):
+    (length,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return json.loads(_recv_exact(sock, length).decode("utf-8"))
+
+
+# ---------------------------------------------------------------- server
+
+class MicroBatcher:
+    """Collects encode requests from all connections and runs them through the model in batches."""
+
+    def __init__(self, model, max_batch=EMBED_MAX_BATCH, max_wait_ms=EMBED_MAX_WAIT_MS):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._stats = {"requests": 0, "texts": 0, "batches": 0, "encode_time": 0.0}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="embed-batcher", daemon=True).start()
+
+    def submit(self, texts):
+        future = Future()
+        self._queue.put((texts, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self._encode(batch)
+
+    def _encode(self, batch):
+        texts = [t for item_texts, _ in batch for t in item_texts]
+        start = time.perf_counter()
+        try:
+            vectors = np.asarray(self.model.encode(texts, convert_to_numpy=True), dtype=np.float32)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        elapsed = time.perf_counter() - start
+
+        pos = 0
+        for item_texts, future in batch:
+            future.set_result(vectors[pos:pos + len(item_texts)])
+            pos += len(item_texts)
+
+        with self._lock:
+            self._stats["requests"] += len(batch)
+            self._stats["texts"] += len(texts)
+            self._stats["batches"] += 1
+            self._stats["encode_time"] += elapsed
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["avg_batch"] = stats["texts"] / stats["batches"] if stats["batches"] else 0.0
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        while True:
+            try:
+                request = _recv_header(sock)
+            except (ConnectionError, OSError):
+                return
+
+            op = request.get("op")
+            try:
+                if op == "ping":
+                    _send_message(sock, {"ok": True, "model": MODEL_NAME})
+                elif op == "stats":
+                    _send_message(sock, self.server.batcher.stats())
+                elif op == "encode":
+                    vectors = self.server.batcher.submit(request["texts"]).result()
+                    _send_message(sock, {"shape": list(vectors.shape)}, np.ascontiguousarray(vectors).tobytes())
+                else:
+                    _send_message(sock, {"error": f"unknown op {op!r}"})
+            except (ConnectionError, OSError):
+                return
+            except Exception as e:
+                _send_message(sock, {"error": str(e)})
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(addr=EMBEDDING_SERVICE_ADDR or "127.0.0.1:8765"):
+    from sentence_transformers import SentenceTransformer
+
+    family, target = parse_addr(addr)
+    if family == socket.AF_UNIX and os.path.exists(target):
+        os.remove(target)  # stale socket from a previous run
+
+    model = SentenceTransformer(MODEL_NAME)
+    server_cls = _UnixServer if family == socket.AF_UNIX else _TCPServer
+    with server_cls(target, _Handler) as server:
+        server.batcher = MicroBatcher(model)
+        print(f"✅ Embedding service ({MODEL_NAME}) listening on {addr} "
+              f"(batch {EMBED_MAX_BATCH}, wait {EMBED_MAX_WAIT_MS} ms)")
+        server.serve_forever()
+
+
+# ---------------------------------------------------------------- client
+
+class EmbeddingClient:
+    """Drop-in for SentenceTransformer.encode; one persistent connection per thread."""
+
+    def __init__(self, addr=EMBEDDING_SERVICE_ADDR, timeout=EMBED_CLIENT_TIMEOUT):
+        self.addr = addr
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            family, target = parse_addr(self.addr)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(target)
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def _call(self, request):
+        # one reconnect: the server may have restarted since this thread's last call
+        for attempt in (1, 2):
+            try:
+                sock = self._socket()
+                _send_message(sock, request)
+                header = _recv_header(sock)
+                if "error" in header:
+                    raise RuntimeError(f"embedding service: {header['error']}")
+                if "shape" not in header:
+                    return header, None
+                rows, dim = header["shape"]
+                payload = _recv_exact(sock, rows * dim * 4)
+                return header, np.frombuffer(payload, dtype=np.float32).reshape(rows, dim)
+            except (ConnectionError, OSError):
+                self._close()
+                if attempt == 2:
+                    raise
+
+    def ping(self):
+        return self._call({"op": "ping"})[0]
+
+    def stats(self):
+        return self._call({"op": "stats"})[0]
+
+    def encode(self, sentences, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        chunks = [self._call({"op": "encode", "texts": texts[i:i + CLIENT_CHUNK]})[1]
+                  for i in range(0, len(texts), CLIENT_CHUNK)]
+        vectors = chunks[0] if len(chunks) == 1 else np.vstack(chunks)
+        return vectors[0] if single else vectors
+
+
+def get_embedder():
+    """Client for the shared service when EMBEDDING_SERVICE_ADDR is set and reachable, else a local model."""
+    if EMBEDDING_SERVICE_ADDR:
+        client = EmbeddingClient(EMBEDDING_SERVICE_ADDR)
+        try:
+            client.ping()
+            return client
+        except (ConnectionError, OSError) as e:
+            print(f"⚠️ Embedding service at {EMBEDDING_SERVICE_ADDR} unavailable ({e}), loading model locally")
+
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(MODEL_NAME)
+
+
+if __name__ == "__main__":
+    serve()
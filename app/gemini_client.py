@@ -1,14 +1,185 @@
 import os
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
 import requests
 import json
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
+
+from app.response_cache import make_key, response_cache  # reads GEMINI_CACHE_* from .env
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 
-GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={GEMINI_API_KEY}"
+GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
+GEMINI_STREAM_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+
+GENERATION_CONFIG = {
+    "temperature": 0,
+    "topK": 1,
+    "topP": 0.1
+}
+
+# HTTP client: keep-alive session, retries with jittered exponential backoff, client-side rate limit
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "600"))            # read timeout (seconds)
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "10"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1"))    # seconds, doubled per attempt
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "60"))
+GEMINI_RATE_LIMIT_RPM = float(os.getenv("GEMINI_RATE_LIMIT_RPM", "60"))  # 0 disables the limiter
+GEMINI_RATE_BURST = int(os.getenv("GEMINI_RATE_BURST", "5"))
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "10"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Requests per minute shared by every thread of the process; acquire() blocks until a token is free."""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class GeminiMetrics:
+    def __init__(self, window=200):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)  # seconds, successful calls only
+        self._stats = {
+            "calls": 0, "errors": 0, "retries": 0, "rate_limited": 0, "throttle_wait": 0.0,
+            "prompt_tokens": 0, "output_tokens": 0, "total_tokens": 0,
+        }
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self._stats[name] += value
+
+    def record_call(self, latency, usage=None):
+        usage = usage or {}
+        with self._lock:
+            self._stats["calls"] += 1
+            self._latencies.append(latency)
+            self._stats["prompt_tokens"] += usage.get("promptTokenCount", 0)
+            self._stats["output_tokens"] += usage.get("candidatesTokenCount", 0)
+            self._stats["total_tokens"] += usage.get("totalTokenCount", 0)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            latencies = sorted(self._latencies)
+        if latencies:
+            stats["latency_avg"] = sum(latencies) / len(latencies)
+            stats["latency_p50"] = latencies[len(latencies) // 2]
+            stats["latency_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            stats["latency_max"] = latencies[-1]
+        return stats
+
+
+rate_limiter = TokenBucket(GEMINI_RATE_LIMIT_RPM, GEMINI_RATE_BURST)
+metrics = GeminiMetrics()
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            # retries are handled in _post so Retry-After and the metrics see every attempt
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GEMINI_POOL_SIZE, max_retries=0)
+            session.mount("https://", adapter)
+            session.headers.update({"Content-Type": "application/json"})
+            _session = session
+        return _session
+
+
+def _retry_after(response):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt):
+    # "full jitter": spreads out retries of many concurrent callers
+    return random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * (2 ** attempt)))
 
-def call_ai(user_message, related_schema):
+
+def get_gemini_stats():
+    stats = metrics.stats()
+    stats["rate_limit_rpm"] = GEMINI_RATE_LIMIT_RPM
+    stats["max_retries"] = GEMINI_MAX_RETRIES
+    return stats
+
+
+def _post(url, body, stream=False):
+    """POST with rate limiting and retries on connection errors, 429 and 5xx. Raises on final failure."""
+    session = get_session()
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        metrics.add(throttle_wait=rate_limiter.acquire())
+        last = attempt == GEMINI_MAX_RETRIES
+        try:
+            response = session.post(url, json=body, stream=stream,
+                                    timeout=(GEMINI_CONNECT_TIMEOUT, GEMINI_TIMEOUT))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if last:
+                raise
+            delay = _backoff(attempt)
+            print(f"⚠️ Gemini connection error ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s")
+            metrics.add(retries=1)
+            time.sleep(delay)
+            continue
+
+        if response.status_code in RETRY_STATUSES and not last:
+            if response.status_code == 429:
+                metrics.add(rate_limited=1)
+            delay = _retry_after(response)
+            delay = min(delay, GEMINI_BACKOFF_MAX) if delay is not None else _backoff(attempt)
+            print(f"⚠️ Gemini HTTP {response.status_code}, retry {attempt + 1} in {delay:.1f}s")
+            response.close()
+            metrics.add(retries=1)
+            time.sleep(delay)
+            continue
+
+        response.raise_for_status()
+        return response
+
+def build_chat_prompt(user_message, related_schema):
 
     # 2. Build prompt untuk AI
     prompt = f"""
@@ -18,6 +189,10 @@ def call_ai(user_message, related_schema):
     Related schema: 
     {related_schema}
     """
+    return prompt
+
+def call_ai(user_message, related_schema):
+    prompt = build_chat_prompt(user_message, related_schema)
 
     # print(prompt)
 
@@ -26,10 +201,18 @@ def call_ai(user_message, related_schema):
 
     return ai_response
 
-def ask_gemini(prompt):
-    headers = {
-        "Content-Type": "application/json"
-    }
+def call_ai_stream(user_message, related_schema):
+    return ask_gemini_stream(build_chat_prompt(user_message, related_schema))
+
+def ask_gemini(prompt, use_cache=True, cache_if=None):
+    # temperature 0: the same prompt gives the same answer, so repeat analyses are served from the cache.
+    # Only complete answers (finishReason STOP, and cache_if(text) when given) are cached.
+    cache_key = make_key(GEMINI_MODEL, GENERATION_CONFIG, prompt)
+    if use_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            print("✅ Gemini response served from cache.")
+            return cached
 
     body = {
         "contents": [
@@ -39,26 +222,31 @@ def ask_gemini(prompt):
                 ]
             }
         ],
-        "generationConfig": {
-            "temperature": 0,
-            "topK": 1,
-            "topP": 0.1
-        }
+        "generationConfig": GENERATION_CONFIG
     }
 
     try:
-        response = requests.post(GEMINI_URL, headers=headers, json=body, timeout=600)
-        response.raise_for_status()
+        start = time.perf_counter()
+        response = _post(GEMINI_URL, body)
         result = response.json()
-        
-        print("✅ Gemini response received.")
-        print(result)
+        latency = time.perf_counter() - start
+        usage = result.get("usageMetadata") or {}
+        metrics.record_call(latency, usage)
+
+        print(f"✅ Gemini response received in {latency:.1f}s "
+              f"({usage.get('promptTokenCount', '?')} prompt / {usage.get('candidatesTokenCount', '?')} output tokens).")
 
         # cek struktur respons
         if "candidates" in result and len(result["candidates"]) > 0:
             candidate = result["candidates"][0]
             if "content" in candidate and "parts" in candidate["content"]:
-                return candidate["content"]["parts"][0].get("text", "")
+                text = candidate["content"]["parts"][0].get("text", "")
+                finish = candidate.get("finishReason")
+                if finish != "STOP":
+                    print(f"⚠️ Gemini answer ended with finishReason={finish}, not cached.")
+                elif text and (cache_if is None or cache_if(text)):
+                    response_cache.put(cache_key, GEMINI_MODEL, text)
+                return text
         
         print("⚠️ Unexpected Gemini response:", result)
         return None
@@ -68,5 +256,75 @@ def ask_gemini(prompt):
         # result = response.json()
         # return result["candidates"][0]["content"]["parts"][0]["text"]
     except Exception as e:
+        metrics.add(errors=1)
         print("❌ Gemini API error:", e)
         return None
+
+
+def _finish_reason(result):
+    candidates = result.get("candidates") or []
+    return candidates[0].get("finishReason") if candidates else None
+
+
+def _candidate_text(result):
+    candidates = result.get("candidates") or []
+    if candidates:
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(part.get("text", "") for part in parts)
+    return ""
+
+
+def ask_gemini_stream(prompt, use_cache=True):
+    """
+    Generator over text chunks as the model produces them (streamGenerateContent, server-sent events).
+    A cached response is yielded as a single chunk; the full text is cached once the stream completes.
+    """
+    cache_key = make_key(GEMINI_MODEL, GENERATION_CONFIG, prompt)
+    if use_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            print("✅ Gemini response served from cache.")
+            yield cached
+            return
+
+    body = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": GENERATION_CONFIG
+    }
+
+    received = []
+    completed = False
+    usage = {}
+    finish = None
+    try:
+        start = time.perf_counter()
+        # retries only happen before the first byte; a stream cut off midway is not replayed
+        with _post(GEMINI_STREAM_URL, body, stream=True) as response:
+            # bytes, decoded per line: without a charset header requests would assume ISO-8859-1
+            for line in response.iter_lines():
+                # SSE: "data: {json}" lines separated by blank lines
+                if not line or not line.startswith(b"data:"):
+                    continue
+                event = json.loads(line[len(b"data:"):].strip().decode("utf-8"))
+                usage = event.get("usageMetadata") or usage  # cumulative, the last event has the totals
+                finish = _finish_reason(event) or finish      # set on the last event only
+                text = _candidate_text(event)
+                if text:
+                    received.append(text)
+                    yield text
+        completed = True
+        latency = time.perf_counter() - start
+        metrics.record_call(latency, usage)
+        print(f"✅ Gemini stream finished in {latency:.1f}s "
+              f"({usage.get('promptTokenCount', '?')} prompt / {usage.get('candidatesTokenCount', '?')} output tokens).")
+    except Exception as e:
+        metrics.add(errors=1)
+        print("❌ Gemini API stream error:", e)
+        if received:
+            raise  # a cut-off answer must not look complete to the caller
+    finally:
+        if completed and received:
+            if finish == "STOP":
+                response_cache.put(cache_key, GEMINI_MODEL, "".join(received))
+            else:
+                print(f"⚠️ Gemini stream ended with finishReason={finish}, not cached.")
@@ -1,63 +1,340 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from app.catalog_collector import build_union_sql, collect, columnar_rows, fetch_columnar, list_user_databases, quote_literal, quote_name
+from app.db_connector import get_connection
+from app.indexing import fragmentation_store
+
+# Parallel scan settings: worker count (keep below SQL_POOL_SIZE) and per-database budget in seconds
+FRAG_MAX_WORKERS = int(os.getenv("FRAG_MAX_WORKERS", "4"))
+FRAG_DB_TIMEOUT = int(os.getenv("FRAG_DB_TIMEOUT", "120"))
+FRAG_PARALLEL = os.getenv("FRAG_PARALLEL", "false").lower() == "true"
+
+# Incremental scan settings: reuse the local snapshot for indexes without writes since the last scan
+FRAG_INCREMENTAL = os.getenv("FRAG_INCREMENTAL", "true").lower() == "true"
+FRAG_SNAPSHOT_MAX_AGE_HOURS = float(os.getenv("FRAG_SNAPSHOT_MAX_AGE_HOURS", "24"))
+# Above this many changed indexes a full database scan is cheaper than per-index calls
+FRAG_MAX_TARGETED_INDEXES = 500
+
+FRAGMENTATION_COLUMNS = ("database_name", "schema_name", "table_name", "index_name",
+                         "index_type_desc", "avg_fragmentation_in_percent", "page_count")
+
+FRAGMENTATION_PER_DB_SQL = """
+    SELECT
+        {db_name} AS database_name,
+        s.name AS schema_name,
+        t.name AS table_name,
+        i.name AS index_name,
+        ps.index_type_desc,
+        ps.avg_fragmentation_in_percent,
+        ps.page_count
+    FROM sys.dm_db_index_physical_stats (DB_ID({db_name}), NULL, NULL, NULL, 'LIMITED') AS ps
+    JOIN {db}.sys.indexes i ON ps.object_id = i.object_id AND ps.index_id = i.index_id
+    JOIN {db}.sys.tables t ON i.object_id = t.object_id
+    JOIN {db}.sys.schemas s ON t.schema_id = s.schema_id
+    WHERE ps.page_count > 100
+      AND i.name IS NOT NULL
+"""
+
+
+def recommend_maintenance(frag):
+    if frag >= 30:
+        return "REBUILD"
+    if frag >= 5:
+        return "REORGANIZE"
+    return None  # low fragmentation
+
+
+def _build_results(data):
+    all_results = []
+    for db, schema, table, index, frag, page_count in zip(
+        data["database_name"], data["schema_name"], data["table_name"], data["index_name"],
+        data["avg_fragmentation_in_percent"], data["page_count"]
+    ):
+        action = recommend_maintenance(frag)
+        if action is None:
+            continue
+
+        all_results.append({
+            "database": db,
+            "schema": schema,
+            "table": table,
+            "index": index,
+            "fragmentation": frag,
+            "page_count": page_count,
+            "recommendation": action,
+        })
+
+    return all_results
+
 
 def analyze_index_fragmentation_all(connection):
-    cursor = connection.cursor()
-    # Get list of databases
-    cursor.execute("""
-        SELECT name 
-        FROM sys.databases
-        WHERE database_id > 4  -- skip master, tempdb, model, msdb
-    """)
-    databases = [row[0] for row in cursor.fetchall()]
+    # Every user database in one statement instead of USE [db] + query per database
+    data = collect(
+        connection,
+        FRAGMENTATION_PER_DB_SQL,
+        wrapper_sql="{union}\nORDER BY avg_fragmentation_in_percent DESC;",
+        columns=FRAGMENTATION_COLUMNS,
+    )
+    return _build_results(data)
 
+
+def _scan_database(db, db_timeout):
+    # Each worker gets its own pooled session; the pool resets the timeout on return
+    with get_connection() as connection:
+        connection.timeout = db_timeout
+        data = collect(connection, FRAGMENTATION_PER_DB_SQL, databases=[db], columns=FRAGMENTATION_COLUMNS)
+    return _build_results(data)
+
+
+def iter_index_fragmentation_parallel(connection, databases=None, max_workers=FRAG_MAX_WORKERS,
+                                      db_timeout=FRAG_DB_TIMEOUT):
+    """
+    Scan databases concurrently and yield (database, results, error) as each one finishes,
+    so one huge database no longer holds back the others.
+    db_timeout is the per-database query budget in seconds (0 = no limit).
+    """
+    if databases is None:
+        databases = list_user_databases(connection)
+    if not databases:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(databases))))
+    futures = {executor.submit(_scan_database, db, db_timeout): db for db in databases}
+    try:
+        for future in as_completed(futures):
+            db = futures[future]
+            try:
+                yield db, future.result(), None
+            except Exception as e:
+                print(f"Failed to analyze {db}: {e}")
+                yield db, [], str(e)
+    finally:
+        # Consumer stopped early (e.g. client disconnected): drop queued databases
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def analyze_index_fragmentation_parallel(connection, databases=None, max_workers=FRAG_MAX_WORKERS,
+                                         db_timeout=FRAG_DB_TIMEOUT):
     all_results = []
+    for _, results, _ in iter_index_fragmentation_parallel(connection, databases, max_workers, db_timeout):
+        all_results.extend(results)
+
+    all_results.sort(key=lambda r: r["fragmentation"], reverse=True)
+    return all_results
+
+
+# Unfiltered (all sizes, leaf in-row data only) so every index lands in the snapshot
+SNAPSHOT_SELECT_SQL = """
+    SELECT
+        {db_name} AS database_name,
+        ps.object_id,
+        ps.index_id,
+        ps.partition_number,
+        s.name AS schema_name,
+        t.name AS table_name,
+        i.name AS index_name,
+        ps.index_type_desc,
+        ps.avg_fragmentation_in_percent,
+        ps.page_count
+"""
+
+SNAPSHOT_JOIN_SQL = """
+    JOIN {db}.sys.indexes i ON ps.object_id = i.object_id AND ps.index_id = i.index_id
+    JOIN {db}.sys.tables t ON i.object_id = t.object_id
+    JOIN {db}.sys.schemas s ON t.schema_id = s.schema_id
+    WHERE ps.alloc_unit_type_desc = 'IN_ROW_DATA'
+      AND i.name IS NOT NULL
+"""
+
+SNAPSHOT_FULL_PER_DB_SQL = (
+    SNAPSHOT_SELECT_SQL
+    + "    FROM sys.dm_db_index_physical_stats (DB_ID({db_name}), NULL, NULL, NULL, 'LIMITED') AS ps\n"
+    + SNAPSHOT_JOIN_SQL
+)
+
+SNAPSHOT_TARGETED_PER_DB_SQL = (
+    SNAPSHOT_SELECT_SQL
+    + "    FROM (VALUES {targets}) AS c(object_id, index_id)\n"
+    + "    CROSS APPLY sys.dm_db_index_physical_stats (DB_ID({db_name}), c.object_id, c.index_id, NULL, 'LIMITED') AS ps\n"
+    + SNAPSHOT_JOIN_SQL
+)
+
+CURRENT_INDEXES_PER_DB_SQL = """
+    SELECT {db_name} AS database_name, i.object_id, i.index_id
+    FROM {db}.sys.indexes i
+    JOIN {db}.sys.tables t ON i.object_id = t.object_id
+    WHERE i.name IS NOT NULL
+"""
 
+# Instance-wide DMV: one query gives the write watermark of every index
+INDEX_WRITES_SQL = """
+    SELECT DB_NAME(database_id) AS database_name, object_id, index_id, last_user_update
+    FROM sys.dm_db_index_usage_stats
+    WHERE database_id > 4
+"""
+
+
+def _plan_incremental_scan(connection, databases):
+    """Decide per database: full scan, targeted (changed indexes only) or nothing."""
+    cursor = connection.cursor()
+    # Usage stats reset on restart, so a snapshot older than the restart cannot be trusted
+    cursor.execute("SELECT sqlserver_start_time FROM sys.dm_os_sys_info")
+    server_start = cursor.fetchone()[0]
+
+    cursor.execute(INDEX_WRITES_SQL)
+    writes = {}
+    for db, object_id, index_id, last_update in cursor.fetchall():
+        writes.setdefault(db, {})[(object_id, index_id)] = last_update
+
+    current = {db: set() for db in databases}
+    for row in columnar_rows(collect(connection, CURRENT_INDEXES_PER_DB_SQL, databases=databases)):
+        current[row["database_name"]].add((row["object_id"], row["index_id"]))
+
+    last_full = fragmentation_store.get_last_full_scans()
+    max_age = timedelta(hours=FRAG_SNAPSHOT_MAX_AGE_HOURS)
+    now = datetime.now()
+
+    full, targeted = [], {}
     for db in databases:
-        try:
-            cursor.execute(f"USE [{db}];")
-
-            query = """
-            SELECT 
-                s.name AS schema_name,
-                t.name AS table_name,
-                i.name AS index_name,
-                ps.index_type_desc,
-                ps.avg_fragmentation_in_percent,
-                ps.page_count
-            FROM sys.dm_db_index_physical_stats (DB_ID(), NULL, NULL, NULL, 'LIMITED') AS ps
-            JOIN sys.indexes i ON ps.object_id = i.object_id AND ps.index_id = i.index_id
-            JOIN sys.tables t ON i.object_id = t.object_id
-            JOIN sys.schemas s ON t.schema_id = s.schema_id
-            WHERE ps.database_id = DB_ID()
-              AND ps.page_count > 100
-              AND i.name IS NOT NULL
-            ORDER BY ps.avg_fragmentation_in_percent DESC;
-            """
-
-            cursor.execute(query)
-            for row in cursor.fetchall():
-                frag = row.avg_fragmentation_in_percent
-                if frag >= 30:
-                    action = "REBUILD"
-                elif frag >= 5:
-                    action = "REORGANIZE"
-                else:
-                    continue  # skip low fragmentation
-
-                all_results.append({
-                    "database": db,
-                    "schema": row.schema_name,
-                    "table": row.table_name,
-                    "index": row.index_name,
-                    "fragmentation": frag,
-                    "page_count": row.page_count,
-                    "recommendation": action,
-                })
-        except Exception as e:
-            print(f"Failed to analyze {db}: {e}")
+        scanned_at = last_full.get(db)
+        if scanned_at is None or now - scanned_at > max_age or scanned_at < server_start:
+            full.append(db)
+            continue
+
+        db_writes = writes.get(db, {})
+        known = fragmentation_store.get_snapshot_versions(db)
+        changed = []
+        for key in current[db]:
+            if key not in known:
+                changed.append(key)  # new index
+                continue
+            last_update = db_writes.get(key)
+            if last_update is not None and (known[key] is None or last_update > known[key]):
+                changed.append(key)
+
+        if len(changed) > FRAG_MAX_TARGETED_INDEXES:
+            full.append(db)
+        elif changed:
+            targeted[db] = changed
+
+    return full, targeted, current, writes
+
+
+def _snapshot_sql(db, targets=None):
+    """Full snapshot query of one database, or only the (object_id, index_id) targets."""
+    if targets is None:
+        return build_union_sql(SNAPSHOT_FULL_PER_DB_SQL, [db])
+    values = ", ".join(f"({object_id}, {index_id})" for object_id, index_id in targets)
+    return SNAPSHOT_TARGETED_PER_DB_SQL.replace("{targets}", values).format(
+        db=quote_name(db), db_name=quote_literal(db)
+    )
+
+
+def _fetch_snapshot_rows(connection, sql):
+    cursor = connection.cursor()
+    cursor.execute(sql)
+    return list(columnar_rows(fetch_columnar(cursor)))
+
+
+def _scan_snapshot_database(sql, db_timeout):
+    # Same as _scan_database: own pooled session and per-database budget
+    with get_connection() as connection:
+        connection.timeout = db_timeout
+        return _fetch_snapshot_rows(connection, sql)
+
+
+def analyze_index_fragmentation_incremental(connection, parallel=FRAG_PARALLEL, max_workers=FRAG_MAX_WORKERS,
+                                            db_timeout=FRAG_DB_TIMEOUT):
+    """
+    Like analyze_index_fragmentation_all, but only indexes whose last_user_update moved since the
+    last snapshot are rescanned; everything else comes from the local snapshot store.
+    With parallel, the full and targeted scans run one database per worker (FRAG_PARALLEL);
+    a database that fails keeps its previous snapshot.
+    """
+    databases = list_user_databases(connection)
+    full, targeted, current, writes = _plan_incremental_scan(connection, databases)
+
+    queries = {db: _snapshot_sql(db) for db in full}
+    queries.update({db: _snapshot_sql(db, keys) for db, keys in targeted.items()})
+
+    scanned = []
+    if queries:
+        print(f"🔍 Fragmentation scan: {len(full)} full, {len(targeted)} incremental, "
+              f"{len(databases) - len(full) - len(targeted)} unchanged databases"
+              + (f", {min(max_workers, len(queries))} workers" if parallel else ""))
+        if parallel:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(queries)))) as executor:
+                futures = {executor.submit(_scan_snapshot_database, sql, db_timeout): db
+                           for db, sql in queries.items()}
+                for future in as_completed(futures):
+                    db = futures[future]
+                    try:
+                        scanned += future.result()
+                    except Exception as e:
+                        print(f"Failed to analyze {db}: {e}")
+                        if db in full:
+                            full.remove(db)  # keep the old snapshot rows instead of clearing them
+        else:
+            scanned = _fetch_snapshot_rows(connection, "\nUNION ALL\n".join(queries.values()))
+
+    rows = []
+    for row in scanned:
+        db = row["database_name"]
+        rows.append({
+            "database": db,
+            "object_id": row["object_id"],
+            "index_id": row["index_id"],
+            "partition_number": row["partition_number"],
+            "schema": row["schema_name"],
+            "table": row["table_name"],
+            "index": row["index_name"],
+            "index_type_desc": row["index_type_desc"],
+            "fragmentation": row["avg_fragmentation_in_percent"],
+            "page_count": row["page_count"],
+            "last_user_update": writes.get(db, {}).get((row["object_id"], row["index_id"])),
+        })
+
+    fragmentation_store.save_snapshot(
+        rows,
+        full_scan_databases=full,
+        keep_indexes={db: current[db] for db in databases if db not in full},
+    )
+
+    all_results = []
+    for row in fragmentation_store.load_snapshot(databases):
+        if row["page_count"] <= 100 or not row["index"]:
+            continue
+        action = recommend_maintenance(row["fragmentation"])
+        if action is None:
+            continue
+
+        all_results.append({
+            "database": row["database"],
+            "schema": row["schema"],
+            "table": row["table"],
+            "index": row["index"],
+            "fragmentation": row["fragmentation"],
+            "page_count": row["page_count"],
+            "recommendation": action,
+        })
 
     return all_results
 
 
+def scan_index_fragmentation(connection):
+    """
+    Pick the configured scan mode: incremental (FRAG_INCREMENTAL, itself parallel when
+    FRAG_PARALLEL is set), parallel, or one query for all databases.
+    """
+    if FRAG_INCREMENTAL:
+        return analyze_index_fragmentation_incremental(connection)
+    if FRAG_PARALLEL:
+        return analyze_index_fragmentation_parallel(connection)
+    return analyze_index_fragmentation_all(connection)
+
+
 def generate_maintenance_sql(results):
     sql_statements = []
     for row in results:
@@ -0,0 +1,208 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+# Local snapshot of index fragmentation, used to skip indexes that did not change since the last scan
+SNAPSHOT_DB = os.getenv("FRAG_SNAPSHOT_DB", os.path.join("data", "fragmentation_snapshots.db"))
+# Trend rows in index_snapshot_history older than this are purged after every scan
+FRAG_HISTORY_RETENTION_DAYS = float(os.getenv("FRAG_HISTORY_RETENTION_DAYS", "90"))
+
+_lock = threading.Lock()
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS index_snapshot (
+    database_name TEXT NOT NULL,
+    object_id INTEGER NOT NULL,
+    index_id INTEGER NOT NULL,
+    partition_number INTEGER NOT NULL,
+    schema_name TEXT,
+    table_name TEXT,
+    index_name TEXT,
+    index_type_desc TEXT,
+    avg_fragmentation REAL,
+    page_count INTEGER,
+    last_user_update TEXT,
+    scanned_at TEXT NOT NULL,
+    PRIMARY KEY (database_name, object_id, index_id, partition_number)
+);
+
+CREATE TABLE IF NOT EXISTS index_snapshot_history (
+    database_name TEXT NOT NULL,
+    object_id INTEGER NOT NULL,
+    index_id INTEGER NOT NULL,
+    partition_number INTEGER NOT NULL,
+    schema_name TEXT,
+    table_name TEXT,
+    index_name TEXT,
+    avg_fragmentation REAL,
+    page_count INTEGER,
+    scanned_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_history_index
+    ON index_snapshot_history (database_name, schema_name, table_name, index_name, scanned_at);
+
+CREATE INDEX IF NOT EXISTS ix_history_scanned_at ON index_snapshot_history (scanned_at);
+
+CREATE TABLE IF NOT EXISTS database_scan (
+    database_name TEXT PRIMARY KEY,
+    scanned_at TEXT NOT NULL
+);
+"""
+
+
+@contextmanager
+def _connect():
+    folder = os.path.dirname(SNAPSHOT_DB)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    conn = sqlite3.connect(SNAPSHOT_DB)
+    try:
+        conn.executescript(SCHEMA_SQL)
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def get_last_full_scans():
+    """{database: datetime of the last full scan}"""
+    with _lock, _connect() as conn:
+        rows = conn.execute("SELECT database_name, scanned_at FROM database_scan").fetchall()
+    return {db: datetime.fromisoformat(ts) for db, ts in rows}
+
+
+def get_snapshot_versions(database):
+    """{(object_id, index_id): last_user_update recorded at scan time (datetime or None)}"""
+    with _lock, _connect() as conn:
+        rows = conn.execute("""
+            SELECT object_id, index_id, MAX(last_user_update)
+            FROM index_snapshot
+            WHERE database_name = ?
+            GROUP BY object_id, index_id
+        """, (database,)).fetchall()
+    return {
+        (object_id, index_id): datetime.fromisoformat(ts) if ts else None
+        for object_id, index_id, ts in rows
+    }
+
+
+def save_snapshot(rows, full_scan_databases=(), keep_indexes=None):
+    """
+    rows: dicts with database, object_id, index_id, partition_number, schema, table, index,
+          index_type_desc, fragmentation, page_count, last_user_update.
+    full_scan_databases: databases rescanned completely (their old rows are replaced).
+    keep_indexes: {database: set((object_id, index_id))} still present on the server;
+                  snapshot rows for dropped indexes are removed.
+    """
+    now = datetime.now().isoformat()
+
+    with _lock, _connect() as conn:
+        for db in full_scan_databases:
+            conn.execute("DELETE FROM index_snapshot WHERE database_name = ?", (db,))
+            conn.execute(
+                "INSERT OR REPLACE INTO database_scan (database_name, scanned_at) VALUES (?, ?)",
+                (db, now)
+            )
+
+        if keep_indexes:
+            for db, present in keep_indexes.items():
+                stored = conn.execute(
+                    "SELECT DISTINCT object_id, index_id FROM index_snapshot WHERE database_name = ?", (db,)
+                ).fetchall()
+                dropped = [key for key in stored if key not in present]
+                conn.executemany(
+                    "DELETE FROM index_snapshot WHERE database_name = ? AND object_id = ? AND index_id = ?",
+                    [(db, object_id, index_id) for object_id, index_id in dropped]
+                )
+
+        conn.executemany("""
+            INSERT OR REPLACE INTO index_snapshot (
+                database_name, object_id, index_id, partition_number, schema_name, table_name,
+                index_name, index_type_desc, avg_fragmentation, page_count, last_user_update, scanned_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(
+            r["database"], r["object_id"], r["index_id"], r["partition_number"], r["schema"], r["table"],
+            r["index"], r["index_type_desc"], r["fragmentation"], r["page_count"],
+            _iso(r["last_user_update"]), now
+        ) for r in rows])
+
+        conn.executemany("""
+            INSERT INTO index_snapshot_history (
+                database_name, object_id, index_id, partition_number, schema_name, table_name,
+                index_name, avg_fragmentation, page_count, scanned_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(
+            r["database"], r["object_id"], r["index_id"], r["partition_number"], r["schema"], r["table"],
+            r["index"], r["fragmentation"], r["page_count"], now
+        ) for r in rows])
+
+        _purge_history(conn)
+
+
+def _purge_history(conn, now=None):
+    now = now or datetime.now()
+    cutoff = (now - timedelta(days=FRAG_HISTORY_RETENTION_DAYS)).isoformat()
+    return conn.execute("DELETE FROM index_snapshot_history WHERE scanned_at < ?", (cutoff,)).rowcount
+
+
+def purge_old_history(now=None):
+    """Drop trend rows older than FRAG_HISTORY_RETENTION_DAYS; returns the number deleted."""
+    with _lock, _connect() as conn:
+        return _purge_history(conn, now)
+
+
+def load_snapshot(databases=None):
+    with _lock, _connect() as conn:
+        rows = conn.execute("""
+            SELECT database_name, schema_name, table_name, index_name, index_type_desc,
+                   avg_fragmentation, page_count, scanned_at
+            FROM index_snapshot
+            ORDER BY avg_fragmentation DESC
+        """).fetchall()
+
+    wanted = set(databases) if databases is not None else None
+    return [{
+        "database": db,
+        "schema": schema,
+        "table": table,
+        "index": index,
+        "index_type_desc": index_type,
+        "fragmentation": frag,
+        "page_count": page_count,
+        "scanned_at": scanned_at,
+    } for db, schema, table, index, index_type, frag, page_count, scanned_at in rows
+        if wanted is None or db in wanted]
+
+
+def invalidate_snapshots(databases=None):
+    """Force a full rescan next time, e.g. after REBUILD/REORGANIZE (which does not bump last_user_update)."""
+    with _lock, _connect() as conn:
+        if databases is None:
+            conn.execute("DELETE FROM database_scan")
+        else:
+            conn.executemany("DELETE FROM database_scan WHERE database_name = ?", [(db,) for db in databases])
+
+
+def get_fragmentation_history(database, schema, table, index, limit=100):
+    with _lock, _connect() as conn:
+        rows = conn.execute("""
+            SELECT scanned_at, partition_number, avg_fragmentation, page_count
+            FROM index_snapshot_history
+            WHERE database_name = ? AND schema_name = ? AND table_name = ? AND index_name = ?
+            ORDER BY scanned_at DESC
+            LIMIT ?
+        """, (database, schema, table, index, limit)).fetchall()
+
+    return [{
+        "scanned_at": scanned_at,
+        "partition_number": partition_number,
+        "fragmentation": frag,
+        "page_count": page_count,
+    } for scanned_at, partition_number, frag, page_count in rows]
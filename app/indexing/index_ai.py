@@ -1,4 +1,5 @@
 from app.gemini_client import ask_gemini
+from app.optimization.prompt_budget import prompt_metrics
 import re
 
 def get_index_recommendation(sp_texts, table_info_text):
@@ -86,6 +87,7 @@ CREATE INDEX IX_<Table>_<Column(s)> ON [<DatabaseName>].[<SchemaName>].[<TableNa
 # 2. === ALASAN === (analisa singkat)
 # """
 
+    prompt_metrics.record("index_recommendation", prompt)
     response = ask_gemini(prompt)
     # print("AI Response:", response)
     return extract_index_ddl(response)
@@ -96,6 +98,11 @@ def extract_index_ddl(ai_text):
     Mendeteksi berbagai variasi, seperti NONCLUSTERED, UNIQUE, dan komentar SQL.
     """
     pattern = re.compile(r"CREATE\s+(?:NONCLUSTERED\s+|UNIQUE\s+)?INDEX\s+[\[\]A-Za-z0-9_]+.*?ON\s+[\[\]A-Za-z0-9_.]+\s*\([^)]+\);", re.IGNORECASE | re.DOTALL)
-    matches = pattern.findall(ai_text)
+    matches = pattern.findall(ai_text or "")  # None when the AI call failed
     return "\n".join([m.strip() for m in matches])
 
+
+def split_index_ddl(ddl):
+    """The ";"-terminated statements of extract_index_ddl output (a CREATE INDEX may span lines)."""
+    return [part.strip() + ";" for part in (ddl or "").split(";") if part.strip()]
+
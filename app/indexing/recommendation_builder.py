@@ -1,34 +1,29 @@
-from app.indexing.fragmentation_analyzer import generate_maintenance_sql
+from app.indexing.fragmentation_analyzer import generate_maintenance_sql, scan_index_fragmentation
 from app.indexing.index_ai import get_index_recommendation
-from app.optimization.sp_loader import get_stored_procedures, get_sp_definition, get_tables, get_table_columns
+from app.optimization.sp_loader import get_stored_procedures, format_table_info, get_tables_metadata
+from app.utils.sql_references import extract_references
 
 def generate_recommendation_procedure(connection, database):
     # 1. Dapatkan SQL Rebuild/Reorganize
-    frag_results = analyze_index_fragmentation_all(connection)
+    frag_results = scan_index_fragmentation(connection)
+    frag_results = [r for r in frag_results if r["recommendation"] in ("REBUILD", "REORGANIZE")]
     maintenance_sql = generate_maintenance_sql(frag_results)
 
     # 2. Ambil semua SP dan info tabel
     sps = get_stored_procedures(connection, database)
-    sps = [sp for sp in sps if not sp["is_encrypted"]]
+    sps = [sp for sp in sps if not sp["is_encrypted"] and sp["definition"]]
+
+    # Metadata for every table any SP references, fetched once and shared by all SPs
+    refs = {(sp["schema"], sp["name"]): list(extract_references(sp["definition"], database).tables) for sp in sps}
+    metadata = get_tables_metadata(connection, [t for tables in refs.values() for t in tables], database)
 
     all_sql = []
     for sp in sps:
-        sp_def = get_sp_definition(connection, database, sp["schema"], sp["name"])
-        if not sp_def:
-            continue
-
-        tables = get_tables(connection, database)
-        table_info_lines = []
-        for tbl in tables:
-            cols = get_table_columns(connection, database, tbl["schema"], tbl["table"])
-            line = f"{tbl['schema']}.{tbl['table']} ({', '.join(cols)})"
-            table_info_lines.append(line)
-        table_info_text = "\n".join(table_info_lines)
-
-        ai_response = get_index_recommendation(sp_def, table_info_text)
-        if "=== INDEX_RECOMMENDATION ===" in ai_response:
-            rec_section = ai_response.split("=== INDEX_RECOMMENDATION ===")[1]
-            rec_sql = rec_section.split("===")[0].strip()
+        table_info_text = format_table_info(metadata, refs[(sp["schema"], sp["name"])], database, sp["definition"])
+
+        # get_index_recommendation already returns only the CREATE INDEX statements
+        rec_sql = get_index_recommendation(sp["definition"], table_info_text)
+        if rec_sql:
             all_sql.append(rec_sql)
 
     all_sql_combined = maintenance_sql.strip() + "\n\n-- AI Suggested Indexes --\n" + "\n".join(all_sql)
@@ -0,0 +1,173 @@
+import json
+import os
+import sqlite3
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+# Background jobs for slow AI calls, so a web worker is not held for the whole LLM round-trip
+JOB_DB = os.getenv("JOB_DB", os.path.join("data", "jobs.db"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))            # concurrent LLM jobs
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "20"))   # queued + running before submit is refused
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "7"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner_pid INTEGER,
+    params TEXT,
+    result TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS ix_jobs_created ON jobs (created_at);
+"""
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_executor = None
+_pending = 0
+
+
+@contextmanager
+def _connect():
+    folder = os.path.dirname(JOB_DB)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    conn = sqlite3.connect(JOB_DB, timeout=30)
+    try:
+        conn.executescript(SCHEMA_SQL)
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":
+        return False  # os.kill(pid, 0) would send CTRL_C_EVENT; the dev server is a single process anyway
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _get_executor():
+    """Created on first submit; jobs left queued/running by a process that no longer exists can never finish."""
+    global _executor
+    if _executor is None:
+        with _connect() as conn:
+            orphans = conn.execute(
+                "SELECT job_id, owner_pid FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE job_id = ?",
+                [(FAILED, "Interrupted by a server restart", _now(), job_id)
+                 for job_id, pid in orphans if pid is None or not _pid_alive(pid)]
+            )
+            cutoff = (datetime.now() - timedelta(days=JOB_RETENTION_DAYS)).isoformat()
+            conn.execute("DELETE FROM jobs WHERE created_at < ?", (cutoff,))
+        _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+    return _executor
+
+
+def _update(job_id, **fields):
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    with _connect() as conn:
+        conn.execute(f"UPDATE jobs SET {columns} WHERE job_id = ?", (*fields.values(), job_id))
+
+
+def _run(job_id, fn, params):
+    global _pending
+    try:
+        _update(job_id, status=RUNNING, started_at=_now())
+        result = fn(**params)
+        _update(job_id, status=DONE, result=json.dumps(result, default=str), finished_at=_now())
+    except Exception as e:
+        traceback.print_exc()
+        _update(job_id, status=FAILED, error=str(e), finished_at=_now())
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+def submit(kind, fn, **params):
+    """
+    Run fn(**params) on a job worker and return the job id right away.
+    params must be JSON-serialisable (they are stored with the job); fn's return value too.
+    Raises JobQueueFull when JOB_MAX_PENDING jobs are already waiting or running.
+    """
+    global _pending
+    with _lock:
+        executor = _get_executor()
+        if _pending >= JOB_MAX_PENDING:
+            raise JobQueueFull(f"{_pending} jobs already pending, try again later")
+        _pending += 1
+
+    job_id = uuid.uuid4().hex
+    try:
+        with _connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, kind, status, owner_pid, params, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, os.getpid(), json.dumps(params, default=str), _now())
+            )
+        executor.submit(_run, job_id, fn, params)
+    except Exception:
+        with _lock:
+            _pending -= 1
+        raise
+    return job_id
+
+
+def get_job(job_id):
+    with _connect() as conn:
+        row = conn.execute("""
+            SELECT job_id, kind, status, params, result, error, created_at, started_at, finished_at
+            FROM jobs WHERE job_id = ?
+        """, (job_id,)).fetchone()
+    if row is None:
+        return None
+
+    job_id, kind, status, params, result, error, created_at, started_at, finished_at = row
+    return {
+        "job_id": job_id,
+        "kind": kind,
+        "status": status,
+        "params": json.loads(params) if params else {},
+        "result": json.loads(result) if result else None,
+        "error": error,
+        "created_at": created_at,
+        "started_at": started_at,
+        "finished_at": finished_at,
+    }
+
+
+def get_job_stats():
+    with _connect() as conn:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    with _lock:
+        pending = _pending
+    return {"workers": JOB_WORKERS, "max_pending": JOB_MAX_PENDING, "pending": pending, "by_status": counts}
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# Seconds an entry is served without asking the server; after that a cheap version check decides
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", "300"))
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "2048"))
+
+# Same attributes the routes read from the old pyodbc rows
+IndexColumn = namedtuple("IndexColumn", "index_name index_type column_name is_included_column")
+
+TableMetadata = namedtuple("TableMetadata", "version columns indexes")
+
+
+def cache_key(db, schema, table):
+    return f"{db}.{schema}.{table}".lower()
+
+
+class MetadataCache:
+    """Process-wide LRU of table metadata keyed by db.schema.table, with a TTL per entry."""
+
+    def __init__(self, ttl=METADATA_CACHE_TTL, max_entries=METADATA_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (TableMetadata, checked_at)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "revalidated": 0, "invalidated": 0, "evicted": 0}
+
+    def lookup(self, key):
+        """Return (metadata or None, fresh). Stale entries still come back so the caller can revalidate."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self._stats["misses"] += 1
+                return None, False
+
+            self._entries.move_to_end(key)
+            metadata, checked_at = item
+            fresh = time.monotonic() - checked_at < self.ttl
+            if fresh:
+                self._stats["hits"] += 1
+            return metadata, fresh
+
+    def revalidate(self, key):
+        """Server version unchanged: restart the TTL without refetching."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                self._entries[key] = (item[0], time.monotonic())
+                self._stats["revalidated"] += 1
+
+    def store(self, key, metadata):
+        with self._lock:
+            if key in self._entries:
+                self._stats["invalidated"] += 1
+            self._entries[key] = (metadata, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evicted"] += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._stats["invalidated"] += len(self._entries)
+                self._entries.clear()
+            elif self._entries.pop(key, None) is not None:
+                self._stats["invalidated"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["ttl"] = self.ttl
+        stats["max_entries"] = self.max_entries
+        return stats
+
+
+metadata_cache = MetadataCache()
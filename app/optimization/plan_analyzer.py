@@ -0,0 +1,254 @@
+"""
+Cached execution plans of a procedure, reduced to what the optimizer prompt needs.
+
+Plans come from sys.dm_exec_text_query_plan (text, so plans nested too deep for the xml type
+still arrive) and are parsed with a streaming XMLPullParser: elements are cleared as soon as
+they are closed, so memory stays small for plans of many megabytes. The summary lists the most
+expensive operators (own estimated cost, not subtree cost), scans, key / RID lookups, spills,
+plan-affecting implicit conversions and SQL Server's missing-index suggestions.
+"""
+import os
+from xml.etree.ElementTree import XMLPullParser
+
+from app.catalog_collector import quote_name
+
+PLAN_ANALYSIS_ENABLED = os.getenv("PLAN_ANALYSIS_ENABLED", "true").lower() in ("1", "true", "yes")
+PLAN_SUMMARY_MAX_ITEMS = int(os.getenv("PLAN_SUMMARY_MAX_ITEMS", "8"))   # lines per section
+
+SHOWPLAN_NS = "{http://schemas.microsoft.com/sqlserver/2004/07/showplan}"
+_FEED_SIZE = 64 * 1024
+
+_SCAN_OPS = {"Table Scan", "Clustered Index Scan", "Index Scan", "Columnstore Index Scan"}
+_SPILL_TAGS = {"SpillToTempDb", "HashSpillDetails", "SortSpillDetails", "ExchangeSpillDetails"}
+
+
+def get_cached_plans(connection, database_name, schema, name):
+    """Showplan XML of every cached plan of the procedure (several with different SET options)."""
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT qp.query_plan
+        FROM sys.dm_exec_procedure_stats ps
+        CROSS APPLY sys.dm_exec_text_query_plan(ps.plan_handle, 0, -1) qp
+        WHERE ps.database_id = DB_ID(?) AND ps.object_id = OBJECT_ID(?)
+          AND qp.query_plan IS NOT NULL
+        ORDER BY ps.total_elapsed_time DESC
+    """, database_name, f"{quote_name(database_name)}.{quote_name(schema)}.{quote_name(name)}")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _local(tag):
+    return tag[len(SHOWPLAN_NS):] if tag.startswith(SHOWPLAN_NS) else tag.rsplit("}", 1)[-1]
+
+
+def _float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _object_name(attrib):
+    parts = [attrib.get(key) for key in ("Database", "Schema", "Table")]
+    name = ".".join(p.strip("[]") for p in parts if p)
+    if attrib.get("Index"):
+        name += f" ({attrib['Index'].strip('[]')})"
+    return name
+
+
+def _short(text, limit=100):
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def _statement_key(text, limit=200):
+    """Whitespace-insensitive prefix of a statement, to find it again in a block of the SP text."""
+    return " ".join((text or "").split()).lower()[:limit]
+
+
+class _PlanWalker:
+    """Collects findings from start / end events of one showplan document."""
+
+    def __init__(self, summary):
+        self.summary = summary
+        self.statement = None     # text of the statement being walked
+        self.key = None           # its _statement_key
+        self.frames = []          # one per open RelOp
+        self.missing = None       # MissingIndexGroup being collected
+        self.column_group = None
+
+    def start(self, tag, attrib):
+        if tag == "StmtSimple":
+            self.statement = _short(attrib.get("StatementText"))
+            self.key = _statement_key(attrib.get("StatementText"))
+            cost = _float(attrib.get("StatementSubTreeCost"))
+            self.summary["total_cost"] += cost
+            self.summary["statements"].append({"text": self.statement, "cost": cost, "key": self.key})
+        elif tag == "RelOp":
+            self.frames.append({
+                "op": attrib.get("PhysicalOp", "?"),
+                "subtree": _float(attrib.get("EstimatedTotalSubtreeCost")),
+                "rows": _float(attrib.get("EstimateRows")),
+                "children": 0.0,
+                "object": None,
+                "lookup": attrib.get("PhysicalOp") == "RID Lookup",
+            })
+        elif tag == "IndexScan" and self.frames and attrib.get("Lookup") in ("1", "true"):
+            self.frames[-1]["lookup"] = True
+        elif tag == "Object" and self.frames and self.frames[-1]["object"] is None and self.missing is None:
+            self.frames[-1]["object"] = _object_name(attrib)
+        elif tag in _SPILL_TAGS:
+            op = self.frames[-1]["op"] if self.frames else "?"
+            level = attrib.get("SpillLevel")
+            self.summary["spills"].append({
+                "text": f"{op} spilled to tempdb" + (f" (level {level})" if level else "") + f" in: {self.statement}",
+                "key": self.key,
+            })
+        elif tag == "PlanAffectingConvert":
+            self.summary["conversions"].append({
+                "text": f"{attrib.get('Expression', '?')} affects {attrib.get('ConvertIssue', 'plan choice')}",
+                "key": self.key,
+            })
+        elif tag == "MissingIndexGroup":
+            self.missing = {"impact": _float(attrib.get("Impact")), "table": "", "columns": {}}
+        elif tag == "MissingIndex" and self.missing is not None:
+            self.missing["table"] = _object_name(attrib)
+        elif tag == "ColumnGroup" and self.missing is not None:
+            self.column_group = self.missing["columns"].setdefault(attrib.get("Usage", "").lower(), [])
+        elif tag == "Column" and self.column_group is not None:
+            self.column_group.append(attrib.get("Name", "").strip("[]"))
+
+    def end(self, tag):
+        if tag == "RelOp":
+            frame = self.frames.pop()
+            own = max(0.0, frame["subtree"] - frame["children"])
+            if self.frames:
+                self.frames[-1]["children"] += frame["subtree"]
+            op = "Key Lookup" if frame["lookup"] and frame["op"] != "RID Lookup" else frame["op"]
+            item = {"op": op, "object": frame["object"] or "", "cost": own, "rows": frame["rows"],
+                    "statement": self.statement, "key": self.key}
+            self.summary["operators"].append(item)
+            if op in _SCAN_OPS:
+                self.summary["scans"].append(item)
+            elif frame["lookup"]:
+                self.summary["lookups"].append(item)
+        elif tag == "ColumnGroup":
+            self.column_group = None
+        elif tag == "MissingIndexGroup" and self.missing is not None:
+            columns = self.missing["columns"]
+            parts = [f"{usage}: {', '.join(cols)}" for usage, cols in
+                     (("equality", columns.get("equality")), ("inequality", columns.get("inequality")),
+                      ("include", columns.get("include"))) if cols]
+            self.summary["missing_indexes"].append({
+                "text": f"{self.missing['table']} ({'; '.join(parts)}), impact {self.missing['impact']:.0f}%",
+                "key": self.key,
+            })
+            self.missing = None
+        elif tag == "StmtSimple":
+            self.statement = self.key = None
+
+
+def analyze_plan_xml(plan_xml, summary=None):
+    """Add the findings of one showplan document to summary (a new one when None) and return it."""
+    if summary is None:
+        summary = {"plans": 0, "total_cost": 0.0, "statements": [], "operators": [], "scans": [],
+                   "lookups": [], "spills": [], "conversions": [], "missing_indexes": []}
+    summary["plans"] += 1
+    walker = _PlanWalker(summary)
+    parser = XMLPullParser(events=("start", "end"))
+
+    for offset in range(0, len(plan_xml), _FEED_SIZE):
+        parser.feed(plan_xml[offset:offset + _FEED_SIZE])
+        for event, element in parser.read_events():
+            tag = _local(element.tag)
+            if event == "start":
+                walker.start(tag, element.attrib)
+            else:
+                walker.end(tag)
+                element.clear()   # nothing is kept once a node has been seen
+    parser.close()
+    return summary
+
+
+def format_plan_summary(summary, max_items=None, statement_filter=None):
+    """
+    Compact text for the prompt and result page; None when there is nothing to report.
+    statement_filter(key) limits it to some statements (see block_plan_summary); shares stay
+    relative to the cost of the whole procedure.
+    """
+    if not summary or not summary["plans"]:
+        return None
+    max_items = max_items or PLAN_SUMMARY_MAX_ITEMS
+    total = summary["total_cost"] or 1.0
+    keep = statement_filter or (lambda key: True)
+
+    def pct(cost):
+        return f"{cost / total * 100:.0f}%"
+
+    def operator_line(item):
+        on = f" on {item['object']}" if item["object"] else ""
+        return f"- {pct(item['cost'])} {item['op']}{on} (est. {item['rows']:,.0f} rows) in: {item['statement']}"
+
+    statements = [item for item in summary["statements"] if keep(item["key"])]
+    if not statements:
+        return None
+    if statement_filter is None:
+        lines = [f"Estimated cost {summary['total_cost']:.2f} over {len(statements)} statements "
+                 f"({summary['plans']} cached plan(s))."]
+    else:
+        cost = sum(item["cost"] for item in statements)
+        lines = [f"Estimated cost {cost:.2f} ({pct(cost)} of the procedure's {summary['total_cost']:.2f}) "
+                 f"over {len(statements)} statements of this fragment."]
+
+    operators = [item for item in summary["operators"] if keep(item["key"])]
+    expensive = sorted((item for item in operators if item["cost"] > 0), key=lambda item: -item["cost"])[:max_items]
+    if expensive:
+        lines.append("Most expensive operators (share of estimated cost):")
+        lines += [operator_line(item) for item in expensive]
+
+    listed = {id(item) for item in expensive}
+    for title, items in (("Other scans", summary["scans"]), ("Other key / RID lookups", summary["lookups"])):
+        items = sorted((item for item in items if id(item) not in listed and keep(item["key"])),
+                       key=lambda item: -item["cost"])[:max_items]
+        if items:
+            lines.append(f"{title}:")
+            lines += [operator_line(item) for item in items]
+
+    for title, items in (("Spills to tempdb", summary["spills"]),
+                         ("Implicit conversions affecting the plan", summary["conversions"]),
+                         ("Missing index suggestions from SQL Server", summary["missing_indexes"])):
+        texts = list(dict.fromkeys(item["text"] for item in items if keep(item["key"])))[:max_items]
+        if texts:
+            lines.append(f"{title}:")
+            lines += [f"- {text}" for text in texts]
+
+    return "\n".join(lines)
+
+
+def block_plan_summary(summary, block_text, max_items=None):
+    """format_plan_summary for the statements that appear in block_text (one chunk of a large SP)."""
+    block = _statement_key(block_text, limit=None)
+    return format_plan_summary(summary, max_items, lambda key: bool(key) and key in block)
+
+
+def get_plan_analysis(connection, database_name, schema, name):
+    """analyze_plan_xml of every cached plan of the procedure; None when not cached, disabled or not permitted."""
+    if not PLAN_ANALYSIS_ENABLED:
+        return None
+    try:
+        plans = get_cached_plans(connection, database_name, schema, name)
+    except Exception as e:
+        print(f"[WARN] Could not read cached plans of {schema}.{name}: {e}")
+        return None
+
+    summary = None
+    for plan_xml in plans:
+        try:
+            summary = analyze_plan_xml(plan_xml, summary)
+        except Exception as e:
+            print(f"[WARN] Could not parse a cached plan of {schema}.{name}: {e}")
+    return summary
+
+
+def get_plan_summary(connection, database_name, schema, name):
+    """format_plan_summary of the procedure's cached plans; None when not cached, disabled or not permitted."""
+    return format_plan_summary(get_plan_analysis(connection, database_name, schema, name))
@@ -0,0 +1,186 @@
+import os
+import threading
+from collections import OrderedDict
+
+from app.utils.sql_references import extract_references
+from app.utils.sql_tokens import get_sp_tokens
+
+# Upper bound for one prompt (SP text + table context + instructions), in estimated tokens
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "24000"))
+PROMPT_OVERHEAD_TOKENS = 1500   # instruction text of the optimize / index prompt templates
+MIN_CONTEXT_TOKENS = 500        # table context always gets at least this much
+
+
+def estimate_tokens(text):
+    """~4 characters per token for English + SQL; good enough for budgeting without a tokenizer."""
+    return (len(text or "") + 3) // 4
+
+
+def context_budget(sp_text, budget=None):
+    """Tokens left for table context once the SP text and the prompt instructions are in."""
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    return max(MIN_CONTEXT_TOKENS, budget - PROMPT_OVERHEAD_TOKENS - estimate_tokens(sp_text))
+
+
+def sp_over_budget(sp_text, budget=None):
+    """True when the SP text alone leaves less than MIN_CONTEXT_TOKENS of the budget for table context."""
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    return estimate_tokens(sp_text) + PROMPT_OVERHEAD_TOKENS + MIN_CONTEXT_TOKENS > budget
+
+
+def _predicate_columns(sp_text, default_db):
+    """({table name or alias-resolved name (lowercase): {column}}, {unqualified column})"""
+    qualified, unqualified = {}, set()
+    if not sp_text:
+        return qualified, unqualified
+    for table, column in extract_references(sp_text, default_db).columns:
+        if table:
+            qualified.setdefault(table.lower(), set()).add(column.lower())
+            qualified.setdefault(table.lower().split(".")[-1], set()).add(column.lower())
+        else:
+            unqualified.add(column.lower())
+    return qualified, unqualified
+
+
+def compact_indexes(indexes):
+    """
+    One entry per index ("IX_Orders_Date NONCLUSTERED (key: OrderDate; include: Total)") instead of one
+    per index column; an index with the same definition as an earlier one is only referenced.
+    """
+    grouped = OrderedDict()
+    for idx in indexes:
+        entry = grouped.setdefault(idx.index_name, (idx.index_type, [], []))
+        entry[2 if idx.is_included_column else 1].append(idx.column_name)
+
+    parts, seen = [], {}
+    for name, (index_type, keys, includes) in grouped.items():
+        signature = (index_type, tuple(keys), tuple(sorted(includes)))
+        if signature in seen:
+            parts.append(f"{name} (same as {seen[signature]})")
+            continue
+        seen[signature] = name
+        text = f"{name} {index_type} (key: {', '.join(keys)}"
+        if includes:
+            text += f"; include: {', '.join(includes)}"
+        parts.append(text + ")")
+    return parts
+
+
+class _TableContext:
+    def __init__(self, name, meta, sp_tokens, predicates, unqualified):
+        short = name.split(".")[-1].lower()
+        wanted = predicates.get(name.lower(), set()) | predicates.get(short, set())
+
+        self.name = name
+        self.predicate = []   # columns used in WHERE / ON / ORDER BY
+        self.used = []        # other columns that appear in the SP text
+        self.other = []
+        for col, dtype in meta.columns:
+            lowered = col.lower()
+            if lowered in wanted or lowered in unqualified:
+                self.predicate.append(f"{col} ({dtype})")
+            elif sp_tokens is not None and lowered in sp_tokens.identifiers:
+                self.used.append(f"{col} ({dtype})")
+            else:
+                self.other.append(f"{col} ({dtype})")
+        self.indexes = compact_indexes(meta.indexes)
+        self.score = len([c for c in meta.columns if c[0].lower() in wanted])
+
+    def render(self, level):
+        """level 2: every used column + indexes; 1: predicate columns + indexes; 0: predicate columns only."""
+        # nothing matched the SP text: same fallback as filter_used_columns
+        full = self.predicate + self.used or self.other
+        cols = full if level >= 2 else list(self.predicate)
+        if len(full) > len(cols):
+            cols.append(f"+{len(full) - len(cols)} more columns")
+        line = f"{self.name} ({', '.join(cols)})"
+        if level >= 1 and self.indexes:
+            line += " | Indexes: " + ", ".join(self.indexes)
+        return line
+
+
+def build_table_context(metadata, sp_text=None, default_db=None, budget_tokens=None):
+    """
+    Table info lines for the prompt, kept within budget_tokens (default: context_budget(sp_text)).
+    Tables with predicate columns come first; when the full listing does not fit, tables are
+    shortened to their predicate columns and indexes, then to predicate columns, then dropped.
+    Returns (text, stats) where stats has tables, tokens and truncated.
+    """
+    if budget_tokens is None:
+        budget_tokens = context_budget(sp_text)
+
+    sp_tokens = get_sp_tokens(sp_text) if sp_text else None
+    predicates, unqualified = _predicate_columns(sp_text, default_db)
+
+    tables = []
+    for name, meta in metadata.items():
+        if not meta.columns and not meta.indexes:
+            print(f"[WARN] Could not load columns for {name}")
+            continue
+        tables.append(_TableContext(name, meta, sp_tokens, predicates, unqualified))
+    # stable sort: most predicate columns first, otherwise SP reference order
+    tables.sort(key=lambda t: -t.score)
+
+    levels = [2] * len(tables)
+    lines = [t.render(2) for t in tables]
+    total = sum(estimate_tokens(line) + 1 for line in lines)
+    truncated = False
+
+    # shrink the least relevant tables first, one level at a time
+    for target in (1, 0):
+        for i in reversed(range(len(tables))):
+            if total <= budget_tokens:
+                break
+            if levels[i] > target:
+                new_line = tables[i].render(target)
+                total += estimate_tokens(new_line) - estimate_tokens(lines[i])
+                lines[i], levels[i] = new_line, target
+                truncated = True
+
+    dropped = 0
+    while total > budget_tokens and lines:
+        total -= estimate_tokens(lines.pop()) + 1
+        dropped += 1
+        truncated = True
+    if dropped:
+        lines.append(f"-- {dropped} more tables omitted (prompt budget)")
+
+    text = "\n".join(lines)
+    return text, {"tables": len(tables), "tokens": estimate_tokens(text), "truncated": truncated,
+                  "dropped_tables": dropped}
+
+
+class PromptMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kinds = {}
+        self._context = {"built": 0, "truncated": 0, "tables_dropped": 0}
+
+    def record(self, kind, prompt):
+        tokens = estimate_tokens(prompt)
+        with self._lock:
+            stats = self._kinds.setdefault(kind, {"calls": 0, "tokens_total": 0, "tokens_max": 0, "over_budget": 0})
+            stats["calls"] += 1
+            stats["tokens_total"] += tokens
+            stats["tokens_max"] = max(stats["tokens_max"], tokens)
+            stats["over_budget"] += tokens > PROMPT_TOKEN_BUDGET
+        if tokens > PROMPT_TOKEN_BUDGET:
+            print(f"⚠️ {kind} prompt is ~{tokens} tokens, over PROMPT_TOKEN_BUDGET={PROMPT_TOKEN_BUDGET}")
+        return tokens
+
+    def record_context(self, stats):
+        with self._lock:
+            self._context["built"] += 1
+            self._context["truncated"] += bool(stats["truncated"])
+            self._context["tables_dropped"] += stats["dropped_tables"]
+
+    def stats(self):
+        with self._lock:
+            kinds = {kind: dict(stats) for kind, stats in self._kinds.items()}
+            context = dict(self._context)
+        for stats in kinds.values():
+            stats["tokens_avg"] = stats["tokens_total"] / stats["calls"] if stats["calls"] else 0
+        return {"budget": PROMPT_TOKEN_BUDGET, "by_kind": kinds, "table_context": context}
+
+
+prompt_metrics = PromptMetrics()
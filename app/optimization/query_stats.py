@@ -0,0 +1,119 @@
+"""
+Slow stored procedures from sys.dm_exec_procedure_stats.
+
+One row per procedure (all cached plans of a procedure summed on the server), TOP-N by the
+chosen sort, keyset paging, and the SQL text only when asked for. Times in the DMV are in
+microseconds; rows carry milliseconds for display and the integer sort value for paging.
+"""
+
+# sort key -> (label, aggregated expression in the ranked CTE)
+SORT_OPTIONS = {
+    "elapsed": ("Avg duration", "avg_elapsed_us"),
+    "cpu": ("Avg CPU", "avg_cpu_us"),
+    "reads": ("Avg logical reads", "avg_logical_reads"),
+    "executions": ("Executions", "execution_count"),
+}
+DEFAULT_SORT = "elapsed"
+MAX_PAGE_SIZE = 500
+
+_QUERY = """
+    WITH proc_stats AS (
+        SELECT
+            ps.database_id,
+            ps.object_id,
+            SUM(ps.execution_count) AS execution_count,
+            SUM(ps.total_worker_time) AS total_cpu_us,
+            SUM(ps.total_elapsed_time) AS total_elapsed_us,
+            SUM(ps.total_logical_reads) AS total_logical_reads,
+            MAX(ps.last_execution_time) AS last_execution_time,
+            MIN(ps.cached_time) AS cached_time,
+            COUNT(*) AS plan_count
+        FROM sys.dm_exec_procedure_stats ps
+        WHERE ps.database_id > 4 AND ps.database_id <> 32767   -- no system / resource databases
+          AND ps.type = 'P'
+        GROUP BY ps.database_id, ps.object_id
+    ), ranked AS (
+        SELECT *,
+            total_cpu_us / execution_count AS avg_cpu_us,
+            total_elapsed_us / execution_count AS avg_elapsed_us,
+            total_logical_reads / execution_count AS avg_logical_reads
+        FROM proc_stats
+        WHERE execution_count > 0
+    )
+    SELECT TOP (?)
+        DB_NAME(database_id) AS database_name,
+        OBJECT_SCHEMA_NAME(object_id, database_id) AS schema_name,
+        OBJECT_NAME(object_id, database_id) AS object_name,
+        database_id,
+        object_id,
+        execution_count,
+        avg_cpu_us,
+        avg_elapsed_us,
+        avg_logical_reads,
+        total_elapsed_us,
+        last_execution_time,
+        cached_time,
+        plan_count,
+        {sort} AS sort_value
+    FROM ranked
+    WHERE OBJECT_NAME(object_id, database_id) IS NOT NULL
+      {keyset}
+    ORDER BY {sort} DESC, database_id, object_id
+"""
+
+_KEYSET = "AND ({sort} < ? OR ({sort} = ? AND (database_id > ? OR (database_id = ? AND object_id > ?))))"
+
+
+def encode_cursor(row):
+    """Opaque "next page" token: the sort value and id of the last row shown."""
+    return f"{row['sort_value']}:{row['database_id']}:{row['object_id']}"
+
+
+def decode_cursor(token):
+    """(sort_value, database_id, object_id); ValueError for anything that is not a cursor."""
+    value, database_id, object_id = (int(part) for part in token.split(":"))
+    return value, database_id, object_id
+
+
+def get_slow_sp(connection, sort=DEFAULT_SORT, limit=50, after=None):
+    """
+    Slowest procedures by sort ("elapsed", "cpu", "reads" or "executions"), limit rows per page.
+    after is the cursor of the previous page. Returns (rows, next cursor or None).
+    """
+    if sort not in SORT_OPTIONS:
+        raise ValueError(f"Unknown sort {sort!r}, expected one of {', '.join(SORT_OPTIONS)}")
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    column = SORT_OPTIONS[sort][1]
+
+    params = [limit + 1]   # one extra row tells whether there is a next page
+    keyset = ""
+    if after:
+        value, database_id, object_id = decode_cursor(after)
+        keyset = _KEYSET.format(sort=column)
+        params += [value, value, database_id, database_id, object_id]
+
+    cursor = connection.cursor()
+    cursor.execute(_QUERY.format(sort=column, keyset=keyset), params)
+    columns = [desc[0] for desc in cursor.description]
+    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    for row in rows:
+        row["full_name"] = f"{row['database_name']}.{row['schema_name']}.{row['object_name']}"
+        row["avg_cpu_ms"] = row["avg_cpu_us"] / 1000.0
+        row["avg_elapsed_ms"] = row["avg_elapsed_us"] / 1000.0
+
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def get_slow_sp_text(connection, database_id, object_id):
+    """Definition of one procedure as cached with its plan, or None when it left the plan cache."""
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT TOP 1 st.text
+        FROM sys.dm_exec_procedure_stats ps
+        CROSS APPLY sys.dm_exec_sql_text(ps.sql_handle) st
+        WHERE ps.database_id = ? AND ps.object_id = ?
+    """, database_id, object_id)
+    row = cursor.fetchone()
+    return row[0] if row else None
@@ -0,0 +1,295 @@
+"""
+Before / after benchmark of a stored procedure and its optimized (_Opt_) copy.
+
+Both procedures run with the same parameters, interleaved (A B, B A, ...) so drift on the
+server hits both alike. Every run is measured three ways:
+  - client latency: execute until the last row is fetched
+  - SET STATISTICS IO / TIME messages: logical / physical reads and CPU of the EXEC
+  - sys.dm_exec_procedure_stats deltas: server CPU, elapsed time and reads (only when no
+    other session ran the procedure in between)
+Every run is rolled back. Cold runs empty the buffer pool first (CHECKPOINT +
+DBCC DROPCLEANBUFFERS, sysadmin only) - never on a production server.
+
+    python -m app.optimization.sp_benchmark Sales.dbo.uspGetOrders --param @CustomerID=42 --runs 20
+    python -m app.optimization.sp_benchmark Sales.dbo.uspGetOrders --cold --runs 5
+"""
+import argparse
+import re
+import time
+
+from app.catalog_collector import quote_name
+from app.db_connector import get_connection
+
+BENCHMARK_FETCH_SIZE = 5000
+_PARAM_NAME_RE = re.compile(r"^@[A-Za-z_][\w@#$]*$")
+_IO_RE = re.compile(r"Table '([^']*)'\. Scan count (\d+), logical reads (\d+), physical reads (\d+)")
+_TIME_RE = re.compile(r"SQL Server Execution Times:\s*CPU time = (\d+) ms,\s*elapsed time = (\d+) ms")
+
+
+def get_sp_parameters(connection, database_name, schema, name):
+    """{"@name" (lowercase): type name} of the procedure's parameters; LookupError when it does not exist."""
+    full_name = f"{quote_name(database_name)}.{quote_name(schema)}.{quote_name(name)}"
+    cursor = connection.cursor()
+    cursor.execute("SELECT OBJECT_ID(?, 'P')", full_name)
+    if cursor.fetchone()[0] is None:
+        raise LookupError(f"Stored procedure {database_name}.{schema}.{name} not found")
+    cursor.execute(f"""
+        SELECT p.name, TYPE_NAME(p.user_type_id)
+        FROM {quote_name(database_name)}.sys.parameters p
+        WHERE p.object_id = OBJECT_ID(?)
+    """, full_name)
+    return {row[0].lower(): row[1] for row in cursor.fetchall()}
+
+
+def build_exec_sql(database_name, schema, name, params=None, known_params=None):
+    """
+    ("EXEC [db].[schema].[name] @a = ?, @b = ?", [values]) for {"@a": value, ...}.
+    Parameter names must be plain @identifiers (and among known_params when given); values are
+    always bound, never put into the SQL text.
+    """
+    assignments, values = [], []
+    for param, value in (params or {}).items():
+        param = param if param.startswith("@") else "@" + param
+        if not _PARAM_NAME_RE.match(param):
+            raise ValueError(f"Invalid parameter name {param!r}")
+        if known_params is not None and param.lower() not in known_params:
+            raise ValueError(f"{name} has no parameter {param}")
+        assignments.append(f"{param} = ?")
+        values.append(value)
+
+    sql = f"EXEC {quote_name(database_name)}.{quote_name(schema)}.{quote_name(name)}"
+    if assignments:
+        sql += " " + ", ".join(assignments)
+    return sql, values
+
+
+def find_optimized_variant(connection, database_name, schema, name):
+    """Name of the newest <name>_Opt_<timestamp> procedure saved by save_optimized_sp, or None."""
+    pattern = name.replace("[", "[[]").replace("_", "[_]").replace("%", "[%]") + "[_]Opt[_]%"
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        SELECT TOP 1 p.name
+        FROM {quote_name(database_name)}.sys.procedures p
+        JOIN {quote_name(database_name)}.sys.schemas s ON s.schema_id = p.schema_id
+        WHERE s.name = ? AND p.name LIKE ?
+        ORDER BY p.create_date DESC
+    """, schema, pattern)
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _proc_counters(cursor, database_name, full_name):
+    cursor.execute("""
+        SELECT SUM(execution_count), SUM(total_worker_time), SUM(total_elapsed_time),
+               SUM(total_logical_reads), SUM(total_physical_reads)
+        FROM sys.dm_exec_procedure_stats
+        WHERE database_id = DB_ID(?) AND object_id = OBJECT_ID(?)
+    """, database_name, full_name)
+    row = cursor.fetchone()
+    return tuple(value or 0 for value in row) if row else (0, 0, 0, 0, 0)
+
+
+def parse_statistics_messages(messages):
+    """Reads per table and CPU / elapsed of the whole EXEC from SET STATISTICS IO / TIME output."""
+    stats = {"logical_reads": 0, "physical_reads": 0, "tables": {}, "cpu_ms": None, "elapsed_ms": None}
+    for _, text in messages:
+        for table, _, logical, physical in _IO_RE.findall(text):
+            stats["logical_reads"] += int(logical)
+            stats["physical_reads"] += int(physical)
+            stats["tables"][table] = stats["tables"].get(table, 0) + int(logical)
+        for cpu, elapsed in _TIME_RE.findall(text):
+            # one message per statement plus one for the EXEC itself, which is the longest
+            if stats["elapsed_ms"] is None or int(elapsed) >= stats["elapsed_ms"]:
+                stats["cpu_ms"], stats["elapsed_ms"] = int(cpu), int(elapsed)
+    return stats
+
+
+def _drop_clean_buffers(connection, database_name):
+    connection.autocommit = True
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"USE {quote_name(database_name)}; CHECKPOINT; DBCC DROPCLEANBUFFERS WITH NO_INFOMSGS;")
+    finally:
+        connection.autocommit = False
+
+
+def run_once(connection, database_name, full_name, exec_sql, values, cold=False):
+    """One measured, rolled back execution."""
+    if cold:
+        _drop_clean_buffers(connection, database_name)
+
+    cursor = connection.cursor()
+    before = _proc_counters(cursor, database_name, full_name)
+
+    messages, rows = [], 0
+    start = time.perf_counter()
+    try:
+        cursor.execute(exec_sql, values)
+        while True:
+            messages += getattr(cursor, "messages", None) or []
+            if cursor.description:
+                while True:
+                    batch = cursor.fetchmany(BENCHMARK_FETCH_SIZE)
+                    if not batch:
+                        break
+                    rows += len(batch)
+            if not cursor.nextset():
+                break
+        latency_ms = (time.perf_counter() - start) * 1000
+    finally:
+        connection.rollback()
+
+    after = _proc_counters(cursor, database_name, full_name)
+    connection.rollback()
+    delta = [a - b for a, b in zip(after, before)]
+
+    run = {"latency_ms": latency_ms, "rows": rows, **parse_statistics_messages(messages)}
+    # only trust the DMV when this was the one execution in between
+    if delta[0] == 1:
+        run.update(dmv_cpu_ms=delta[1] / 1000.0, dmv_elapsed_ms=delta[2] / 1000.0,
+                   dmv_logical_reads=delta[3], dmv_physical_reads=delta[4])
+    return run
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))] if values else None
+
+
+def _avg(runs, key):
+    values = [run[key] for run in runs if run.get(key) is not None]
+    return sum(values) / len(values) if values else None
+
+
+def summarize(runs):
+    latencies = [run["latency_ms"] for run in runs]
+    return {
+        "runs": len(runs),
+        "latency_p50_ms": _percentile(latencies, 0.50),
+        "latency_p95_ms": _percentile(latencies, 0.95),
+        "latency_min_ms": min(latencies) if latencies else None,
+        "latency_max_ms": max(latencies) if latencies else None,
+        "cpu_ms": _avg(runs, "cpu_ms"),
+        "server_elapsed_ms": _avg(runs, "elapsed_ms"),
+        "logical_reads": _avg(runs, "logical_reads"),
+        "physical_reads": _avg(runs, "physical_reads"),
+        "dmv_cpu_ms": _avg(runs, "dmv_cpu_ms"),
+        "dmv_logical_reads": _avg(runs, "dmv_logical_reads"),
+        "rows": _avg(runs, "rows"),
+        "rows_min": min((run["rows"] for run in runs), default=None),
+        "rows_max": max((run["rows"] for run in runs), default=None),
+    }
+
+
+def benchmark_sp(sp_name, params=None, optimized_name=None, runs=10, cold=False, warmup=1):
+    """
+    Run "db.schema.name" and its optimized copy runs times each; returns
+    {"original": summary, "optimized": summary, ...} with the summaries of summarize().
+    """
+    parts = (sp_name or "").split(".")
+    if len(parts) != 3 or not all(parts):
+        raise ValueError("Invalid SP name, expected db.schema.name")
+    database_name, schema, name = parts
+    runs = max(1, int(runs))
+
+    with get_connection() as connection:
+        optimized_name = optimized_name or find_optimized_variant(connection, database_name, schema, name)
+        if not optimized_name:
+            raise LookupError(f"No optimized copy ({name}_Opt_...) of {sp_name} found; save one first")
+
+        variants = {}
+        for label, proc in (("original", name), ("optimized", optimized_name)):
+            known = get_sp_parameters(connection, database_name, schema, proc)
+            exec_sql, values = build_exec_sql(database_name, schema, proc, params, known)
+            full_name = f"{quote_name(database_name)}.{quote_name(schema)}.{quote_name(proc)}"
+            variants[label] = (full_name, exec_sql, values)
+
+        cursor = connection.cursor()
+        cursor.execute("SET STATISTICS IO ON; SET STATISTICS TIME ON;")
+        try:
+            if not cold:
+                # compile and load pages once, outside the measurements
+                for _ in range(warmup):
+                    for full_name, exec_sql, values in variants.values():
+                        run_once(connection, database_name, full_name, exec_sql, values)
+
+            results = {label: [] for label in variants}
+            order = list(variants)
+            for i in range(runs):
+                for label in (order if i % 2 == 0 else order[::-1]):
+                    full_name, exec_sql, values = variants[label]
+                    results[label].append(run_once(connection, database_name, full_name, exec_sql, values, cold))
+        finally:
+            cursor.execute("SET STATISTICS IO OFF; SET STATISTICS TIME OFF;")
+
+    original, optimized = summarize(results["original"]), summarize(results["optimized"])
+    warnings = []
+    # per-run counts, not averages: a variant whose row count changes between runs is not comparable
+    for label, summary in (("original", original), ("optimized", optimized)):
+        if summary["rows_min"] != summary["rows_max"]:
+            warnings.append(f"Row count of the {label} varies between runs: {summary['rows_min']} to {summary['rows_max']}")
+    if (original["rows_min"], original["rows_max"]) != (optimized["rows_min"], optimized["rows_max"]):
+        warnings.append(f"Row counts differ: {original['rows_min']}-{original['rows_max']} "
+                        f"vs {optimized['rows_min']}-{optimized['rows_max']}")
+    return {
+        "sp_name": sp_name,
+        "optimized_name": f"{database_name}.{schema}.{optimized_name}",
+        "params": params or {},
+        "mode": "cold" if cold else "warm",
+        "original": original,
+        "optimized": optimized,
+        "warnings": warnings,
+    }
+
+
+REPORT_METRICS = [
+    ("latency_p50_ms", "Latency p50 (ms)"),
+    ("latency_p95_ms", "Latency p95 (ms)"),
+    ("latency_min_ms", "Latency min (ms)"),
+    ("cpu_ms", "CPU (ms, STATISTICS TIME)"),
+    ("server_elapsed_ms", "Server elapsed (ms)"),
+    ("logical_reads", "Logical reads"),
+    ("physical_reads", "Physical reads"),
+    ("dmv_cpu_ms", "CPU (ms, procedure stats)"),
+    ("rows", "Rows returned"),
+]
+
+
+def format_report(result):
+    from tabulate import tabulate
+
+    rows = []
+    for key, label in REPORT_METRICS:
+        before, after = result["original"][key], result["optimized"][key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else ""
+        rows.append([label, before, after, change])
+
+    header = (f"{result['sp_name']} vs {result['optimized_name']} - {result['mode']} cache, "
+              f"{result['original']['runs']} runs each, params {result['params'] or '(none)'}")
+    table = tabulate(rows, headers=["", "original", "optimized", "change"], floatfmt=".1f")
+    return "\n".join([header, table] + [f"⚠️ {w}" for w in result["warnings"]])
+
+
+def _parse_param(text):
+    name, sep, value = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected @name=value, got {text!r}")
+    return name.strip(), None if value.upper() == "NULL" else value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a stored procedure against its optimized copy")
+    parser.add_argument("sp_name", help="db.schema.name of the original procedure")
+    parser.add_argument("--optimized", help="name of the optimized copy (default: newest <name>_Opt_...)")
+    parser.add_argument("--param", action="append", type=_parse_param, default=[],
+                        help="@name=value, repeatable (NULL for null)")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--cold", action="store_true", help="empty the buffer pool before every run (sysadmin)")
+    args = parser.parse_args()
+
+    result = benchmark_sp(args.sp_name, dict(args.param), args.optimized, args.runs, args.cold)
+    print(format_report(result))
+
+
+if __name__ == "__main__":
+    main()
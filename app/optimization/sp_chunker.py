@@ -0,0 +1,352 @@
+"""
+Chunked optimisation of very large stored procedures.
+
+The body is split into statement blocks with a T-SQL statement splitter on top of the lexer
+(app.utils.sql_tokens), each block that contains DML is optimised on its own, concurrently,
+and the results are spliced back into the original text. Everything between blocks (procedure
+header, comments, DECLAREs, BEGIN / END of an enclosing block) is kept verbatim.
+
+A block prompt only contains the block, the declarations of the variables it uses and the
+tables it references, so an unchanged block produces the same prompt and is answered from the
+Gemini response cache instead of being resent.
+"""
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from app.optimization.plan_analyzer import block_plan_summary
+from app.optimization.sp_loader import format_table_info
+from app.optimization.sp_optimizer import optimize_sql_block
+from app.utils.sql_references import extract_references
+from app.utils.sql_tokens import iter_token_spans
+
+SP_CHUNK_TARGET_CHARS = int(os.getenv("SP_CHUNK_TARGET_CHARS", "6000"))   # preferred block size
+SP_CHUNK_WORKERS = int(os.getenv("SP_CHUNK_WORKERS", "4"))               # concurrent block prompts
+SP_CHUNK_AUTO_CHARS = int(os.getenv("SP_CHUNK_AUTO_CHARS", "60000"))      # longer SPs are chunked, 0 = only on request
+
+# start / end: character offsets into the SP text; optimize: block contains DML worth sending;
+# branch: the single statement of an IF / WHILE / ELSE written without BEGIN ... END
+SqlBlock = namedtuple("SqlBlock", "start end text optimize branch", defaults=(False,))
+
+_DML = {"SELECT", "INSERT", "UPDATE", "DELETE", "MERGE"}
+_STATEMENT_START = {
+    "DECLARE", "IF", "WHILE", "ELSE", "PRINT", "RETURN", "RAISERROR", "THROW", "TRUNCATE", "DROP",
+    "CREATE", "ALTER", "COMMIT", "ROLLBACK", "SAVE", "OPEN", "CLOSE", "FETCH", "DEALLOCATE", "GOTO",
+    "WAITFOR", "BREAK", "CONTINUE", "MERGE", "BEGIN", "EXEC", "EXECUTE", "SET", "WITH",
+} | _DML
+# BEGIN / END that do not open or close a block
+_NOT_BLOCK = {"TRAN", "TRANSACTION", "DISTRIBUTED", "DIALOG", "CONVERSATION"}
+# DROP TABLE IF EXISTS ...
+_OBJECT_TYPES = {
+    "TABLE", "VIEW", "PROCEDURE", "PROC", "FUNCTION", "INDEX", "SCHEMA", "TRIGGER", "SEQUENCE", "TYPE",
+    "SYNONYM", "STATISTICS",
+}
+
+
+def _upper(token):
+    return token.value.upper() if token.kind == "word" else None
+
+
+def _is_punct(token, value):
+    return token.kind == "punct" and token.value == value
+
+
+class _Splitter:
+    def __init__(self, sql_text):
+        self.sql_text = sql_text
+        self.spans = list(iter_token_spans(sql_text))
+        self.tokens = [span[0] for span in self.spans]
+        self.words = [_upper(token) for token in self.tokens]
+
+    def word(self, i):
+        return self.words[i] if 0 <= i < len(self.words) else None
+
+    def opens_block(self, i):
+        word = self.words[i]
+        return word == "CASE" or (word == "BEGIN" and self.word(i + 1) not in _NOT_BLOCK)
+
+    def closes_block(self, i):
+        return self.words[i] == "END" and self.word(i + 1) not in _NOT_BLOCK
+
+    def body_start(self):
+        """Index of the first body token after CREATE / ALTER PROCEDURE ... AS (0 for a bare batch)."""
+        proc = next((i for i, w in enumerate(self.words[:8]) if w in ("PROC", "PROCEDURE")), None)
+        if proc is None:
+            return 0
+        depth = 0
+        for i in range(proc + 1, len(self.tokens)):
+            if _is_punct(self.tokens[i], "("):
+                depth += 1
+            elif _is_punct(self.tokens[i], ")"):
+                depth -= 1
+            # "@p AS int" is a parameter; the body AS is followed by a statement
+            elif depth == 0 and self.words[i] == "AS" and (
+                    self.word(i + 1) in _STATEMENT_START or (i + 1 < len(self.tokens) and _is_punct(self.tokens[i + 1], ";"))):
+                return i + 1
+        return 0
+
+    def _starts_statement(self, i, head, state):
+        word, prev = self.words[i], self.word(i - 1)
+        if word not in _STATEMENT_START:
+            return False
+        if head == "MERGE":
+            return False          # MERGE must end with ";"
+        if word == "SELECT":
+            if _is_punct(self.tokens[i - 1], "(") or prev in ("UNION", "ALL", "EXCEPT", "INTERSECT", "FOR"):
+                return False
+            if head in ("INSERT", "WITH") and not state["source"]:
+                state["source"] = True
+                return False      # INSERT ... SELECT, WITH cte AS (...) SELECT
+            return True
+        if word in ("INSERT", "UPDATE", "DELETE", "MERGE"):
+            if prev in ("THEN", "FOR", "OF"):
+                return False      # MERGE ... THEN UPDATE, FOR UPDATE OF
+            if head == "WITH" and not state["source"]:
+                state["source"] = True
+                return False
+            return True
+        if word in ("EXEC", "EXECUTE"):
+            if head == "INSERT" and not state["source"]:
+                state["source"] = True
+                return False      # INSERT ... EXEC
+            return True
+        if word == "SET":
+            if head == "UPDATE" and not state["update_set"]:
+                state["update_set"] = True
+                return False
+            return prev != "UPDATE"
+        if word == "WITH":
+            # CTE: WITH name AS ( / WITH name (cols) AS; not table hints or EXEC ... WITH RECOMPILE
+            following = self.tokens[i + 1] if i + 1 < len(self.tokens) else None
+            return (following is not None and following.kind in ("word", "ident")
+                    and (self.word(i + 2) == "AS" or
+                         (i + 2 < len(self.tokens) and _is_punct(self.tokens[i + 2], "("))))
+        if word == "FETCH":
+            return prev not in ("ROWS", "ROW")    # OFFSET ... ROWS FETCH NEXT
+        if word == "IF":
+            return prev not in _OBJECT_TYPES       # DROP TABLE IF EXISTS
+        return True
+
+    def statements(self, lo, hi):
+        """Top-level statements in tokens[lo:hi] as (first, last + 1) token index pairs."""
+        statements = []
+        depth, start, head = 0, lo, None
+        state = {"source": False, "update_set": False}
+        after_semicolon = False
+
+        for i in range(lo, hi):
+            token = self.tokens[i]
+            if depth == 0 and i > start and (after_semicolon or self._starts_statement(i, head, state)):
+                statements.append((start, i))
+                start = i
+            if i == start:
+                head = self.words[i]
+                state = {"source": False, "update_set": False}
+            after_semicolon = False
+
+            if _is_punct(token, "("):
+                depth += 1
+            elif _is_punct(token, ")"):
+                depth = max(0, depth - 1)
+            elif self.opens_block(i):
+                depth += 1
+            elif self.closes_block(i):
+                depth = max(0, depth - 1)
+            elif _is_punct(token, ";") and depth == 0:
+                after_semicolon = True
+
+        if start < hi:
+            statements.append((start, hi))
+        return statements
+
+    def groups(self, lo, hi):
+        """Statements with IF / WHILE / ELSE headers joined to their bodies, BEGIN CATCH to its TRY."""
+        groups = []
+        glue_next = False
+        for first, end in self.statements(lo, hi):
+            word = self.words[first]
+            joins = word == "ELSE" or (word == "BEGIN" and self.word(first + 1) == "CATCH")
+            if groups and (glue_next or joins):
+                groups[-1] = (groups[-1][0], end)
+            else:
+                groups.append((first, end))
+            glue_next = word in ("IF", "WHILE", "ELSE")
+        return groups
+
+    def inner_blocks(self, lo, hi):
+        """(first, end) token ranges of the contents of each top-level BEGIN ... END in tokens[lo:hi]."""
+        ranges = []
+        depth, begin = 0, None
+        for i in range(lo, hi):
+            if self.opens_block(i):
+                if depth == 0 and self.words[i] == "BEGIN":
+                    begin = i + 2 if self.word(i + 1) in ("TRY", "CATCH") else i + 1
+                depth += 1
+            elif self.closes_block(i):
+                depth -= 1
+                if depth == 0 and begin is not None:
+                    ranges.append((begin, i))
+                    begin = None
+        return ranges
+
+    def char_size(self, first, end):
+        return self.spans[end - 1][2] - self.spans[first][1]
+
+    def has_dml(self, first, end):
+        return any(w in _DML for w in self.words[first:end])
+
+    def blocks(self, lo, hi, target_chars):
+        """
+        (first, end, branch) token ranges of the blocks to optimise in tokens[lo:hi], at most
+        ~target_chars each where possible; branch marks a lone statement under an IF / WHILE / ELSE.
+        """
+        ranges = []
+        current = None
+        for first, end in self.groups(lo, hi):
+            if self.char_size(first, end) > target_chars and self.inner_blocks(first, end):
+                # too big on its own: keep IF / WHILE / ELSE headers and BEGIN / END framing,
+                # split what is inside and send the other statements of the group on their own
+                if current:
+                    ranges.append(current)
+                    current = None
+                for part_first, part_end in self.statements(first, end):
+                    inner = self.inner_blocks(part_first, part_end)
+                    if self.words[part_first] == "BEGIN" and inner:
+                        for inner_lo, inner_hi in inner:
+                            if inner_lo < inner_hi:
+                                ranges.extend(self.blocks(inner_lo, inner_hi, target_chars))
+                    elif self.words[part_first] not in ("IF", "WHILE", "ELSE"):
+                        ranges.append((part_first, part_end, True))
+                continue
+            if current and self.char_size(current[0], end) <= target_chars:
+                current = (current[0], end, False)
+            else:
+                if current:
+                    ranges.append(current)
+                current = (first, end, False)
+        if current:
+            ranges.append(current)
+        return ranges
+
+
+def split_sp_blocks(sp_text, target_chars=None):
+    """
+    The SP body as SqlBlocks, in text order. Statements are never split; IF / WHILE / ELSE stay
+    with their bodies; a compound statement bigger than target_chars is split inside its BEGIN ... END
+    and its other statements (e.g. an IF branch without BEGIN) become blocks of their own.
+    Blocks without DML (DECLARE / SET / PRINT only) have optimize=False.
+    """
+    target_chars = target_chars or SP_CHUNK_TARGET_CHARS
+    splitter = _Splitter(sp_text)
+    if not splitter.tokens:
+        return []
+
+    blocks = []
+    for first, end, branch in splitter.blocks(splitter.body_start(), len(splitter.tokens), target_chars):
+        start, stop = splitter.spans[first][1], splitter.spans[end - 1][2]
+        blocks.append(SqlBlock(start, stop, sp_text[start:stop], splitter.has_dml(first, end), branch))
+    return blocks
+
+
+def keep_single_statement(optimized_text):
+    """
+    Text to splice in place of a branch block: a rewrite into several statements is wrapped in
+    BEGIN ... END so all of them stay under the IF / WHILE / ELSE.
+    """
+    splitter = _Splitter(optimized_text)
+    if len(splitter.statements(0, len(splitter.tokens))) <= 1:
+        return optimized_text
+    return f"BEGIN\n{optimized_text}\nEND"
+
+
+def collect_declarations(sp_text):
+    """
+    {"@var" (lowercase): "DECLARE @var <type> [= ...]"} for every variable declared in the SP,
+    plus "" -> the parameter list of the procedure header.
+    """
+    splitter = _Splitter(sp_text)
+    tokens, spans = splitter.tokens, splitter.spans
+    declarations = {}
+
+    body = splitter.body_start()
+    if body:
+        # CREATE PROCEDURE name @p int, ... AS
+        declarations[""] = sp_text[spans[0][1]:spans[body - 1][2]]
+
+    for i, word in enumerate(splitter.words):
+        if word != "DECLARE":
+            continue
+        j, n = i + 1, len(tokens)
+        while j < n and tokens[j].kind == "variable":
+            depth, k = 0, j + 1
+            while k < n:
+                if _is_punct(tokens[k], "("):
+                    depth += 1
+                elif _is_punct(tokens[k], ")"):
+                    depth -= 1
+                elif depth == 0 and (_is_punct(tokens[k], ",") or _is_punct(tokens[k], ";")
+                                     or splitter.words[k] in _STATEMENT_START):
+                    break
+                k += 1
+            declarations.setdefault(tokens[j].value.lower(), "DECLARE " + sp_text[spans[j][1]:spans[k - 1][2]])
+            if k < n and _is_punct(tokens[k], ","):
+                j = k + 1
+            else:
+                break
+    return declarations
+
+
+def block_declarations(block_text, declarations):
+    """Parameter list and the DECLAREs of the variables a block uses, in a stable order."""
+    used = {token.value.lower() for token, _, _ in iter_token_spans(block_text) if token.kind == "variable"}
+    lines = [declarations[""]] if "" in declarations else []
+    lines += [declarations[var] for var in sorted(used) if var in declarations and declarations[var] not in block_text]
+    return "\n".join(lines)
+
+
+def optimize_sp_in_blocks(sp_text, metadata, default_db, workers=None, plan=None):
+    """
+    Optimise the SP block by block and reassemble it. Blocks whose optimisation fails are kept
+    as they were. plan (plan_analyzer.get_plan_analysis) gives every block the cost summary of
+    its own statements. Returns (optimized_sql, stats).
+    """
+    blocks = split_sp_blocks(sp_text)
+    declarations = collect_declarations(sp_text)
+
+    def run(block):
+        tables = extract_references(block.text, default_db).tables
+        table_info = format_table_info(metadata, tables, default_db, block.text)
+        plan_summary = block_plan_summary(plan, block.text) if plan else None
+        return optimize_sql_block(block.text, block_declarations(block.text, declarations), table_info, plan_summary)
+
+    todo = [block for block in blocks if block.optimize]
+    with ThreadPoolExecutor(max_workers=max(1, workers or SP_CHUNK_WORKERS)) as executor:
+        futures = {block: executor.submit(run, block) for block in todo}
+
+    parts, pos, failed = [], 0, 0
+    for block in blocks:
+        optimized = block.text
+        if block.optimize:
+            try:
+                result = futures[block].result()
+            except Exception as e:
+                print(f"❌ Block at offset {block.start} failed: {e}")
+                result = None
+            if result:
+                optimized = keep_single_statement(result) if block.branch else result
+            else:
+                failed += 1
+        parts.append(sp_text[pos:block.start])
+        parts.append(optimized)
+        pos = block.end
+    parts.append(sp_text[pos:])
+
+    stats = {
+        "blocks": len(blocks),
+        "optimized_blocks": len(todo) - failed,
+        "failed_blocks": failed,
+        "largest_block_chars": max((len(b.text) for b in todo), default=0),
+    }
+    print(f"✅ Chunked optimization: {stats['optimized_blocks']}/{len(todo)} blocks optimized "
+          f"({len(blocks) - len(todo)} kept as is, largest {stats['largest_block_chars']} chars)")
+    return "".join(parts), stats
@@ -1,56 +1,10 @@
 import pyodbc
-import re
-
-def get_slow_sp(connection):
-    cursor = connection.cursor()
-
-    # This DMV is instance-wide, so we don't need to change databases
-    # We just filter to user databases and stored procs
-    query = """
-        SELECT 
-            DB_NAME(st.dbid) AS database_name,
-            OBJECT_NAME(st.objectid, st.dbid) AS object_name,
-            qs.total_worker_time / qs.execution_count AS avg_cpu_time,
-            qs.total_elapsed_time / qs.execution_count AS avg_elapsed_time,
-            qs.execution_count,
-            qs.total_elapsed_time,
-            qs.creation_time,
-            st.text AS sql_text
-        FROM sys.dm_exec_query_stats qs
-        CROSS APPLY sys.dm_exec_sql_text(qs.sql_handle) st
-        WHERE st.objectid IS NOT NULL
-        AND OBJECT_NAME(st.objectid, st.dbid) IS NOT NULL
-        AND DB_NAME(st.dbid) NOT IN ('master', 'msdb', 'tempdb', 'model')
-        ORDER BY avg_elapsed_time DESC
-    """
-
-    cursor.execute(query)
-    results = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in results]
-
-
-# def get_slow_sp(connection):
-#     cursor = connection.cursor()
-#     cursor.execute("""
-#         SELECT TOP 50 
-#             DB_NAME(st.dbid) AS database_name,
-#             OBJECT_NAME(st.objectid, st.dbid) AS object_name,
-#             qs.total_worker_time / qs.execution_count AS avg_cpu_time,
-#             qs.total_elapsed_time / qs.execution_count AS avg_elapsed_time,
-#             qs.execution_count,
-#             qs.total_elapsed_time,
-#             qs.creation_time,
-#             st.text AS sql_text
-#         FROM sys.dm_exec_query_stats qs
-#         CROSS APPLY sys.dm_exec_sql_text(qs.sql_handle) st
-#         WHERE st.objectid IS NOT NULL
-#         ORDER BY avg_elapsed_time DESC
-#     """)
-#     results = cursor.fetchall()
-#     columns = [desc[0] for desc in cursor.description]
-#     return [dict(zip(columns, row)) for row in results]
 
+from app.catalog_collector import collect, quote_name
+from app.utils.sql_tokens import get_sp_tokens
+from app.utils.sql_references import extract_references
+from app.optimization.prompt_budget import build_table_context, prompt_metrics
+from app.optimization.metadata_cache import IndexColumn, TableMetadata, cache_key, metadata_cache
 
 def get_all_databases(connection):
     cursor = connection.cursor()
@@ -76,42 +30,40 @@ def get_sp_definition(connection, db_name, schema, name):
         return None
 
 
-def get_stored_procedures_all_databases(connection):
-    cursor = connection.cursor()
+STORED_PROCEDURES_PER_DB_SQL = """
+    SELECT
+        {db_name} AS database_name,
+        s.name AS schema_name,
+        o.name,
+        m.definition,
+        CAST(CASE WHEN m.definition IS NULL THEN 1 ELSE 0 END AS bit) AS is_encrypted
+    FROM {db}.sys.objects o
+    INNER JOIN {db}.sys.schemas s ON o.schema_id = s.schema_id
+    LEFT JOIN {db}.sys.sql_modules m ON o.object_id = m.object_id
+    WHERE o.type = 'P'
+"""
 
-    # Step 1: Get all user databases
-    cursor.execute("""
-        SELECT name
-        FROM sys.databases
-        WHERE name NOT IN ('master','model','msdb','tempdb')
-    """)
-    db_list = [row.name for row in cursor.fetchall()]
-
-    all_procs = []
-
-    # Step 2: Loop through each DB and collect stored procedures
-    for db in db_list:
-        cursor.execute(f"USE [{db}];")
-        cursor.execute("""
-            SELECT 
-                SCHEMA_NAME(schema_id) AS schema_name,
-                name,
-                OBJECT_DEFINITION(object_id) AS definition,
-                OBJECTPROPERTY(object_id, 'IsEncrypted') AS is_encrypted
-            FROM sys.objects
-            WHERE type = 'P'
-        """)
-        for row in cursor.fetchall():
-            all_procs.append({
-                "database": db,
-                "schema": row.schema_name,
-                "name": row.name,
-                "definition": row.definition,
-                "is_encrypted": row.is_encrypted,
-                "full_name": f"{db}.{row.schema_name}.{row.name}"
-            })
-
-    return all_procs
+
+def get_stored_procedures_all_databases(connection, databases=None):
+    # One UNION ALL over every user database (or only `databases`) instead of USE [db] per database.
+    # sys.sql_modules.definition is NULL for encrypted procedures.
+    data = collect(
+        connection,
+        STORED_PROCEDURES_PER_DB_SQL,
+        databases=databases,
+        columns=("database_name", "schema_name", "name", "definition", "is_encrypted"),
+    )
+
+    return [{
+        "database": db,
+        "schema": schema,
+        "name": name,
+        "definition": definition,
+        "is_encrypted": is_encrypted,
+        "full_name": f"{db}.{schema}.{name}"
+    } for db, schema, name, definition, is_encrypted in zip(
+        data["database_name"], data["schema_name"], data["name"], data["definition"], data["is_encrypted"]
+    )]
 
 
 def get_stored_procedures(connection, database):
@@ -148,36 +100,29 @@ def get_tables(connection, database):
         'database': database
     } for row in cursor.fetchall()]
 
-def get_table_columns(connection, db_name, schema, table, sp_text=None):
-    with connection.cursor() as cursor:
-        cursor.execute(f"USE {db_name};")
-        cursor.execute("""
-            SELECT COLUMN_NAME, DATA_TYPE
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?
-            ORDER BY ORDINAL_POSITION
-        """, (schema, table))
-        all_columns = cursor.fetchall()
-
-        used_cols = []
-        for col, dtype in all_columns:
-            # cari pola "table.col" atau langsung "col"
-            pattern1 = rf"\b{table}\s*\.\s*{col}\b"
-            pattern2 = rf"\b{col}\b"
-            if re.search(pattern1, sp_text, re.IGNORECASE) or re.search(pattern2, sp_text, re.IGNORECASE):
-                used_cols.append(f"{col} ({dtype})")
-
-        # fallback: kalau tidak ketemu sama sekali, pakai semua
-        if not used_cols:
-            used_cols = [f"{col} ({dtype})" for col, dtype in all_columns]
 
-        return used_cols
+# Cheap change check: table DDL bumps modify_date, index DDL changes the checksums
+TABLE_VERSION_SQL = """
+    SELECT
+        o.modify_date,
+        (SELECT CHECKSUM_AGG(CHECKSUM(i.index_id, i.name, i.type, i.is_disabled))
+           FROM {db}.sys.indexes i WHERE i.object_id = o.object_id) AS index_checksum,
+        (SELECT CHECKSUM_AGG(CHECKSUM(ic.index_id, ic.column_id, ic.key_ordinal, ic.is_included_column))
+           FROM {db}.sys.index_columns ic WHERE ic.object_id = o.object_id) AS index_column_checksum
+    FROM {db}.sys.objects o
+    INNER JOIN {db}.sys.schemas s ON o.schema_id = s.schema_id
+    WHERE s.name = ? AND o.name = ?;
+"""
 
-        # return [f"{row[0]} ({row[1]})" for row in cursor.fetchall()]
+TABLE_COLUMNS_SQL = """
+    SELECT COLUMN_NAME, DATA_TYPE
+    FROM {db}.INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?
+    ORDER BY ORDINAL_POSITION;
+"""
 
-def get_table_indexes(connection, db, schema, table):
-    sql = f"""
-    SELECT 
+TABLE_INDEXES_SQL = """
+    SELECT
         ind.name AS index_name,
         ind.type_desc AS index_type,
         col.name AS column_name,
@@ -187,13 +132,240 @@ def get_table_indexes(connection, db, schema, table):
         ON ind.object_id = ic.object_id AND ind.index_id = ic.index_id
     JOIN {db}.sys.columns col
         ON ic.object_id = col.object_id AND ic.column_id = col.column_id
-    WHERE ind.object_id = OBJECT_ID('{db}.{schema}.{table}')
+    JOIN {db}.sys.objects o ON ind.object_id = o.object_id
+    JOIN {db}.sys.schemas s ON o.schema_id = s.schema_id
+    WHERE s.name = ? AND o.name = ?
     ORDER BY ind.name, ic.key_ordinal;
+"""
+
+# Version, columns and indexes in a single batch (three result sets)
+TABLE_METADATA_SQL = TABLE_VERSION_SQL + TABLE_COLUMNS_SQL + TABLE_INDEXES_SQL
+
+
+def _fetch_table_version(cursor, db, schema, table):
+    cursor.execute(TABLE_VERSION_SQL.format(db=quote_name(db)), (schema, table))
+    row = cursor.fetchone()
+    return tuple(row) if row else None
+
+
+def get_table_metadata(connection, db, schema, table):
     """
+    Columns + index definitions for one table, served from the process-wide metadata cache.
+    Within the TTL no query is sent; after it, only the version check runs unless the table changed.
+    """
+    key = cache_key(db, schema, table)
+    cached, fresh = metadata_cache.lookup(key)
+    if cached is not None and fresh:
+        return cached
+
+    with connection.cursor() as cursor:
+        if cached is not None:
+            if _fetch_table_version(cursor, db, schema, table) == cached.version:
+                metadata_cache.revalidate(key)
+                return cached
+
+        # Version, columns and indexes in a single round-trip
+        cursor.execute(TABLE_METADATA_SQL.format(db=quote_name(db)), (schema, table) * 3)
+        row = cursor.fetchone()
+        version = tuple(row) if row else None
+        cursor.nextset()
+        columns = [(col, dtype) for col, dtype in cursor.fetchall()]
+        cursor.nextset()
+        indexes = [IndexColumn(*r) for r in cursor.fetchall()]
+
+    metadata = TableMetadata(version, columns, indexes)
+    metadata_cache.store(key, metadata)
+    return metadata
+
+
+def filter_used_columns(all_columns, table, sp_text):
+    used_cols = []
+    if sp_text:
+        # Tokenized once per SP text (cached), so each column is a set lookup
+        tokens = get_sp_tokens(sp_text)
+        aliases = extract_references(sp_text).aliases
+        short = table.split(".")[-1].lower()
+        # "alias.col" only counts for this table when the alias is bound to it (or to nothing we know)
+        own = {alias for alias, full in aliases.items() if full.split(".")[-1].lower() == short} | {short}
+        qualifiers = {}
+        for left, right in tokens.qualified:
+            qualifiers.setdefault(right, set()).add(left)
+
+        for col, dtype in all_columns:
+            lowered = col.lower()
+            # "table.col" atau langsung "col"
+            if lowered in tokens.bare or any(q in own or q not in aliases for q in qualifiers.get(lowered, ())):
+                used_cols.append(f"{col} ({dtype})")
+
+    # fallback: kalau tidak ketemu sama sekali, pakai semua
+    if not used_cols:
+        used_cols = [f"{col} ({dtype})" for col, dtype in all_columns]
+
+    return used_cols
+
+
+def get_table_columns(connection, db_name, schema, table, sp_text=None):
+    all_columns = get_table_metadata(connection, db_name, schema, table).columns
+    return filter_used_columns(all_columns, table, sp_text)
+
+
+def get_table_indexes(connection, db, schema, table):
+    return get_table_metadata(connection, db, schema, table).indexes
+
+
+# INSERT ... VALUES takes at most 1000 rows, and 2 parameters per table stays under the 2100 limit
+BULK_METADATA_CHUNK = 1000
+
+BULK_METADATA_SQL = """
+    SET NOCOUNT ON;
+    DECLARE @t TABLE (schema_name sysname NOT NULL, table_name sysname NOT NULL);
+    INSERT INTO @t (schema_name, table_name) VALUES {values};
+
+    SELECT
+        s.name AS schema_name,
+        o.name AS table_name,
+        o.modify_date,
+        (SELECT CHECKSUM_AGG(CHECKSUM(i.index_id, i.name, i.type, i.is_disabled))
+           FROM {db}.sys.indexes i WHERE i.object_id = o.object_id) AS index_checksum,
+        (SELECT CHECKSUM_AGG(CHECKSUM(ic.index_id, ic.column_id, ic.key_ordinal, ic.is_included_column))
+           FROM {db}.sys.index_columns ic WHERE ic.object_id = o.object_id) AS index_column_checksum
+    FROM @t t
+    INNER JOIN {db}.sys.schemas s ON s.name = t.schema_name COLLATE DATABASE_DEFAULT
+    INNER JOIN {db}.sys.objects o ON o.schema_id = s.schema_id AND o.name = t.table_name COLLATE DATABASE_DEFAULT;
+
+    SELECT c.TABLE_SCHEMA, c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE
+    FROM {db}.INFORMATION_SCHEMA.COLUMNS c
+    INNER JOIN @t t
+        ON c.TABLE_SCHEMA = t.schema_name COLLATE DATABASE_DEFAULT
+        AND c.TABLE_NAME = t.table_name COLLATE DATABASE_DEFAULT
+    ORDER BY c.TABLE_SCHEMA, c.TABLE_NAME, c.ORDINAL_POSITION;
+
+    SELECT
+        s.name AS schema_name,
+        o.name AS table_name,
+        ind.name AS index_name,
+        ind.type_desc AS index_type,
+        col.name AS column_name,
+        ic.is_included_column
+    FROM @t t
+    INNER JOIN {db}.sys.schemas s ON s.name = t.schema_name COLLATE DATABASE_DEFAULT
+    INNER JOIN {db}.sys.objects o ON o.schema_id = s.schema_id AND o.name = t.table_name COLLATE DATABASE_DEFAULT
+    INNER JOIN {db}.sys.indexes ind ON ind.object_id = o.object_id
+    INNER JOIN {db}.sys.index_columns ic
+        ON ind.object_id = ic.object_id AND ind.index_id = ic.index_id
+    INNER JOIN {db}.sys.columns col
+        ON ic.object_id = col.object_id AND ic.column_id = col.column_id
+    ORDER BY s.name, o.name, ind.name, ic.key_ordinal;
+"""
+
+
+def _split_table_name(full_name, default_db=None):
+    parts = [p for p in full_name.replace("[", "").replace("]", "").split(".") if p]
+    if len(parts) == 3:
+        return tuple(parts)
+    if len(parts) == 2 and default_db:
+        # assume current database if DB not specified
+        return (default_db, parts[0], parts[1])
+    return None  # skip if can't parse
+
+
+def _fetch_tables_metadata(connection, db, tables):
+    """tables: list of (schema, table). One batch (one round-trip) per chunk of tables."""
+    found = {}
     with connection.cursor() as cursor:
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-    return rows
+        for i in range(0, len(tables), BULK_METADATA_CHUNK):
+            chunk = tables[i:i + BULK_METADATA_CHUNK]
+            sql = BULK_METADATA_SQL.format(db=quote_name(db), values=", ".join(["(?, ?)"] * len(chunk)))
+            params = [value for pair in chunk for value in pair]
+            cursor.execute(sql, params)
+
+            versions = {}
+            for schema, table, *version in cursor.fetchall():
+                versions[cache_key(db, schema, table)] = tuple(version)
+            cursor.nextset()
+
+            columns = {}
+            for schema, table, col, dtype in cursor.fetchall():
+                columns.setdefault(cache_key(db, schema, table), []).append((col, dtype))
+            cursor.nextset()
+
+            indexes = {}
+            for schema, table, *idx in cursor.fetchall():
+                indexes.setdefault(cache_key(db, schema, table), []).append(IndexColumn(*idx))
+
+            for schema, table in chunk:
+                key = cache_key(db, schema, table)
+                found[key] = TableMetadata(versions.get(key), columns.get(key, []), indexes.get(key, []))
+    return found
+
+
+def get_tables_metadata(connection, table_names, default_db=None):
+    """
+    Bulk version of get_table_metadata for every table an SP references.
+    Returns {"db.schema.table": TableMetadata}; tables are grouped by database and everything
+    not fresh in the cache is fetched with one parameterised batch per database.
+    """
+    result = {}
+    pending = {}   # db -> [(full_name, schema, table, cached)]
+
+    for full_name in dict.fromkeys(table_names):
+        parsed = _split_table_name(full_name, default_db)
+        if not parsed:
+            continue
+        db, schema, table = parsed
+        name = f"{db}.{schema}.{table}"
+
+        cached, fresh = metadata_cache.lookup(cache_key(db, schema, table))
+        if cached is not None and fresh:
+            result[name] = cached
+        else:
+            pending.setdefault(db, []).append((name, schema, table, cached))
+
+    for db, items in pending.items():
+        try:
+            fetched = _fetch_tables_metadata(connection, db, [(schema, table) for _, schema, table, _ in items])
+        except Exception as e:
+            print(f"[WARN] Could not load metadata for tables in {db}: {e}")
+            continue
+        for name, schema, table, cached in items:
+            key = cache_key(db, schema, table)
+            metadata = fetched[key]
+            if cached is not None and cached.version == metadata.version:
+                metadata_cache.revalidate(key)
+                metadata = cached
+            else:
+                metadata_cache.store(key, metadata)
+            result[name] = metadata
+
+    return result
+
+
+def build_table_info(connection, table_names, default_db, sp_text=None):
+    """
+    Prompt context for the tables an SP touches: one line per table with the used columns
+    and existing indexes, e.g. "Sales.dbo.Orders (OrderID (int), ...) | Indexes: ...".
+    """
+    metadata = get_tables_metadata(connection, table_names, default_db)
+    return format_table_info(metadata, default_db=default_db, sp_text=sp_text)
+
+
+def format_table_info(metadata, table_names=None, default_db=None, sp_text=None):
+    """
+    build_table_info from already fetched metadata ({"db.schema.table": TableMetadata}).
+    With table_names only those tables are included, so one get_tables_metadata call
+    can serve many SPs (see batch_optimize.py). Kept within PROMPT_TOKEN_BUDGET, see prompt_budget.
+    """
+    if table_names is not None:
+        wanted = (_split_table_name(name, default_db) for name in table_names)
+        names = dict.fromkeys(".".join(parsed) for parsed in wanted if parsed)
+        metadata = {name: metadata[name] for name in names if name in metadata}
+
+    text, stats = build_table_context(metadata, sp_text, default_db)
+    prompt_metrics.record_context(stats)
+    if stats["truncated"]:
+        print(f"[INFO] Table context shortened to ~{stats['tokens']} tokens "
+              f"({stats['dropped_tables']} of {stats['tables']} tables dropped)")
+    return text
 
 
 def build_detailed_table_info(connection, db_name, tables):
@@ -2,7 +2,8 @@ import os
 import requests
 import re
 from dotenv import load_dotenv
-from app.gemini_client import ask_gemini
+from app.gemini_client import ask_gemini, ask_gemini_stream
+from app.optimization.prompt_budget import prompt_metrics
 
 load_dotenv(override=True)
 
@@ -29,10 +30,24 @@ def sanitize_sql(generated_sql):
 
     return cleaned_text
 
-def optimize_stored_procedure(sp_text, table_info_text=None):
+def build_optimize_prompt(sp_text, table_info_text=None, plan_summary=None):
     if table_info_text is None:
         table_info_text = "(tidak ada metadata tabel)"
-    
+
+    # Cost summary of the cached execution plan (see plan_analyzer), when the SP has one
+    plan_section = ""
+    if plan_summary:
+        plan_section = f"""
+3. Where the cost is in the cached execution plan (SQL Server estimates):
+
+=== BEGIN PLAN SUMMARY ===
+{plan_summary}
+=== END PLAN SUMMARY ===
+
+Focus the rewrite on the statements and operators with the highest share of the cost (scans, key lookups, spills,
+implicit conversions). Missing index suggestions are for context only.
+"""
+
     prompt = f"""
 You are a SQL Server expert. Your task is to **rewrite and optimize** the following stored procedure for performance and clarity.
 
@@ -48,7 +63,7 @@ You are a SQL Server expert. Your task is to **rewrite and optimize** the follow
 === BEGIN TABLE INFO ===
 {table_info_text}
 === END TABLE INFO ===
-
+{plan_section}
 
 **Optimization rules:**
 - **Keep output identical**: Result set, logic, and schema (table names, column names, and structure) must not change.
@@ -212,7 +227,12 @@ You are a SQL Server expert. Your task is to **rewrite and optimize** the follow
 # === END SP_OPTIMIZED ===
 # """
 
+    prompt_metrics.record("optimize_sp", prompt)
+    return prompt
+
 
+def optimize_stored_procedure(sp_text, table_info_text=None, plan_summary=None):
+    prompt = build_optimize_prompt(sp_text, table_info_text, plan_summary)
 
     # headers = {
     #     "Content-Type": "application/json"
@@ -254,3 +274,169 @@ You are a SQL Server expert. Your task is to **rewrite and optimize** the follow
         print(f"❌ Other error from Gemini: {e}")
     
     return None
+
+
+def optimize_stored_procedure_stream(sp_text, table_info_text=None, plan_summary=None):
+    """Same prompt as optimize_stored_procedure, yielding the raw model output as it is generated."""
+    return ask_gemini_stream(build_optimize_prompt(sp_text, table_info_text, plan_summary))
+
+
+BLOCK_START_MARKER = "=== BLOCK_OPTIMIZED ==="
+BLOCK_END_MARKER = "=== END BLOCK_OPTIMIZED ==="
+
+
+def build_block_prompt(block_text, declarations_text=None, table_info_text=None, plan_summary=None):
+    """Prompt for one statement block of a large SP (see app.optimization.sp_chunker)."""
+    # the block's part of the cached plan (plan_analyzer.block_plan_summary), when there is one
+    plan_section = ""
+    if plan_summary:
+        plan_section = f"""
+4. Where the cost of this fragment is in the cached execution plan (SQL Server estimates):
+
+=== BEGIN PLAN SUMMARY ===
+{plan_summary}
+=== END PLAN SUMMARY ===
+
+Focus the rewrite on the statements and operators with the highest share of the cost.
+"""
+
+    prompt = f"""
+You are a SQL Server expert. Your task is to **rewrite and optimize** one fragment of a large stored procedure for performance.
+The fragment is spliced back into the procedure in place of the original, so it must stay a drop-in replacement.
+
+**Input:**
+1. Procedure parameters and the declarations of the variables used by the fragment (context only, do not output):
+
+=== BEGIN DECLARATIONS ===
+{declarations_text or "(none)"}
+=== END DECLARATIONS ===
+
+2. Fragment to optimize:
+
+=== BEGIN BLOCK ===
+{block_text}
+=== END BLOCK ===
+
+3. Related tables (columns + existing indexes):
+
+=== BEGIN TABLE INFO ===
+{table_info_text or "(tidak ada metadata tabel)"}
+=== END TABLE INFO ===
+{plan_section}
+
+**Optimization rules:**
+- **Keep output identical**: Result sets, row counts, variable values, temp table contents and logic must not change.
+- Output only the rewritten fragment: no CREATE PROCEDURE, no declarations from the context, no code from outside the fragment.
+- Keep every variable, temp table, table variable, cursor and label the fragment defines or uses, with the same names.
+- Keep BEGIN / END, TRY / CATCH and transaction statements balanced exactly as in the fragment.
+- **Allowed optimizations** (only if they improve performance without changing output):
+  - Replace `NOT IN` / `NOT EXISTS` with `LEFT JOIN` filtering if faster.
+  - Convert correlated subqueries to joins.
+  - Reorder joins and filters for better performance.
+  - Flatten nested queries where beneficial.
+- Replace all `SELECT *` with **explicit column lists** based on provided table metadata.
+- Do **not**:
+  - Add, remove, or suggest indexes.
+  - Change database, schema, table or column references.
+  - Modify or remove any existing comments.
+  - Change the `UNION` / `UNION ALL` usage — keep exactly as in the original. This is a hard constraint.
+  - Add explanations or reasoning — output only the final code.
+- Only use T-SQL syntax supported by **SQL Server Standard Edition** (no `GREATEST()`, `LEAST()`, `LIMIT`, `:=`).
+
+**Output format (strict)**:
+
+{BLOCK_START_MARKER}
+(optimized fragment here)
+{BLOCK_END_MARKER}
+
+    """
+    prompt_metrics.record("optimize_block", prompt)
+    return prompt
+
+
+def optimize_sql_block(block_text, declarations_text=None, table_info_text=None, plan_summary=None):
+    """Optimized text of one SP block, or None when the AI gave no usable answer."""
+    def complete(text):
+        return BLOCK_START_MARKER in text and BLOCK_END_MARKER in text.split(BLOCK_START_MARKER, 1)[1]
+
+    try:
+        response = ask_gemini(build_block_prompt(block_text, declarations_text, table_info_text, plan_summary),
+                              cache_if=complete)
+    except Exception as e:
+        print(f"❌ Other error from Gemini: {e}")
+        return None
+    if not response or not complete(response):
+        return None  # no answer, or cut off before the end marker: never splice half a statement
+
+    text = response.split(BLOCK_START_MARKER, 1)[1].split(BLOCK_END_MARKER, 1)[0]
+    text = text.replace("```sql", "").replace("```", "").strip()
+    create_proc = re.compile(r"\bCREATE\s+PROC", re.IGNORECASE)
+    if not text or (create_proc.search(text) and not create_proc.search(block_text)):
+        return None  # model returned a whole procedure instead of the fragment
+    return text
+
+
+SP_START_MARKER = "=== SP_OPTIMIZED ==="
+SP_END_MARKER = "=== END SP_OPTIMIZED ==="
+
+
+class OptimizedSqlStream:
+    """
+    Incremental parser for the "=== SP_OPTIMIZED === ... === END SP_OPTIMIZED ===" block.
+    feed(chunk) returns the part of the optimized SQL that became known with this chunk;
+    a marker split across chunks is held back until it can be recognised.
+    """
+
+    def __init__(self):
+        self.raw = []          # everything received, for the final clean-up
+        self._pending = ""     # text not yet classified
+        self._state = "before"  # before -> start (rest of marker line) -> inside -> after
+
+    def feed(self, chunk):
+        self.raw.append(chunk)
+        self._pending += chunk
+        out = []
+
+        while True:
+            if self._state == "before":
+                pos = self._pending.find(SP_START_MARKER)
+                if pos < 0:
+                    # keep a tail that could be the start of the marker
+                    self._pending = self._pending[-(len(SP_START_MARKER) - 1):]
+                    break
+                self._pending = self._pending[pos + len(SP_START_MARKER):]
+                self._state = "start"
+            elif self._state == "start":
+                # drop the rest of the marker line, which may arrive in a later chunk
+                stripped = self._pending.lstrip(" \t\r")
+                if not stripped:
+                    self._pending = ""
+                    break
+                self._pending = stripped[1:] if stripped.startswith("\n") else stripped
+                self._state = "inside"
+            elif self._state == "inside":
+                pos = self._pending.find(SP_END_MARKER)
+                if pos >= 0:
+                    out.append(self._pending[:pos])
+                    self._pending = ""
+                    self._state = "after"
+                    break
+                safe = len(self._pending) - (len(SP_END_MARKER) - 1)
+                if safe > 0:
+                    out.append(self._pending[:safe])
+                    self._pending = self._pending[safe:]
+                break
+            else:
+                self._pending = ""
+                break
+
+        return "".join(out)
+
+    def text(self):
+        return "".join(self.raw)
+
+    def finish(self):
+        """Leftover SQL if the END marker never came (truncated output)."""
+        rest = self._pending if self._state == "inside" else ""
+        self._pending = ""
+        return rest
@@ -0,0 +1,218 @@
+"""
+Checks that an optimized procedure returns the same result sets as the original.
+
+Both procedures run with the same parameters, each in its own transaction that is rolled
+back. Rows are streamed with fetchmany and folded into order-insensitive digests, so memory
+does not grow with the size of the result:
+  - row count
+  - result set hash: sum mod 2^64 of the blake2b digest of every row (a multiset hash, so
+    ORDER BY differences are ignored but duplicated or missing rows are not)
+  - one checksum per column, built the same way, to point at the columns that differ
+The optimized SQL can also be checked before it is saved: it is created under a temporary
+_Opt_ name inside the transaction and disappears with the rollback.
+
+Procedures that use GETDATE(), NEWID() or unordered TOP return different data on every
+run and will be reported as different.
+
+    python -m app.optimization.sp_verifier Sales.dbo.uspGetOrders --param @CustomerID=42
+"""
+import argparse
+import datetime
+import decimal
+import hashlib
+import struct
+import uuid
+
+from app.catalog_collector import quote_name
+from app.db_connector import get_connection
+from app.optimization.sp_benchmark import (
+    BENCHMARK_FETCH_SIZE, _parse_param, build_exec_sql, find_optimized_variant, get_sp_parameters
+)
+from app.optimization.sp_saver import rename_sp_name
+
+_MASK = (1 << 64) - 1
+
+
+def _encode_value(value):
+    """Type-tagged, length-prefixed bytes of one value; 1 and 1.00 (int / DECIMAL) encode alike."""
+    if value is None:
+        return b"N"
+    if isinstance(value, bool):
+        tag, data = b"b", b"1" if value else b"0"
+    elif isinstance(value, (int, decimal.Decimal)):
+        number = decimal.Decimal(value)
+        tag, data = b"n", (str(number.normalize()) if number else "0").encode()
+    elif isinstance(value, float):
+        tag, data = b"f", repr(value).encode()
+    elif isinstance(value, str):
+        tag, data = b"s", value.encode("utf-8")
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        tag, data = b"x", bytes(value)
+    elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        tag, data = b"d", value.isoformat().encode()
+    elif isinstance(value, uuid.UUID):
+        tag, data = b"u", str(value).upper().encode()
+    else:
+        tag, data = b"?", str(value).encode("utf-8")
+    return tag + struct.pack(">I", len(data)) + data
+
+
+def _hash64(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+class _ResultSetDigest:
+    """Order-insensitive digest of one result set, fed batch by batch."""
+
+    def __init__(self, description):
+        self.columns = [(column[0], getattr(column[1], "__name__", str(column[1]))) for column in description]
+        self.rows = 0
+        self.row_hash = 0
+        self.column_hashes = [0] * len(self.columns)
+
+    def update(self, batch):
+        column_hashes = self.column_hashes
+        for row in batch:
+            encoded = [_encode_value(value) for value in row]
+            self.row_hash = (self.row_hash + _hash64(b"".join(encoded))) & _MASK
+            for i, data in enumerate(encoded):
+                column_hashes[i] = (column_hashes[i] + _hash64(data)) & _MASK
+        self.rows += len(batch)
+
+    def result(self):
+        return {
+            "columns": [name for name, _ in self.columns],
+            "types": [type_name for _, type_name in self.columns],
+            "rows": self.rows,
+            "hash": f"{self.row_hash:016x}",
+            "column_checksums": [f"{h:016x}" for h in self.column_hashes],
+        }
+
+
+def digest_result_sets(cursor, fetch_size=BENCHMARK_FETCH_SIZE):
+    """Digests of every result set left on an executed cursor, in order."""
+    digests = []
+    while True:
+        if cursor.description:
+            digest = _ResultSetDigest(cursor.description)
+            while True:
+                batch = cursor.fetchmany(fetch_size)
+                if not batch:
+                    break
+                digest.update(batch)
+            digests.append(digest.result())
+        if not cursor.nextset():
+            break
+    return digests
+
+
+def _run_and_digest(connection, database_name, exec_sql, values, create_sql=None):
+    """Execute (after creating the temporary procedure when create_sql is given), digest, roll back."""
+    cursor = connection.cursor()
+    try:
+        if create_sql:
+            cursor.execute(f"USE {quote_name(database_name)};")
+            cursor.execute(create_sql)
+        cursor.execute(exec_sql, values)
+        return digest_result_sets(cursor)
+    finally:
+        connection.rollback()
+
+
+def compare_digests(original, optimized):
+    """List of differences between two digest_result_sets() results; empty when equivalent."""
+    differences = []
+    if len(original) != len(optimized):
+        differences.append(f"Number of result sets differs: {len(original)} vs {len(optimized)}")
+
+    for index, (before, after) in enumerate(zip(original, optimized), start=1):
+        label = f"Result set {index}"
+        if len(before["columns"]) != len(after["columns"]):
+            differences.append(f"{label}: {len(before['columns'])} vs {len(after['columns'])} columns")
+            continue
+        if before["rows"] != after["rows"]:
+            differences.append(f"{label}: {before['rows']:,} vs {after['rows']:,} rows")
+        if before["hash"] != after["hash"]:
+            columns = [
+                before["columns"][i] or f"#{i + 1}"
+                for i, (a, b) in enumerate(zip(before["column_checksums"], after["column_checksums"])) if a != b
+            ]
+            detail = f" (columns: {', '.join(columns)})" if columns else " (same column values, combined differently)"
+            differences.append(f"{label}: row contents differ{detail}")
+    return differences
+
+
+def verify_equivalence(sp_name, params=None, optimized_name=None, optimized_sql=None):
+    """
+    Compare "db.schema.name" with its optimized copy: optimized_sql (a CREATE PROCEDURE that is
+    not saved yet), optimized_name, or the newest <name>_Opt_... procedure.
+    """
+    parts = (sp_name or "").split(".")
+    if len(parts) != 3 or not all(parts):
+        raise ValueError("Invalid SP name, expected db.schema.name")
+    database_name, schema, name = parts
+
+    create_sql = None
+    with get_connection() as connection:
+        if optimized_sql:
+            create_sql, optimized_name = rename_sp_name(optimized_sql)
+        else:
+            optimized_name = optimized_name or find_optimized_variant(connection, database_name, schema, name)
+            if not optimized_name:
+                raise LookupError(f"No optimized copy ({name}_Opt_...) of {sp_name} found; save one first")
+
+        exec_sql, values = build_exec_sql(
+            database_name, schema, name, params, get_sp_parameters(connection, database_name, schema, name)
+        )
+        original = _run_and_digest(connection, database_name, exec_sql, values)
+
+        if create_sql:
+            # parameters of the unsaved procedure cannot be looked up, the original's are checked above
+            known = None
+        else:
+            known = get_sp_parameters(connection, database_name, schema, optimized_name)
+        exec_sql, values = build_exec_sql(database_name, schema, optimized_name, params, known)
+        optimized = _run_and_digest(connection, database_name, exec_sql, values, create_sql)
+
+    differences = compare_digests(original, optimized)
+    warnings = []
+    for index, (before, after) in enumerate(zip(original, optimized), start=1):
+        if len(before["columns"]) != len(after["columns"]):
+            continue
+        if before["columns"] != after["columns"]:
+            warnings.append(f"Result set {index}: column names differ: {before['columns']} vs {after['columns']}")
+        if before["types"] != after["types"]:
+            warnings.append(f"Result set {index}: column types differ: {before['types']} vs {after['types']}")
+
+    return {
+        "sp_name": sp_name,
+        "optimized_name": f"{database_name}.{schema}.{optimized_name}" + (" (unsaved)" if create_sql else ""),
+        "params": params or {},
+        "verdict": "different" if differences else "equivalent",
+        "differences": differences,
+        "warnings": warnings,
+        "original": original,
+        "optimized": optimized,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that an optimized procedure returns the same results")
+    parser.add_argument("sp_name", help="db.schema.name of the original procedure")
+    parser.add_argument("--optimized", help="name of the optimized copy (default: newest <name>_Opt_...)")
+    parser.add_argument("--param", action="append", type=_parse_param, default=[],
+                        help="@name=value, repeatable (NULL for null)")
+    args = parser.parse_args()
+
+    result = verify_equivalence(args.sp_name, dict(args.param), args.optimized)
+    print(f"{result['sp_name']} vs {result['optimized_name']}: {result['verdict'].upper()}")
+    for index, digest in enumerate(result["original"], start=1):
+        print(f"  result set {index}: {digest['rows']:,} rows, {len(digest['columns'])} columns, hash {digest['hash']}")
+    for line in result["differences"]:
+        print(f"❌ {line}")
+    for line in result["warnings"]:
+        print(f"⚠️ {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+from app.db_connector import get_connection
+from app.indexing.index_ai import get_index_recommendation
+from app.optimization.plan_analyzer import format_plan_summary, get_plan_analysis
+from app.optimization.prompt_budget import sp_over_budget
+from app.optimization.sp_chunker import SP_CHUNK_AUTO_CHARS, optimize_sp_in_blocks
+from app.optimization.sp_loader import format_table_info, get_sp_definition, get_tables_metadata
+from app.optimization.sp_optimizer import (
+    OptimizedSqlStream, optimize_stored_procedure, optimize_stored_procedure_stream, sanitize_sql
+)
+from app.optimization.sp_saver import save_sql_to_file
+from app.utils.utils import extract_table_names_from_sql_new, is_similar_sql
+
+# The steps behind /optimize_sp and /analyze_ai, runnable from a request or a background job.
+# The SQL connection is only held while reading metadata and goes back to the pool before the LLM call.
+
+
+def split_sp_name(sp_full):
+    """"db.schema.name" -> (db, schema, name); ValueError for anything else."""
+    parts = (sp_full or "").split(".")
+    if len(parts) != 3 or not all(parts):
+        raise ValueError("Invalid SP data. Please select SP from the list.")
+    return tuple(parts)
+
+
+def load_sp_metadata(connection, database_name, schema, name):
+    """SP text plus the fetched metadata ({"db.schema.table": TableMetadata}) of every referenced table."""
+    sp_text = get_sp_definition(connection, database_name, schema, name)
+    if not sp_text:
+        raise LookupError(f"Failed to retrieve SP definition {schema}.{name}")
+
+    table_names = extract_table_names_from_sql_new(sp_text, database_name)
+    print(table_names)
+
+    # Columns + indexes for every referenced table, one batch per database
+    return sp_text, get_tables_metadata(connection, table_names, database_name)
+
+
+def load_sp_context(connection, database_name, schema, name):
+    """SP text plus the table info lines (columns + indexes of every referenced table) sent to the AI."""
+    sp_text, metadata = load_sp_metadata(connection, database_name, schema, name)
+    return sp_text, format_table_info(metadata, default_db=database_name, sp_text=sp_text)
+
+
+def use_chunks(sp_text, chunked=None):
+    """
+    Whether to optimize block by block: as requested, else for SPs longer than SP_CHUNK_AUTO_CHARS
+    or too big for PROMPT_TOKEN_BUDGET in one prompt (the SP text itself is never truncated).
+    """
+    if chunked is not None:
+        return chunked
+    return 0 < SP_CHUNK_AUTO_CHARS < len(sp_text) or sp_over_budget(sp_text)
+
+
+def clean_optimized_sql(optimized_sql):
+    optimized_sql = sanitize_sql(optimized_sql)
+    optimized_sql = optimized_sql.replace("=== END SP_OPTIMIZED ===", "")
+    return optimized_sql.replace("=== SP_OPTIMIZED ===", "")
+
+
+def run_optimize_sp(sp_name, chunked=None):
+    """
+    Everything result.html needs for one optimized SP.
+    chunked=True optimizes the SP block by block (see sp_chunker); None decides with use_chunks.
+    """
+    database_name, schema, name = split_sp_name(sp_name)
+
+    with get_connection() as connection:
+        sp_text, metadata = load_sp_metadata(connection, database_name, schema, name)
+        plan = get_plan_analysis(connection, database_name, schema, name)
+    plan_summary = format_plan_summary(plan)
+
+    chunks = None
+    if use_chunks(sp_text, chunked):
+        optimized_sql, chunks = optimize_sp_in_blocks(sp_text, metadata, database_name, plan=plan)
+        if not chunks["optimized_blocks"]:
+            raise RuntimeError("Optimization failed (AI did not respond).")
+    else:
+        table_info = format_table_info(metadata, default_db=database_name, sp_text=sp_text)
+        optimized_sql = optimize_stored_procedure(sp_text, table_info, plan_summary)
+        if not optimized_sql:
+            raise RuntimeError("Optimization failed (AI did not respond).")
+        optimized_sql = clean_optimized_sql(optimized_sql)
+
+    similar, ratio = is_similar_sql(sp_text, optimized_sql)
+
+    return {
+        "original": sp_text,
+        "optimized": optimized_sql,
+        "database_name": database_name,
+        "schema": schema,
+        "name": name,
+        "similarity": round(ratio * 100, 2),
+        "similar": similar,
+        "chunks": chunks,
+        "plan_summary": plan_summary,
+    }
+
+
+def stream_optimize_sp(sp_name):
+    """
+    Streaming variant of run_optimize_sp, yielding events for the browser:
+      {"type": "meta", original, database_name, schema, name, plan_summary}
+      {"type": "sql", "delta": ...}            optimized SQL as it arrives
+      {"type": "done", optimized, similarity, similar}
+      {"type": "error", "message": ...}
+    """
+    database_name, schema, name = split_sp_name(sp_name)
+
+    with get_connection() as connection:
+        sp_text, metadata = load_sp_metadata(connection, database_name, schema, name)
+        plan = get_plan_analysis(connection, database_name, schema, name)
+    plan_summary = format_plan_summary(plan)
+
+    yield {"type": "meta", "original": sp_text, "database_name": database_name, "schema": schema, "name": name,
+           "plan_summary": plan_summary}
+
+    if use_chunks(sp_text):
+        # blocks are optimized concurrently, so the result arrives in one piece
+        optimized_sql, chunks = optimize_sp_in_blocks(sp_text, metadata, database_name, plan=plan)
+        if not chunks["optimized_blocks"]:
+            yield {"type": "error", "message": "Optimization failed (AI did not respond)."}
+            return
+        yield {"type": "sql", "delta": optimized_sql}
+    else:
+        table_info = format_table_info(metadata, default_db=database_name, sp_text=sp_text)
+        parser = OptimizedSqlStream()
+        for chunk in optimize_stored_procedure_stream(sp_text, table_info, plan_summary):
+            delta = parser.feed(chunk)
+            if delta:
+                yield {"type": "sql", "delta": delta}
+        rest = parser.finish()
+        if rest:
+            yield {"type": "sql", "delta": rest}
+
+        if not parser.text():
+            yield {"type": "error", "message": "Optimization failed (AI did not respond)."}
+            return
+
+        # same clean-up as the non-streaming path, so saving gives identical SQL
+        optimized_sql = clean_optimized_sql(parser.text())
+
+    similar, ratio = is_similar_sql(sp_text, optimized_sql)
+    yield {"type": "done", "optimized": optimized_sql, "similarity": round(ratio * 100, 2), "similar": similar}
+
+
+def run_index_recommendation(sp_name):
+    database_name, schema, name = split_sp_name(sp_name)
+
+    with get_connection() as connection:
+        sp_text, table_info = load_sp_context(connection, database_name, schema, name)
+
+    ai_suggestions = get_index_recommendation(sp_text, table_info)
+    if not ai_suggestions:
+        ai_suggestions = "-- (No AI recommendations)"
+    else:
+        save_sql_to_file(ai_suggestions, "index_ai_recommendations.sql")
+
+    return {"ai_suggestions": ai_suggestions}
@@ -0,0 +1,171 @@
+"""
+Background sampler of sys.dm_exec_procedure_stats.
+
+The DMV only has counters accumulated since each plan was cached. Every STATS_SAMPLE_INTERVAL
+seconds the sampler takes a snapshot, diffs it against the previous one per plan_handle and
+stores the per-interval work per procedure (app.optimization.stats_store), so /slow-sp can
+show what was slow in the last 15 minutes instead of since the plan was compiled.
+
+Runs inside the web app when STATS_SAMPLER_ENABLED=true, or on its own:
+
+    python -m app.optimization.stats_sampler
+"""
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+from app.db_connector import get_connection
+from app.optimization import stats_store  # reads STATS_* from .env
+
+STATS_SAMPLER_ENABLED = os.getenv("STATS_SAMPLER_ENABLED", "false").lower() in ("1", "true", "yes")
+STATS_SAMPLE_INTERVAL = int(os.getenv("STATS_SAMPLE_INTERVAL", "60"))
+
+PlanCounters = namedtuple(
+    "PlanCounters",
+    "database_id object_id database_name schema_name object_name cached_time "
+    "execution_count cpu_us elapsed_us logical_reads"
+)
+ProcDelta = namedtuple("ProcDelta", "database_id object_id executions cpu_us elapsed_us logical_reads")
+
+SNAPSHOT_SQL = """
+    SELECT
+        ps.plan_handle,
+        ps.database_id,
+        ps.object_id,
+        DB_NAME(ps.database_id),
+        OBJECT_SCHEMA_NAME(ps.object_id, ps.database_id),
+        OBJECT_NAME(ps.object_id, ps.database_id),
+        ps.cached_time,
+        ps.execution_count,
+        ps.total_worker_time,
+        ps.total_elapsed_time,
+        ps.total_logical_reads
+    FROM sys.dm_exec_procedure_stats ps
+    WHERE ps.database_id > 4 AND ps.database_id <> 32767
+      AND ps.type = 'P'
+"""
+
+
+def take_snapshot(connection):
+    """(server time before the snapshot, {plan_handle: PlanCounters})"""
+    cursor = connection.cursor()
+    cursor.execute("SELECT SYSDATETIME()")
+    sampled_at = cursor.fetchone()[0]
+
+    cursor.execute(SNAPSHOT_SQL)
+    snapshot = {}
+    for row in cursor.fetchall():
+        if row[5] is None:
+            continue  # dropped since the plan was cached
+        snapshot[bytes(row[0])] = PlanCounters(*row[1:])
+    return sampled_at, snapshot
+
+
+def compute_deltas(previous, current, previous_sampled_at):
+    """
+    Work done between two snapshots, summed per procedure: ({(db, schema, name): ProcDelta}, evicted plans).
+
+    - same plan_handle and cached_time as before: counters minus the previous counters
+    - plan cached after the previous snapshot (new, or recompiled under the same handle):
+      all of its counters belong to this interval
+    - plan seen for the first time but cached earlier: baseline only, nothing recorded
+    Executions of an evicted plan between the previous snapshot and its eviction are not visible.
+    """
+    totals = {}
+    for handle, cur in current.items():
+        old = previous.get(handle)
+        if old is not None and old.cached_time == cur.cached_time and cur.execution_count >= old.execution_count:
+            diff = (cur.execution_count - old.execution_count, cur.cpu_us - old.cpu_us,
+                    cur.elapsed_us - old.elapsed_us, cur.logical_reads - old.logical_reads)
+        elif previous_sampled_at is not None and cur.cached_time >= previous_sampled_at:
+            diff = (cur.execution_count, cur.cpu_us, cur.elapsed_us, cur.logical_reads)
+        else:
+            continue
+        if diff[0] <= 0:
+            continue
+
+        key = (cur.database_name, cur.schema_name, cur.object_name)
+        sums = totals.setdefault(key, [cur.database_id, cur.object_id, 0, 0, 0, 0])
+        for i, value in enumerate(diff):
+            sums[2 + i] += max(0, value)
+
+    evicted = len(previous.keys() - current.keys())
+    return {key: ProcDelta(*sums) for key, sums in totals.items()}, evicted
+
+
+class StatsSampler:
+    def __init__(self, interval=STATS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._previous = {}
+        self._previous_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"samples": 0, "errors": 0, "procedures_recorded": 0, "evicted_plans": 0,
+                       "last_sample": None, "leader": False}
+
+    def sample_once(self):
+        with get_connection() as connection:
+            sampled_at, snapshot = take_snapshot(connection)
+
+        deltas, evicted = compute_deltas(self._previous, snapshot, self._previous_at)
+        self._previous, self._previous_at = snapshot, sampled_at
+        stats_store.record_deltas(time.time(), deltas)
+
+        self._stats["samples"] += 1
+        self._stats["procedures_recorded"] += len(deltas)
+        self._stats["evicted_plans"] += evicted
+        self._stats["last_sample"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        return deltas
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                leader = stats_store.acquire_lease(self.owner, self.interval * 3)
+                if leader:
+                    self.sample_once()
+                    stats_store.purge_old_samples()
+                elif self._stats["leader"]:
+                    # another process took over; start from a fresh baseline if we get it back
+                    self._previous, self._previous_at = {}, None
+                self._stats["leader"] = leader
+            except Exception as e:
+                self._stats["errors"] += 1
+                print(f"❌ Stats sampler error: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="stats-sampler", daemon=True)
+            self._thread.start()
+            print(f"📈 Stats sampler started (every {self.interval}s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {"enabled": self._thread is not None, "interval": self.interval, **self._stats}
+
+
+sampler = StatsSampler()
+
+
+def start_sampler():
+    """Start the background sampler when STATS_SAMPLER_ENABLED is set; safe to call more than once."""
+    if STATS_SAMPLER_ENABLED:
+        sampler.start()
+    return sampler
+
+
+if __name__ == "__main__":
+    print(f"📈 Sampling sys.dm_exec_procedure_stats every {sampler.interval}s into {stats_store.STATS_DB}")
+    try:
+        sampler.run()
+    except KeyboardInterrupt:
+        sampler.stop()
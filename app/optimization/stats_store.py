@@ -0,0 +1,227 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-interval procedure stats written by the sampler (app.optimization.stats_sampler)
+STATS_DB = os.getenv("STATS_DB", os.path.join("data", "query_stats.db"))
+STATS_RAW_RETENTION_HOURS = float(os.getenv("STATS_RAW_RETENTION_HOURS", "24"))
+STATS_RETENTION_DAYS = float(os.getenv("STATS_RETENTION_DAYS", "30"))
+
+# Every delta is added to a one-minute and a one-hour bucket; minute buckets are purged
+# after STATS_RAW_RETENTION_HOURS, hour buckets after STATS_RETENTION_DAYS.
+MINUTE = 60
+HOUR = 3600
+
+_lock = threading.Lock()
+
+# Procedure names are stored once in proc; samples are integer-only rows clustered by
+# (resolution, bucket) so a time window is one contiguous range scan.
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS proc (
+    proc_id INTEGER PRIMARY KEY,
+    database_name TEXT NOT NULL,
+    schema_name TEXT NOT NULL,
+    object_name TEXT NOT NULL,
+    database_id INTEGER,
+    object_id INTEGER,
+    UNIQUE (database_name, schema_name, object_name)
+);
+
+CREATE TABLE IF NOT EXISTS proc_sample (
+    resolution INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    proc_id INTEGER NOT NULL,
+    executions INTEGER NOT NULL,
+    cpu_us INTEGER NOT NULL,
+    elapsed_us INTEGER NOT NULL,
+    logical_reads INTEGER NOT NULL,
+    PRIMARY KEY (resolution, bucket, proc_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS ix_sample_proc ON proc_sample (proc_id, resolution, bucket);
+
+CREATE TABLE IF NOT EXISTS sampler_lease (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+# sort key (same keys as query_stats.SORT_OPTIONS) -> ORDER BY expression
+_ORDER_BY = {
+    "elapsed": "SUM(s.elapsed_us) * 1.0 / SUM(s.executions)",
+    "cpu": "SUM(s.cpu_us) * 1.0 / SUM(s.executions)",
+    "reads": "SUM(s.logical_reads) * 1.0 / SUM(s.executions)",
+    "executions": "SUM(s.executions)",
+}
+
+
+@contextmanager
+def _connect():
+    folder = os.path.dirname(STATS_DB)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    conn = sqlite3.connect(STATS_DB, timeout=30)
+    try:
+        conn.executescript(SCHEMA_SQL)
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def acquire_lease(owner, ttl):
+    """
+    Only one sampler per machine writes samples (several gunicorn workers may start one).
+    True when owner holds the lease for the next ttl seconds.
+    """
+    now = time.time()
+    with _lock, _connect() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO sampler_lease (id, owner, expires_at) VALUES (1, ?, ?)", (owner, now + ttl)
+        )
+        cursor = conn.execute(
+            "UPDATE sampler_lease SET owner = ?, expires_at = ? WHERE id = 1 AND (owner = ? OR expires_at < ?)",
+            (owner, now + ttl, owner, now)
+        )
+        return cursor.rowcount == 1
+
+
+def _proc_ids(conn, procs):
+    """{(db, schema, name): proc_id}, creating entries for new procedures."""
+    conn.executemany(
+        "INSERT OR IGNORE INTO proc (database_name, schema_name, object_name) VALUES (?, ?, ?)",
+        list(procs)
+    )
+    conn.executemany(
+        "UPDATE proc SET database_id = ?, object_id = ? WHERE database_name = ? AND schema_name = ? AND object_name = ?",
+        [(ids[0], ids[1], *key) for key, ids in procs.items()]
+    )
+    ids = {}
+    for key in procs:
+        row = conn.execute(
+            "SELECT proc_id FROM proc WHERE database_name = ? AND schema_name = ? AND object_name = ?", key
+        ).fetchone()
+        ids[key] = row[0]
+    return ids
+
+
+def record_deltas(sampled_at, deltas):
+    """
+    deltas: {(database, schema, name): ProcDelta} for one sampling interval, added to the minute
+    and hour buckets that contain sampled_at (unix time).
+    """
+    if not deltas:
+        return
+    with _lock, _connect() as conn:
+        ids = _proc_ids(conn, {key: (d.database_id, d.object_id) for key, d in deltas.items()})
+        rows = []
+        for resolution in (MINUTE, HOUR):
+            bucket = int(sampled_at) // resolution * resolution
+            rows += [
+                (resolution, bucket, ids[key], d.executions, d.cpu_us, d.elapsed_us, d.logical_reads)
+                for key, d in deltas.items()
+            ]
+        conn.executemany("""
+            INSERT INTO proc_sample (resolution, bucket, proc_id, executions, cpu_us, elapsed_us, logical_reads)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (resolution, bucket, proc_id) DO UPDATE SET
+                executions = executions + excluded.executions,
+                cpu_us = cpu_us + excluded.cpu_us,
+                elapsed_us = elapsed_us + excluded.elapsed_us,
+                logical_reads = logical_reads + excluded.logical_reads
+        """, rows)
+
+
+def purge_old_samples(now=None):
+    now = time.time() if now is None else now
+    with _lock, _connect() as conn:
+        deleted = conn.execute(
+            "DELETE FROM proc_sample WHERE resolution = ? AND bucket < ?",
+            (MINUTE, now - STATS_RAW_RETENTION_HOURS * 3600)
+        ).rowcount
+        deleted += conn.execute(
+            "DELETE FROM proc_sample WHERE resolution = ? AND bucket < ?",
+            (HOUR, now - STATS_RETENTION_DAYS * 86400)
+        ).rowcount
+    return deleted
+
+
+def _resolution_for(seconds):
+    """Minute buckets while they are still kept and the result stays small, hour buckets otherwise."""
+    return MINUTE if seconds <= min(STATS_RAW_RETENTION_HOURS * 3600, 6 * 3600) else HOUR
+
+
+def get_top_procedures(window_minutes, sort="elapsed", limit=50):
+    """Slowest procedures over the last window_minutes, same row keys as query_stats.get_slow_sp."""
+    if sort not in _ORDER_BY:
+        raise ValueError(f"Unknown sort {sort!r}")
+    seconds = window_minutes * 60
+    resolution = _resolution_for(seconds)
+    since = (int(time.time()) - seconds) // resolution * resolution
+
+    with _lock, _connect() as conn:
+        rows = conn.execute(f"""
+            SELECT p.database_name, p.schema_name, p.object_name, p.database_id, p.object_id,
+                   SUM(s.executions), SUM(s.cpu_us), SUM(s.elapsed_us), SUM(s.logical_reads),
+                   MAX(s.bucket)
+            FROM proc_sample s
+            JOIN proc p ON p.proc_id = s.proc_id
+            WHERE s.resolution = ? AND s.bucket >= ?
+            GROUP BY s.proc_id
+            HAVING SUM(s.executions) > 0
+            ORDER BY {_ORDER_BY[sort]} DESC
+            LIMIT ?
+        """, (resolution, since, limit)).fetchall()
+
+    result = []
+    for db, schema, name, database_id, object_id, executions, cpu_us, elapsed_us, reads, last_bucket in rows:
+        result.append({
+            "database_name": db,
+            "schema_name": schema,
+            "object_name": name,
+            "full_name": f"{db}.{schema}.{name}",
+            "database_id": database_id,
+            "object_id": object_id,
+            "execution_count": executions,
+            "avg_cpu_ms": cpu_us / executions / 1000.0,
+            "avg_elapsed_ms": elapsed_us / executions / 1000.0,
+            "avg_logical_reads": reads // executions,
+            "total_elapsed_ms": elapsed_us / 1000.0,
+            "last_execution_time": time.strftime("%Y-%m-%d %H:%M", time.localtime(last_bucket)),
+            "plan_count": 1,
+        })
+    return result
+
+
+def get_procedure_trend(database, schema, name, hours=24):
+    """Per-bucket executions and averages for one procedure, oldest first."""
+    seconds = int(hours * 3600)
+    resolution = _resolution_for(seconds)
+    since = (int(time.time()) - seconds) // resolution * resolution
+
+    with _lock, _connect() as conn:
+        rows = conn.execute("""
+            SELECT s.bucket, s.executions, s.cpu_us, s.elapsed_us, s.logical_reads
+            FROM proc_sample s
+            JOIN proc p ON p.proc_id = s.proc_id
+            WHERE p.database_name = ? AND p.schema_name = ? AND p.object_name = ?
+              AND s.resolution = ? AND s.bucket >= ?
+            ORDER BY s.bucket
+        """, (database, schema, name, resolution, since)).fetchall()
+
+    return {
+        "resolution_seconds": resolution,
+        "points": [
+            {
+                "time": time.strftime("%Y-%m-%d %H:%M", time.localtime(bucket)),
+                "executions": executions,
+                "avg_cpu_ms": round(cpu_us / executions / 1000.0, 3) if executions else None,
+                "avg_elapsed_ms": round(elapsed_us / executions / 1000.0, 3) if executions else None,
+                "avg_logical_reads": reads // executions if executions else None,
+            }
+            for bucket, executions, cpu_us, elapsed_us, reads in rows
+        ],
+    }
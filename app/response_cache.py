@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Persistent cache of LLM responses, keyed by hash(model, generationConfig, prompt)
+RESPONSE_CACHE_DB = os.getenv("GEMINI_CACHE_DB", os.path.join("data", "gemini_cache.db"))
+RESPONSE_CACHE_ENABLED = os.getenv("GEMINI_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("GEMINI_CACHE_TTL", "0"))   # seconds, 0 = never expires
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    cache_key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS ix_response_cache_access ON response_cache (last_access);
+"""
+
+
+def make_key(model, generation_config, prompt):
+    raw = json.dumps(
+        {"model": model, "generationConfig": generation_config, "prompt": prompt},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(raw.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed LRU (by last access) with an optional TTL; safe to share between threads and processes."""
+
+    def __init__(self, path=RESPONSE_CACHE_DB, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 ttl=RESPONSE_CACHE_TTL, enabled=RESPONSE_CACHE_ENABLED):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._ready = False
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "evicted": 0}
+
+    @contextmanager
+    def _connect(self):
+        if not self._ready:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            if not self._ready:
+                conn.executescript(SCHEMA_SQL)
+                self._ready = True
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT response, created_at FROM response_cache WHERE cache_key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._count("misses")
+                return None
+
+            response, created_at = row
+            if self.ttl and now - created_at > self.ttl:
+                conn.execute("DELETE FROM response_cache WHERE cache_key = ?", (key,))
+                self._count("expired")
+                self._count("misses")
+                return None
+
+            conn.execute(
+                "UPDATE response_cache SET last_access = ?, hits = hits + 1 WHERE cache_key = ?", (now, key)
+            )
+        self._count("hits")
+        return response
+
+    def put(self, key, model, response):
+        if not self.enabled or response is None:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO response_cache (cache_key, model, response, created_at, last_access, hits)
+                VALUES (?, ?, ?, ?, ?, 0)
+            """, (key, model, response, now, now))
+
+            evicted = conn.execute("""
+                DELETE FROM response_cache WHERE cache_key IN (
+                    SELECT cache_key FROM response_cache
+                    ORDER BY last_access DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,)).rowcount
+        self._count("stores")
+        if evicted > 0:
+            self._count("evicted", evicted)
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM response_cache")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["enabled"] = self.enabled
+        stats["max_entries"] = self.max_entries
+        stats["ttl"] = self.ttl
+        if self.enabled:
+            with self._connect() as conn:
+                stats["entries"] = conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        return stats
+
+
+response_cache = ResponseCache()
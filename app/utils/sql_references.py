@@ -0,0 +1,372 @@
+"""
+Table / column reference extraction on top of the T-SQL lexer in sql_tokens.
+
+One linear walk over the token list collects:
+- tables read or written (FROM, JOIN, APPLY, INTO, UPDATE, DELETE, MERGE, USING, TRUNCATE TABLE)
+- columns used in WHERE, JOIN ... ON and ORDER BY, resolved through table aliases
+- CTE names, which are excluded from the table list
+Temp tables, table variables, derived tables and table-valued functions are skipped.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+from app.utils.sql_tokens import text_hash, tokenize
+
+# tables:  unique table names in order of first appearance (db.schema.table when default_db is given)
+# columns: unique (table or None, column) pairs used in WHERE / ON / ORDER BY
+# ctes:    CTE names defined in the text
+# aliases: {lower(alias or table name): full table name} as bound in FROM / JOIN (latest binding wins)
+SqlReferences = namedtuple("SqlReferences", "tables columns ctes aliases")
+
+_TABLE_INTRO = {"FROM", "JOIN", "APPLY", "INTO", "UPDATE", "MERGE", "USING"}
+_PREDICATE_START = {"WHERE", "ON"}
+_CLAUSE_END = {
+    "SELECT", "FROM", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "OUTER", "APPLY",
+    "GROUP", "HAVING", "UNION", "EXCEPT", "INTERSECT", "INSERT", "UPDATE", "DELETE", "MERGE",
+    "SET", "OPTION", "RETURN", "DECLARE", "EXEC", "EXECUTE", "IF", "ELSE", "WHILE", "BEGIN",
+    "END", "OUTPUT", "INTO", "VALUES", "WITH", "FOR", "PRINT", "RAISERROR", "THROW",
+    "TRUNCATE", "USING", "GO",
+}
+
+# Words that are never table aliases or column names
+_KEYWORDS = _CLAUSE_END | _PREDICATE_START | {
+    "ADD", "ALL", "ALTER", "AND", "ANY", "AS", "ASC", "BETWEEN", "BREAK", "BY", "CASE", "CAST",
+    "CATCH", "CHECK", "CLOSE", "COLLATE", "COMMIT", "CONTINUE", "CREATE", "CROSS", "CURSOR",
+    "DEALLOCATE", "DEFAULT", "DESC", "DISTINCT", "DROP", "ESCAPE", "EXISTS", "FETCH", "GOTO",
+    "IN", "INDEX", "IS", "KEY", "LIKE", "MATCHED", "NEXT", "NOCOUNT", "NOLOCK", "NOT", "NULL",
+    "OF", "OFF", "OFFSET", "ONLY", "OPEN", "OR", "ORDER", "OVER", "PARTITION", "PERCENT",
+    "PIVOT", "PROC", "PROCEDURE", "READONLY", "ROLLBACK", "ROWS", "SOURCE", "TABLE", "TABLESAMPLE",
+    "TARGET", "THEN", "TIES", "WHEN", "TOP", "TRAN", "TRANSACTION", "TRY", "UNPIVOT", "VIEW", "WAITFOR",
+    "XACT_ABORT",
+}
+
+# Words handled by the statement walk in _extract; every other token only matters inside a predicate
+_STRUCTURE_WORDS = _TABLE_INTRO | _CLAUSE_END | _PREDICATE_START | {
+    "CASE", "DELETE", "ELSE", "END", "INSERT", "ORDER", "TRUNCATE", "WITH",
+}
+
+# First argument is a type or datepart, not a column
+_FIRST_ARG_NOT_COLUMN = {
+    "CONVERT", "TRY_CONVERT", "DATEADD", "DATEDIFF", "DATEDIFF_BIG", "DATEPART", "DATENAME", "DATETRUNC",
+}
+
+_CACHE_SIZE = 128
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _is_name(token):
+    return token.kind == "ident" or (token.kind == "word" and token.value.upper() not in _KEYWORDS)
+
+
+def _is_punct(token, value):
+    return token.kind == "punct" and token.value == value
+
+
+def _is_word(token, *values):
+    return token.kind == "word" and token.value.upper() in values
+
+
+def _is_cursor_fetch(tokens, i):
+    """tokens[i] is FROM; True for FETCH [NEXT|PRIOR|FIRST|LAST|ABSOLUTE n|RELATIVE n] FROM cursor."""
+    prev = tokens[i - 1]
+    if _is_word(prev, "FETCH", "NEXT", "PRIOR", "FIRST", "LAST"):
+        return True
+    return prev.kind in ("number", "variable") and i > 1 and _is_word(tokens[i - 2], "ABSOLUTE", "RELATIVE")
+
+
+def _match_parens(tokens):
+    """Index of the matching ")" for every "(" (linear, stack based)."""
+    match = {}
+    stack = []
+    for i, tok in enumerate(tokens):
+        if tok.kind == "punct":
+            if tok.value == "(":
+                stack.append(i)
+            elif tok.value == ")" and stack:
+                match[stack.pop()] = i
+    return match
+
+
+def _read_qualified_name(tokens, i):
+    """Read a.b.c / [a]..[c] starting at i. Returns (parts, next_index); parts is [] if no name there."""
+    n = len(tokens)
+    parts = []
+    while i < n:
+        tok = tokens[i]
+        if tok.kind not in ("word", "ident"):
+            break
+        parts.append(tok.value)
+        i += 1
+
+        if i < n and _is_punct(tokens[i], "."):
+            i += 1
+            while i < n and _is_punct(tokens[i], "."):
+                parts.append("")  # db..table -> empty schema part
+                i += 1
+        else:
+            break
+    return parts, i
+
+
+def _scan_ctes(tokens, i, parens):
+    """tokens[i] is WITH; returns CTE names if this WITH starts a CTE list, else []."""
+    names = []
+    n = len(tokens)
+    j = i + 1
+    while j < n and _is_name(tokens[j]):
+        name = tokens[j].value
+        j += 1
+        if j < n and _is_punct(tokens[j], "("):  # optional column list
+            j = parens.get(j, n) + 1
+        if not (j + 1 < n and _is_word(tokens[j], "AS") and _is_punct(tokens[j + 1], "(")):
+            break
+        names.append(name)
+        j = parens.get(j + 1, n) + 1
+        if j < n and _is_punct(tokens[j], ","):
+            j += 1
+        else:
+            break
+    return names
+
+
+def _expand_name(parts, default_db):
+    parts = list(parts)
+    if len(parts) == 3 and not parts[1]:
+        parts[1] = "dbo"  # db..table
+    parts = [p for p in parts if p]
+    if len(parts) == 1 and default_db:
+        return f"{default_db}.dbo.{parts[0]}"
+    if len(parts) == 2 and default_db:
+        return f"{default_db}.{parts[0]}.{parts[1]}"
+    return ".".join(parts)
+
+
+def _extract(tokens, default_db):
+    parens = _match_parens(tokens)
+    n = len(tokens)
+
+    tables = OrderedDict()      # lower(full name) -> full name
+    pending_targets = []        # UPDATE/DELETE targets that may turn out to be aliases
+    aliases = {}                # lower(alias) -> full table name (latest binding wins)
+    ctes = OrderedDict()
+    columns = OrderedDict()
+
+    clause = None               # "predicate" while inside WHERE / ON / ORDER BY
+    clause_stack = []           # saved clause per open paren
+    from_list_depth = None      # paren depth of the current FROM list (commas introduce tables)
+    depth = 0
+    case_depth = 0              # END / ELSE inside CASE do not end a clause
+    skip_first_arg = set()      # "(" indexes whose first token is a type/datepart
+
+    def add_table(parts, alias=None, target=False):
+        if not parts or not parts[-1]:
+            return
+        single = len([p for p in parts if p]) == 1
+        if single and parts[-1].lower() in ctes:
+            full = ctes[parts[-1].lower()]
+        else:
+            full = _expand_name(parts, default_db)
+            if target and single:
+                pending_targets.append((parts[-1], full))
+            else:
+                tables.setdefault(full.lower(), full)
+        aliases[parts[-1].lower()] = full
+        if alias:
+            aliases[alias.lower()] = full
+
+    def read_table_source(i, allow_function=True, target=False):
+        """Parse "name [AS] alias" at i; returns the index after it."""
+        if i >= n:
+            return i
+        tok = tokens[i]
+        if tok.kind in ("variable", "temp") or _is_punct(tok, "("):
+            return i + 1 if tok.kind in ("variable", "temp") else i
+        if tok.kind == "word" and tok.value.upper() in _KEYWORDS:
+            return i
+
+        parts, j = _read_qualified_name(tokens, i)
+        if not parts:
+            return i
+        if allow_function and j < n and _is_punct(tokens[j], "("):
+            return j  # table-valued function / OPENQUERY(...)
+
+        alias = None
+        if j < n and _is_word(tokens[j], "AS") and j + 1 < n and _is_name(tokens[j + 1]):
+            alias = tokens[j + 1].value
+            j += 2
+        elif j < n and _is_name(tokens[j]):
+            alias = tokens[j].value
+            j += 1
+
+        add_table(parts, alias, target=target)
+        return j
+
+    def add_column(parts):
+        parts = [p for p in parts if p]
+        if not parts:
+            return
+        column = parts[-1]
+        table = None
+        if len(parts) >= 2:
+            qualifier = parts[:-1]
+            table = aliases.get(qualifier[-1].lower()) if len(qualifier) == 1 else _expand_name(qualifier, default_db)
+            if table is None:
+                table = qualifier[-1]
+        columns.setdefault((table.lower() if table else None, column.lower()), (table, column))
+
+    i = 0
+    while i < n:
+        tok = tokens[i]
+        upper = tok.value.upper() if tok.kind == "word" else None
+
+        if tok.kind == "punct":
+            if tok.value == "(":
+                clause_stack.append((clause, from_list_depth))
+                depth += 1
+                if i in skip_first_arg and i + 1 < n:
+                    i += 2
+                    continue
+            elif tok.value == ")":
+                if clause_stack:
+                    clause, from_list_depth = clause_stack.pop()
+                depth = max(depth - 1, 0)
+            elif tok.value == ";":
+                clause, from_list_depth = None, None
+            elif tok.value == "," and from_list_depth == depth and clause is None:
+                i = read_table_source(i + 1)
+                continue
+            i += 1
+            continue
+
+        if upper not in _STRUCTURE_WORDS:
+            # names, literals and operators; only predicate columns need a closer look
+            if clause == "predicate" and tok.kind in ("word", "ident"):
+                if upper in ("AS", "COLLATE"):
+                    i += 2  # CAST(x AS type) / COLLATE name
+                    continue
+                if upper in _KEYWORDS:
+                    i += 1
+                    continue
+                parts, j = _read_qualified_name(tokens, i)
+                if j < n and _is_punct(tokens[j], "("):
+                    # function call, not a column
+                    if len(parts) == 1 and parts[0].upper() in _FIRST_ARG_NOT_COLUMN:
+                        skip_first_arg.add(j)
+                    i = j
+                    continue
+                add_column(parts)
+                i = j
+                continue
+            i += 1
+            continue
+
+        if upper == "WITH":
+            for name in _scan_ctes(tokens, i, parens):
+                ctes.setdefault(name.lower(), name)
+            i += 1
+            continue
+
+        if upper == "CASE":
+            case_depth += 1
+            i += 1
+            continue
+
+        if upper in ("END", "ELSE") and case_depth:
+            if upper == "END":
+                case_depth -= 1
+            i += 1
+            continue
+
+        if upper == "FROM" and i > 0 and _is_cursor_fetch(tokens, i):
+            i += 2  # FETCH NEXT FROM cursor_name
+            continue
+
+        if upper == "INSERT":
+            clause, from_list_depth = None, None
+            j = i + 1
+            if j < n and _is_word(tokens[j], "INTO"):
+                j += 1
+            i = read_table_source(j, allow_function=False)
+            continue
+
+        if upper in _TABLE_INTRO:
+            clause = None
+            if upper == "FROM":
+                from_list_depth = depth
+            elif upper != "INTO":
+                from_list_depth = None
+            if upper == "UPDATE":
+                i = read_table_source(i + 1, allow_function=False, target=True)
+            elif upper in ("INTO", "MERGE"):
+                j = i + 1
+                if upper == "MERGE" and j < n and _is_word(tokens[j], "INTO"):
+                    j += 1
+                i = read_table_source(j, allow_function=False)
+            else:
+                i = read_table_source(i + 1)
+            continue
+
+        if upper == "DELETE":
+            clause, from_list_depth = None, None
+            j = i + 1
+            if j < n and _is_word(tokens[j], "TOP") and j + 1 < n and _is_punct(tokens[j + 1], "("):
+                j = parens.get(j + 1, n) + 1
+            if j < n and _is_word(tokens[j], "FROM"):
+                from_list_depth = depth
+                j += 1
+            i = read_table_source(j, allow_function=False, target=True)
+            continue
+
+        if upper == "TRUNCATE" and i + 1 < n and _is_word(tokens[i + 1], "TABLE"):
+            i = read_table_source(i + 2, allow_function=False)
+            continue
+
+        if upper in _PREDICATE_START or (upper == "ORDER" and i + 1 < n and _is_word(tokens[i + 1], "BY")):
+            clause = "predicate"
+            from_list_depth = None
+            i += 2 if upper == "ORDER" else 1
+            continue
+
+        if upper in _CLAUSE_END:
+            clause = None
+            if upper not in ("JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "OUTER", "WITH"):
+                from_list_depth = None
+            i += 1
+            continue
+
+        i += 1
+
+    # UPDATE o SET ... FROM dbo.Orders o: "o" is an alias, not a table
+    for name, full in pending_targets:
+        key = name.lower()
+        if key in ctes:
+            continue
+        if aliases.get(key, full) != full:
+            continue
+        tables.setdefault(full.lower(), full)
+
+    return SqlReferences(
+        tables=list(tables.values()),
+        columns=list(columns.values()),
+        ctes=list(ctes.values()),
+        aliases=aliases,
+    )
+
+
+def extract_references(sql_text, default_db=None):
+    """Tables, predicate columns and CTE names for sql_text, cached by text hash."""
+    key = (text_hash(sql_text), default_db)
+    with _cache_lock:
+        refs = _cache.get(key)
+        if refs is not None:
+            _cache.move_to_end(key)
+            return refs
+
+    refs = _extract(tokenize(sql_text), default_db)
+
+    with _cache_lock:
+        _cache[key] = refs
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return refs
@@ -0,0 +1,139 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+# kind: word (bare identifier or keyword), ident ([bracketed] / "quoted", value unquoted),
+#       variable (@x, @@x), temp (#x, ##x), string, number, punct (. , ; ( )), op
+Token = namedtuple("Token", "kind value")
+
+# identifiers: every identifier in the SP, lowercased, brackets/quotes removed
+# qualified:   (left, right) pairs for every "left.right" reference, e.g. ("o", "customerid")
+# bare:        identifiers that also appear without a qualifier in front
+SpTokens = namedtuple("SpTokens", "identifiers qualified bare")
+
+# Whitespace and line comments in front of a token are consumed by the same match, so there is
+# one regex call per token. Common kinds come first; N'..' must precede word, number precede
+# punct (".5") and /* precede op. "end" matches only trailing whitespace / comments.
+_LEX_RE = re.compile(
+    r"""
+    \s*(?:--[^\n]*\s*)*
+    (?:
+      (?P<string>[Nn]?'(?:[^']|'')*(?:'|\Z))
+    | (?P<word>[^\W\d][\w@\#$]*)
+    | (?P<number>0[xX][0-9A-Fa-f]*|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<punct>[.,;()])
+    | (?P<variable>@@?[\w@\#$]*)
+    | (?P<temp>\#\#?[\w@\#$]*)
+    | (?P<bracket>\[(?:[^\]]|\]\])*(?:\]|\Z))
+    | (?P<quoted>"(?:[^"]|"")*(?:"|\Z))
+    | (?P<block_comment>/\*)
+    | (?P<end>\Z)
+    | (?P<op>.)
+    )
+    """,
+    re.DOTALL | re.VERBOSE,
+)
+
+_BLOCK_COMMENT_RE = re.compile(r"/\*|\*/")
+
+_CACHE_SIZE = 64
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _skip_block_comment(sql_text, pos):
+    """pos points at "/*"; T-SQL block comments nest. Returns the index after the closing "*/"."""
+    depth = 0
+    for m in _BLOCK_COMMENT_RE.finditer(sql_text, pos):
+        depth += 1 if m.group() == "/*" else -1
+        if depth == 0:
+            return m.end()
+    return len(sql_text)  # unterminated comment runs to the end
+
+
+def iter_token_spans(sql_text):
+    """
+    Streaming T-SQL lexer: one left-to-right pass, comments and whitespace dropped.
+    Handles N'' strings with '' escapes, [bracketed names with spaces]]], "quoted" names
+    and nested /* */ comments. Yields (Token, start, end) offsets into sql_text.
+    """
+    pos = 0
+    n = len(sql_text)
+    new_token = tuple.__new__  # Token(kind, value) without the namedtuple __new__ wrapper
+
+    while pos < n:
+        for m in _LEX_RE.finditer(sql_text, pos):
+            kind = m.lastgroup
+            value = m.group(m.lastindex)  # the token group always ends where the match ends
+            end = m.end()
+            if kind == "bracket" or kind == "quoted":
+                close = "]" if kind == "bracket" else '"'
+                inner = value[1:-1] if len(value) > 1 and value.endswith(close) else value[1:]
+                yield new_token(Token, ("ident", inner.replace(close * 2, close))), end - len(value), end
+            elif kind == "block_comment":
+                pos = _skip_block_comment(sql_text, end - 2)
+                break  # resume the scan after the comment
+            elif kind == "end":
+                return
+            else:
+                yield new_token(Token, (kind, value)), end - len(value), end
+        else:
+            return
+
+
+def iter_tokens(sql_text):
+    for token, _, _ in iter_token_spans(sql_text):
+        yield token
+
+
+def tokenize(sql_text):
+    return [token for token, _, _ in iter_token_spans(sql_text)]
+
+
+def tokenize_identifiers(sql_text):
+    """Single pass over the SQL text; comments and string literals are skipped."""
+    identifiers = set()
+    qualified = set()
+    bare = set()
+
+    previous = None      # last identifier seen
+    after_dot = False    # previous token was "." following an identifier
+
+    for kind, value in iter_tokens(sql_text):
+        if kind == "word" or kind == "ident":
+            name = value.lower()
+            identifiers.add(name)
+            if after_dot and previous is not None:
+                qualified.add((previous, name))
+            else:
+                bare.add(name)
+            previous, after_dot = name, False
+        elif kind == "punct" and value == ".":
+            after_dot = previous is not None
+        else:
+            previous, after_dot = None, False
+
+    return SpTokens(frozenset(identifiers), frozenset(qualified), frozenset(bare))
+
+
+def text_hash(sql_text):
+    return hashlib.sha1(sql_text.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def get_sp_tokens(sql_text):
+    """tokenize_identifiers with a small cache keyed by the text hash, so every table of one SP reuses it."""
+    key = text_hash(sql_text)
+    with _cache_lock:
+        tokens = _cache.get(key)
+        if tokens is not None:
+            _cache.move_to_end(key)
+            return tokens
+
+    tokens = tokenize_identifiers(sql_text)
+
+    with _cache_lock:
+        _cache[key] = tokens
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return tokens
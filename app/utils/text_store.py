@@ -0,0 +1,70 @@
+import mmap
+import os
+
+import numpy as np
+
+# Offset-indexed text list on disk, read through mmap so every worker shares the page cache.
+#   <name>.dat          UTF-8 texts back to back
+#   <name>.offsets.npy  int64 (n, 2): start, length; length -1 marks a None slot
+
+
+def store_paths(path):
+    base, _ = os.path.splitext(path)
+    return base + ".dat", base + ".offsets.npy"
+
+
+def write_texts(path, texts):
+    data_path, offsets_path = store_paths(path)
+    offsets = np.empty((len(texts), 2), dtype=np.int64)
+
+    pos = 0
+    with open(data_path + ".tmp", "wb") as f:
+        for i, text in enumerate(texts):
+            if text is None:
+                offsets[i] = (pos, -1)
+                continue
+            raw = text.encode("utf-8")
+            f.write(raw)
+            offsets[i] = (pos, len(raw))
+            pos += len(raw)
+
+    with open(offsets_path + ".tmp", "wb") as f:
+        np.save(f, offsets)
+
+    # swap both files only once they are complete, so a running app never sees half a store
+    os.replace(data_path + ".tmp", data_path)
+    os.replace(offsets_path + ".tmp", offsets_path)
+
+
+def exists(path):
+    return all(os.path.exists(p) for p in store_paths(path))
+
+
+class TextStore:
+    """Read-only list-like view: len(store), store[i] (str or None), iteration."""
+
+    def __init__(self, path):
+        data_path, offsets_path = store_paths(path)
+        self._offsets = np.load(offsets_path, mmap_mode="r")
+        self._file = open(data_path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap of an empty file is not allowed; every slot is None in that case anyway
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        start, length = self._offsets[i]
+        if length < 0:
+            return None
+        return self._data[start:start + length].decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
@@ -1,33 +1,119 @@
 import os
 from datetime import datetime
 from difflib import SequenceMatcher
-import re
 
-import faiss
 import pickle
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+from app.catalog_collector import collect
+from app.embedding_service import get_embedder
+from app.utils import text_store
+from app.utils.sql_references import extract_references
 
 # --- Tambahan untuk FAISS ---
 DATA_DIR = "data"
 FAISS_FILE = os.path.join(DATA_DIR, "faiss_index.bin")
-TEXTS_FILE = os.path.join(DATA_DIR, "schema_texts.pkl")
+TEXTS_FILE = os.path.join(DATA_DIR, "schema_texts.dat")       # offset-indexed, see text_store
+LEGACY_TEXTS_FILE = os.path.join(DATA_DIR, "schema_texts.pkl")
+EMBED_FILE = os.path.join(DATA_DIR, "embeddings.npy")
+
+# Search-time knobs for approximate indexes (see create_faiss.py --index-type); ignored for flat
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
 
-# Load model & index sekali
+# Load model & index sekali (faiss / the embedding model are loaded on first use,
+# so routes that never search the schema do not pay for them)
 _model = None
 _index = None
 _texts = None
+_embeddings = None   # raw rows (memory-mapped), row i <-> texts[i]
+_inv_norms = None    # 1 / |row|, 0 for empty rows
+_name_index = None   # "db.schema.table" / "schema.table" -> [row ids]
 
-def load_faiss():
-    global _model, _index, _texts
+
+def read_faiss_index(path):
+    """
+    IO_FLAG_MMAP only maps the inverted lists of IVF / IVF-PQ indexes, which workers then share
+    through the page cache; flat and HNSW indexes are still read into memory.
+    """
+    import faiss
+
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+    except RuntimeError:
+        return faiss.read_index(path)
+
+
+def load_schema_texts():
+    if text_store.exists(TEXTS_FILE):
+        return text_store.TextStore(TEXTS_FILE)
+    with open(LEGACY_TEXTS_FILE, "rb") as f:  # built before the text store; rerun create_faiss.py
+        return pickle.load(f)
+
+
+def get_model():
+    global _model
     if _model is None:
-        _model = SentenceTransformer("all-MiniLM-L6-v2")
+        _model = get_embedder()  # shared service if EMBEDDING_SERVICE_ADDR is set
+    return _model
+
+
+def load_faiss():
+    global _index, _texts
+    model = get_model()
     if _index is None:
-        _index = faiss.read_index(FAISS_FILE)
+        _index = set_search_params(read_faiss_index(FAISS_FILE))
     if _texts is None:
-        with open(TEXTS_FILE, "rb") as f:
-            _texts = pickle.load(f)
-    return _model, _index, _texts
+        _texts = load_schema_texts()
+    return model, _index, _texts
+
+
+def set_search_params(index, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH):
+    """nprobe for IVF / IVF-PQ, efSearch for HNSW; higher means better recall and slower queries."""
+    import faiss
+
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(base, faiss.IndexIVF):
+        base.nprobe = min(nprobe, base.nlist)
+    elif isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = ef_search
+    return index
+
+
+def schema_text_table_name(text):
+    """Schema texts look like "db.schema.table (col (type), ...) Indexes: ..."."""
+    return text.split(" (", 1)[0].lower()
+
+
+def load_schema_vectors():
+    """Stored embeddings (memory-mapped, with per-row inverse norms) plus a table-name -> row-id lookup."""
+    global _embeddings, _inv_norms, _name_index
+    _, index, texts = load_faiss()
+
+    if _embeddings is None:
+        if os.path.exists(EMBED_FILE):
+            emb = np.load(EMBED_FILE, mmap_mode="r")
+        else:
+            emb = index.reconstruct_n(0, index.ntotal)  # older data dirs without embeddings.npy
+        norms = np.sqrt(np.einsum("ij,ij->i", emb, emb, dtype=np.float32))
+        inv = np.zeros_like(norms)
+        np.divide(1.0, norms, out=inv, where=norms > 0)
+        _embeddings, _inv_norms = emb, inv
+
+    if _name_index is None:
+        name_index = {}
+        for row_id, text in enumerate(texts):
+            if text is None:
+                continue  # slot freed by an incremental rebuild
+            full_name = schema_text_table_name(text)
+            name_index.setdefault(full_name, []).append(row_id)
+            parts = full_name.split(".")
+            if len(parts) == 3:
+                name_index.setdefault(f"{parts[1]}.{parts[2]}", []).append(row_id)
+        _name_index = name_index
+
+    return _embeddings, _inv_norms, _name_index
+
 
 def search_schema(query, top_k=5):
     table_info = extract_table_names_from_sql_new(query)
@@ -39,48 +125,27 @@ def search_schema(query, top_k=5):
     model, index, texts = load_faiss()
     q_emb = model.encode([query], convert_to_numpy=True)[0]
 
-    # print(texts[:5])
-
     results = []
     if table_info:
+        embeddings, inv_norms, name_index = load_schema_vectors()
+
+        # O(1) lookup per referenced table instead of scanning every schema text
+        row_ids = []
         for info in table_info:
-            # print(info)
-            # print(len(info.split(".")))
-            db = None
-            schema = None
-            tbl = None
-            if (len(info.split("."))==3):
-                db = info.split(".")[0].lower()
-                schema = info.split(".")[1].lower()
-                tbl = info.split(".")[2].lower()
-                # print(f"Searching for db: {db}, schema: {schema}, table: {tbl}")
-            
-            elif (len(info.split("."))==2):
-                schema = info.split(".")[0].lower()
-                tbl = info.split(".")[1].lower()
-                # print(f"Searching for schema: {schema}, table: {tbl}")
-            
-            else:
+            if len(info.split(".")) not in (2, 3):
                 continue
-            
-            
-            for txt in texts:
-                # if db and db.lower() not in txt.lower():
-                #     continue  # skip jika db tidak sama
-
-                if db:
-                    check = db.lower()+'.'+schema.lower()+'.'+tbl.lower()
-                else:
-                    check = schema.lower()+'.'+tbl.lower()
-                
-                if (check.lower() in txt.lower()):
-                    emb = model.encode([txt], convert_to_numpy=True)[0]
-                    score = float(np.dot(q_emb, emb) / (np.linalg.norm(q_emb) * np.linalg.norm(emb)))
-                    results.append((txt, score))
+            row_ids.extend(name_index.get(info.lower(), []))
+        row_ids = list(dict.fromkeys(row_ids))
+
+        if row_ids:
+            # Stored embeddings, one matrix-vector product for all candidates (no re-encoding)
+            q_norm = np.linalg.norm(q_emb) or 1.0
+            scores = (embeddings[row_ids] @ (q_emb / q_norm)) * inv_norms[row_ids]
+            results = [(texts[i], float(score)) for i, score in zip(row_ids, scores)]
     else:
         # fallback global
         D, I = index.search(np.array([q_emb]), top_k)
-        results = [(texts[i], float(D[0][j])) for j, i in enumerate(I[0])]
+        results = [(texts[i], float(D[0][j])) for j, i in enumerate(I[0]) if i >= 0]
     
     results = sorted(results, key=lambda x: x[1], reverse=True)[:top_k]
     return results
@@ -92,42 +157,10 @@ def extract_table_names_from_sql_new_no_defaultdb(sql_text):
     """
     Extract table names from SQL text, returning raw identifiers:
     db.schema.table OR schema.table OR table
-    Removes comments first so patterns in comments are ignored.
-    Excludes temporary tables (#temp, ##globaltemp).
+    Uses the T-SQL lexer, so comments, string literals, CTE names,
+    temp tables (#temp, ##globaltemp) and table variables are ignored.
     """
-
-    # Remove multi-line comments (/* ... */)
-    sql_no_multiline = re.sub(r"/\*.*?\*/", "", sql_text, flags=re.DOTALL)
-
-    # Remove single-line comments (-- ...)
-    sql_no_comments = re.sub(r"--.*?$", "", sql_no_multiline, flags=re.MULTILINE)
-
-    # Capture table references, but exclude temp tables starting with #
-    pattern = re.compile(
-        r"""
-        \b(?:FROM|JOIN|INTO|UPDATE|DELETE\s+FROM)\s+
-        (?!\#)                                 # exclude temp tables
-        (
-            (?:\[?[a-zA-Z0-9_]+\]?\.){0,2}     # 0 to 2 prefixes (db. schema.)
-            \[?[a-zA-Z0-9_]+\]?                # final object
-        )
-        """,
-        re.IGNORECASE | re.VERBOSE,
-    )
-
-    matches = pattern.findall(sql_no_comments)
-    cleaned = []
-
-    for m in matches:
-        # Skip temp tables again as extra safety
-        if m.strip().startswith("#"):
-            continue
-
-        # Clean brackets
-        full_name = m.replace("[", "").replace("]", "")
-        cleaned.append(full_name)
-
-    return list(set(cleaned))
+    return list(extract_references(sql_text).tables)
 
 
 def get_existing_index_info(connection, table_names):
@@ -187,48 +220,11 @@ def extract_table_names_from_sql_new(sql_text, default_db=None):
     """
     Extract table names from SQL text, returning full identifiers:
     db.schema.table
-    Removes comments first so patterns in comments are ignored.
-    Excludes temporary tables (#temp, ##globaltemp).
+    Uses the T-SQL lexer, so comments, string literals, CTE names,
+    temp tables (#temp, ##globaltemp) and table variables are ignored.
+    Results are cached by SP text hash (see app.utils.sql_references).
     """
-
-    # Remove multi-line comments (/* ... */)
-    sql_no_multiline = re.sub(r"/\*.*?\*/", "", sql_text, flags=re.DOTALL)
-
-    # Remove single-line comments (-- ...)
-    sql_no_comments = re.sub(r"--.*?$", "", sql_no_multiline, flags=re.MULTILINE)
-
-    # Capture table references, but exclude temp tables starting with #
-    pattern = re.compile(
-        r"""
-        \b(?:FROM|JOIN|INTO|UPDATE|DELETE\s+FROM)\s+
-        (?!\#)                                 # exclude temp tables
-        (
-            (?:\[?[a-zA-Z0-9_]+\]?\.){0,2}     # 0 to 2 prefixes (db. schema.)
-            \[?[a-zA-Z0-9_]+\]?                # final object
-        )
-        """,
-        re.IGNORECASE | re.VERBOSE,
-    )
-
-    matches = pattern.findall(sql_no_comments)
-    cleaned = []
-
-    for m in matches:
-        # Skip temp tables again as extra safety
-        if m.strip().startswith("#"):
-            continue
-
-        parts = [p for p in m.replace("[", "").replace("]", "").split(".") if p]
-        if len(parts) == 1 and default_db:
-            full_name = f"{default_db}.dbo.{parts[0]}"
-        elif len(parts) == 2 and default_db:
-            full_name = f"{default_db}.{parts[0]}.{parts[1]}"
-        else:
-            full_name = ".".join(parts)
-        cleaned.append(full_name)
-
-    return list(set(cleaned))
-
+    return list(extract_references(sql_text, default_db).tables)
 
 
 def is_similar_sql(original_sql, optimized_sql, threshold=0.95):
@@ -261,72 +257,56 @@ def log_to_sql(connection, sp_name, status, similarity=None, note=None):
         print(f"⚠️ Failed to log into database: {e}")
 
 
-def get_db_schema_with_indexes_all_databases(connection):
-    cursor = connection.cursor()
+SCHEMA_WITH_INDEXES_PER_DB_SQL = """
+    SELECT
+        {db_name} AS DatabaseName,
+        sch.name AS SchemaName,
+        t.name AS TableName,
+        c.name AS ColumnName,
+        ty.name AS DataType,
+        i.name AS IndexName,
+        i.type_desc AS IndexType,
+        ic.is_included_column,
+        ic.key_ordinal
+    FROM {db}.sys.tables t
+    INNER JOIN {db}.sys.schemas sch ON t.schema_id = sch.schema_id
+    INNER JOIN {db}.sys.columns c ON t.object_id = c.object_id
+    INNER JOIN {db}.sys.types ty ON c.user_type_id = ty.user_type_id
+    LEFT JOIN {db}.sys.index_columns ic
+        ON t.object_id = ic.object_id AND c.column_id = ic.column_id
+    LEFT JOIN {db}.sys.indexes i
+        ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+"""
 
-    # ambil semua database kecuali system
-    cursor.execute("""
-        SELECT name 
-        FROM sys.databases
-        WHERE name NOT IN ('master', 'tempdb', 'model', 'msdb')
-    """)
-    databases = [row[0] for row in cursor.fetchall()]
 
-    all_schema_info = {}
-
-    for db in databases:
-        try:
-            print(f"🔍 Processing database: {db}")
-            cursor.execute(f"USE [{db}]")
+def get_db_schema_with_indexes_all_databases(connection):
+    # Single round-trip for every user database (see app.catalog_collector)
+    data = collect(
+        connection,
+        SCHEMA_WITH_INDEXES_PER_DB_SQL,
+        wrapper_sql="{union}\nORDER BY DatabaseName, SchemaName, TableName, IndexName, key_ordinal;",
+        columns=("DatabaseName", "SchemaName", "TableName", "ColumnName", "DataType", "IndexName", "IndexType"),
+    )
 
-            query = """
-            SELECT 
-                sch.name AS SchemaName,
-                t.name AS TableName,
-                c.name AS ColumnName,
-                ty.name AS DataType,
-                i.name AS IndexName,
-                i.type_desc AS IndexType,
-                ic.is_included_column,
-                ic.key_ordinal
-            FROM sys.tables t
-            INNER JOIN sys.schemas sch ON t.schema_id = sch.schema_id
-            INNER JOIN sys.columns c ON t.object_id = c.object_id
-            INNER JOIN sys.types ty ON c.user_type_id = ty.user_type_id
-            LEFT JOIN sys.index_columns ic 
-                ON t.object_id = ic.object_id AND c.column_id = ic.column_id
-            LEFT JOIN sys.indexes i 
-                ON ic.object_id = i.object_id AND ic.index_id = i.index_id
-            ORDER BY sch.name, t.name, i.name, ic.key_ordinal;
-            """
-
-            cursor.execute(query)
-            rows = cursor.fetchall()
-
-            schema_info = {}
-            for row in rows:
-                table_key = f"{db}.{row.SchemaName}.{row.TableName}"
-                if table_key not in schema_info:
-                    schema_info[table_key] = {
-                        "columns": [],
-                        "indexes": {}
-                    }
-                schema_info[table_key]["columns"].append(f"{row.ColumnName} ({row.DataType})")
-
-                if row.IndexName:
-                    if row.IndexName not in schema_info[table_key]["indexes"]:
-                        schema_info[table_key]["indexes"][row.IndexName] = {
-                            "type": row.IndexType,
-                            "columns": []
-                        }
-                    schema_info[table_key]["indexes"][row.IndexName]["columns"].append(row.ColumnName)
-
-            all_schema_info.update(schema_info)
-
-        except Exception as e:
-            print(f"⚠️ Skipping database {db}: {e}")
+    all_schema_info = {}
+    for db, schema, table, column, dtype, index_name, index_type in zip(
+        data["DatabaseName"], data["SchemaName"], data["TableName"], data["ColumnName"],
+        data["DataType"], data["IndexName"], data["IndexType"]
+    ):
+        table_key = f"{db}.{schema}.{table}"
+        if table_key not in all_schema_info:
+            all_schema_info[table_key] = {
+                "columns": [],
+                "indexes": {}
+            }
+        all_schema_info[table_key]["columns"].append(f"{column} ({dtype})")
+
+        if index_name:
+            if index_name not in all_schema_info[table_key]["indexes"]:
+                all_schema_info[table_key]["indexes"][index_name] = {
+                    "type": index_type,
+                    "columns": []
+                }
+            all_schema_info[table_key]["indexes"][index_name]["columns"].append(column)
 
     return all_schema_info
-
-
-
@@ -0,0 +1,236 @@
+"""
+Optimize (or get index recommendations for) every non-encrypted stored procedure, unattended.
+
+    python batch_optimize.py                                # all databases, optimized SPs
+    python batch_optimize.py --mode index --database Sales  # index recommendations only
+    python batch_optimize.py --resume 20250101_220000       # continue an interrupted run
+
+Results go to outputs/batch_<run>/: one .sql per procedure, checkpoint.jsonl (one line per finished
+procedure, used to resume) and summary.json. Procedures are loaded one database at a time, table
+metadata is fetched once per chunk of procedures and shared; LLM calls run on --workers threads and
+are throttled by the Gemini client's rate limiter.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from app.catalog_collector import list_user_databases
+from app.db_connector import get_connection
+from app.indexing.index_ai import get_index_recommendation, split_index_ddl
+from app.optimization.sp_loader import format_table_info, get_stored_procedures_all_databases, get_tables_metadata
+from app.optimization.sp_chunker import optimize_sp_in_blocks
+from app.optimization.sp_optimizer import optimize_stored_procedure
+from app.optimization.sp_workflow import clean_optimized_sql, use_chunks
+from app.utils.sql_references import extract_references
+from app.utils.utils import is_similar_sql
+
+OUTPUT_DIR = "outputs"
+CHUNK_SIZE = 100   # procedures whose metadata is fetched together
+
+
+def load_checkpoint(path):
+    """{full_name: record} of procedures already processed in this run."""
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # partial last line from a crash
+                done[record["sp"]] = record
+    return done
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def iter_chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def prepare_chunk(sps):
+    """Prompt context for a chunk of SPs, with one metadata batch per database for all their tables."""
+    refs = {sp["full_name"]: list(extract_references(sp["definition"], sp["database"]).tables) for sp in sps}
+
+    by_db = {}
+    for sp in sps:
+        by_db.setdefault(sp["database"], []).extend(refs[sp["full_name"]])
+
+    metadata = {}
+    with get_connection() as connection:
+        for db, table_names in by_db.items():
+            metadata.update(get_tables_metadata(connection, table_names, db))
+
+    return [
+        (sp, format_table_info(metadata, refs[sp["full_name"]], sp["database"], sp["definition"]), metadata)
+        for sp in sps
+    ]
+
+
+def output_path(run_dir, sp, suffix):
+    folder = os.path.join(run_dir, sp["database"])
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{sp['schema']}.{sp['name']}{suffix}.sql")
+
+
+def process_sp(mode, run_dir, sp, table_info, metadata):
+    start = time.perf_counter()
+    record = {"sp": sp["full_name"], "mode": mode}
+
+    if mode == "optimize":
+        if use_chunks(sp["definition"]):
+            # too big for one prompt: block by block, like the web app
+            optimized_sql, chunks = optimize_sp_in_blocks(sp["definition"], metadata, sp["database"])
+            if not chunks["optimized_blocks"]:
+                raise RuntimeError("AI did not respond")
+            record["chunks"] = chunks
+        else:
+            optimized_sql = optimize_stored_procedure(sp["definition"], table_info)
+            if not optimized_sql:
+                raise RuntimeError("AI did not respond")
+            optimized_sql = clean_optimized_sql(optimized_sql)
+        similar, ratio = is_similar_sql(sp["definition"], optimized_sql)
+        path = output_path(run_dir, sp, "_optimized")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(optimized_sql)
+        record.update(similarity=round(ratio * 100, 2), similar=similar)
+    else:
+        ddl = get_index_recommendation(sp["definition"], table_info)
+        path = output_path(run_dir, sp, "_indexes")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(ddl or "-- (No AI recommendations)")
+        record["indexes"] = len(split_index_ddl(ddl))
+
+    record.update(status="done", file=path, seconds=round(time.perf_counter() - start, 1))
+    return record
+
+
+def combine_index_recommendations(run_dir, records):
+    """All recommended CREATE INDEX statements in one file, duplicates removed."""
+    statements = {}
+    for record in records:
+        if record.get("status") == "done" and record.get("indexes"):
+            with open(record["file"], encoding="utf-8") as f:
+                for statement in split_index_ddl(f.read()):
+                    # whole statements, compared without case / whitespace differences
+                    statements.setdefault(" ".join(statement.split()).lower(), statement)
+    statements = list(statements.values())
+
+    path = os.path.join(run_dir, "all_index_recommendations.sql")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(statements) + "\n")
+    return path, len(statements)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch-optimize every stored procedure")
+    parser.add_argument("--mode", choices=("optimize", "index"), default="optimize")
+    parser.add_argument("--database", action="append", help="only this database (repeatable)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("BATCH_WORKERS", "4")),
+                        help="concurrent LLM calls (default: BATCH_WORKERS or 4)")
+    parser.add_argument("--limit", type=int, help="stop after this many procedures")
+    parser.add_argument("--resume", metavar="RUN_ID", help="continue the run in outputs/batch_<RUN_ID>")
+    parser.add_argument("--retry-failed", action="store_true", help="with --resume, redo procedures that failed")
+    args = parser.parse_args()
+
+    run_id = args.resume or datetime.now().strftime("%Y%m%d_%H%M%S")
+    run_dir = os.path.join(OUTPUT_DIR, f"batch_{run_id}")
+    os.makedirs(run_dir, exist_ok=True)
+    checkpoint_path = os.path.join(run_dir, "checkpoint.jsonl")
+
+    previous = load_checkpoint(checkpoint_path)
+    previous_modes = {r.get("mode") for r in previous.values()}
+    if previous and previous_modes != {args.mode}:
+        parser.error(f"run {run_id} was started with --mode {', '.join(sorted(map(str, previous_modes)))}; "
+                     f"resume it with the same mode or start a new run")
+    skip = {name for name, r in previous.items() if r["status"] == "done" or not args.retry_failed}
+
+    with get_connection() as connection:
+        databases = list_user_databases(connection)
+    if args.database:
+        wanted_dbs = {db.lower() for db in args.database}
+        databases = [db for db in databases if db.lower() in wanted_dbs]
+
+    print(f"Run {run_id}: {len(databases)} databases ({len(skip)} procedures already in checkpoint), "
+          f"mode={args.mode}, workers={args.workers}")
+
+    checkpoint = Checkpoint(checkpoint_path)
+    counts = {"done": 0, "failed": 0}
+    remaining = args.limit
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for database in databases:
+            if remaining is not None and remaining <= 0:
+                break
+            # one database's definitions in memory at a time
+            with get_connection() as connection:
+                sps = get_stored_procedures_all_databases(connection, [database])
+            sps = [sp for sp in sps if not sp["is_encrypted"] and sp["definition"] and sp["full_name"] not in skip]
+            if remaining is not None:
+                sps = sps[:remaining]
+                remaining -= len(sps)
+            if not sps:
+                continue
+            print(f"📂 {database}: {len(sps)} procedures to process")
+
+            for chunk in iter_chunks(sps, CHUNK_SIZE):
+                # only one chunk in flight: bounded memory and metadata stays fresh for its SPs
+                futures = {
+                    executor.submit(process_sp, args.mode, run_dir, sp, table_info, metadata): sp
+                    for sp, table_info, metadata in prepare_chunk(chunk)
+                }
+                for future in as_completed(futures):
+                    sp = futures[future]
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        record = {"sp": sp["full_name"], "mode": args.mode, "status": "failed", "error": str(e)}
+                    checkpoint.append(record)
+                    counts[record["status"]] += 1
+
+                    total = counts["done"] + counts["failed"]
+                    elapsed = time.perf_counter() - started
+                    print(f"[{total}] {record['status']:6} {sp['full_name']} "
+                          f"({elapsed / total:.1f}s/SP avg)")
+
+    records = list(load_checkpoint(checkpoint_path).values())
+    summary = {
+        "run_id": run_id,
+        "mode": args.mode,
+        "processed_this_session": counts,
+        "done_total": sum(1 for r in records if r["status"] == "done"),
+        "failed_total": sum(1 for r in records if r["status"] == "failed"),
+        "elapsed_seconds": round(time.perf_counter() - started, 1),
+    }
+    if args.mode == "index":
+        path, n = combine_index_recommendations(run_dir, records)
+        summary["combined_index_file"] = path
+        summary["combined_index_statements"] = n
+
+    with open(os.path.join(run_dir, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"✅ Batch finished: {summary['done_total']} done, {summary['failed_total']} failed -> {run_dir}")
+
+
+if __name__ == "__main__":
+    main()
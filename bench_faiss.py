@@ -0,0 +1,134 @@
+"""
+Recall / latency benchmark of the approximate FAISS index types against the exact (flat) baseline.
+
+    python bench_faiss.py --tables 20000                 # synthetic schema texts, real embeddings
+    python bench_faiss.py --tables 200000 --random       # random unit vectors, no model needed
+    python bench_faiss.py --nprobe 8 16 32 --ef-search 32 64 128
+"""
+import argparse
+import random
+import time
+
+import faiss
+import numpy as np
+from tabulate import tabulate
+
+from app.embedding_service import MODEL_NAME
+from create_faiss import build_ann_index, build_table_text
+from app.utils.utils import set_search_params
+
+WORDS = [
+    "customer", "order", "invoice", "payment", "product", "stock", "warehouse", "shipment",
+    "employee", "branch", "account", "ledger", "journal", "supplier", "contract", "price",
+    "discount", "tax", "currency", "region", "audit", "log", "status", "session", "user",
+]
+TYPES = ["int", "bigint", "varchar", "nvarchar", "datetime", "decimal", "bit", "uniqueidentifier"]
+
+
+def synthetic_schema(n_tables, seed=0):
+    """{db.schema.table: {"columns": [...], "indexes": [...]}} shaped like get_db_schema_with_indexes_all_databases."""
+    rnd = random.Random(seed)
+    schema = {}
+    while len(schema) < n_tables:
+        db = f"Db{rnd.randint(1, 20)}"
+        table = "".join(w.title() for w in rnd.sample(WORDS, rnd.randint(1, 3))) + str(rnd.randint(1, 999))
+        columns = [f"{table}ID (int)"] + [
+            f"{rnd.choice(WORDS).title()}{rnd.choice(WORDS).title()} ({rnd.choice(TYPES)})"
+            for _ in range(rnd.randint(3, 15))
+        ]
+        indexes = [f"PK_{table} (CLUSTERED)"] + [
+            f"IX_{table}_{i} (NONCLUSTERED)" for i in range(rnd.randint(0, 3))
+        ]
+        schema[f"{db}.dbo.{table}"] = {"columns": columns, "indexes": indexes}
+    return schema
+
+
+def embed(n_tables, n_queries, use_random, dim, seed):
+    rnd = np.random.default_rng(seed)
+    if use_random:
+        base = rnd.standard_normal((n_tables, dim)).astype(np.float32)
+        # queries near existing rows, like a question mentioning a known table
+        picks = rnd.integers(0, n_tables, n_queries)
+        queries = base[picks] + 0.3 * rnd.standard_normal((n_queries, dim)).astype(np.float32)
+        return base, queries
+
+    from sentence_transformers import SentenceTransformer
+
+    schema = synthetic_schema(n_tables, seed)
+    texts = [build_table_text(table, info) for table, info in schema.items()]
+    model = SentenceTransformer(MODEL_NAME)
+    print(f"Encoding {len(texts)} schema texts...")
+    base = model.encode(texts, convert_to_numpy=True, batch_size=256, show_progress_bar=True)
+    picks = rnd.integers(0, n_tables, n_queries)
+    questions = [f"which columns does {texts[i].split(' (', 1)[0]} have" for i in picks]
+    queries = model.encode(questions, convert_to_numpy=True)
+    return np.ascontiguousarray(base, dtype=np.float32), np.ascontiguousarray(queries, dtype=np.float32)
+
+
+def run_queries(index, queries, k):
+    """One query at a time, as search_schema does; returns (ids, per-query latency in ms)."""
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    latencies = np.empty(len(queries))
+    for i, q in enumerate(queries):
+        start = time.perf_counter()
+        _, found = index.search(q.reshape(1, -1), k)
+        latencies[i] = (time.perf_counter() - start) * 1000
+        ids[i] = found[0]
+    return ids, latencies
+
+
+def recall_at_k(found, truth):
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index types for the schema search")
+    parser.add_argument("--tables", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--random", action="store_true", help="random vectors instead of embedded schema texts")
+    parser.add_argument("--dim", type=int, default=384, help="vector size for --random")
+    parser.add_argument("--types", nargs="+", default=["ivf", "hnsw", "ivfpq"])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    base, queries = embed(args.tables, args.queries, args.random, args.dim, args.seed)
+    ids = np.arange(len(base), dtype=np.int64)
+
+    def build(index_type):
+        start = time.perf_counter()
+        index, built_type = build_ann_index(base, index_type)
+        index.add_with_ids(base, ids)
+        return index, built_type, time.perf_counter() - start
+
+    flat, _, flat_build = build("flat")
+    truth, flat_lat = run_queries(flat, queries, args.k)
+
+    rows = [["flat", "-", f"{flat_build:.1f}", 1.0,
+             f"{np.percentile(flat_lat, 50):.3f}", f"{np.percentile(flat_lat, 95):.3f}",
+             f"{faiss.serialize_index(flat).nbytes / 2**20:.1f}"]]
+
+    for index_type in args.types:
+        index, built_type, build_time = build(index_type)
+        size_mb = faiss.serialize_index(index).nbytes / 2**20
+        if built_type == "hnsw":
+            settings = [("efSearch", v, dict(ef_search=v)) for v in args.ef_search]
+        else:
+            settings = [("nprobe", v, dict(nprobe=v)) for v in args.nprobe]
+
+        for name, value, params in settings:
+            set_search_params(index, **params)
+            found, lat = run_queries(index, queries, args.k)
+            rows.append([built_type, f"{name}={value}", f"{build_time:.1f}", round(recall_at_k(found, truth), 4),
+                         f"{np.percentile(lat, 50):.3f}", f"{np.percentile(lat, 95):.3f}", f"{size_mb:.1f}"])
+
+    print(f"\n{len(base)} vectors, dim {base.shape[1]}, {len(queries)} queries, k={args.k}")
+    print(tabulate(rows, headers=["index", "search param", "build s", f"recall@{args.k}",
+                                  "p50 ms", "p95 ms", "size MB"], tablefmt="github"))
+
+
+if __name__ == "__main__":
+    main()
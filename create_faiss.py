@@ -1,10 +1,13 @@
 from app.utils.utils import get_db_schema_with_indexes_all_databases
 from app.db_connector import get_connection
+from app.utils import text_store
+from app.embedding_service import get_embedder
 
 import pyodbc
-from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
+import argparse
+import hashlib
 import pickle
 import os
 
@@ -13,50 +16,221 @@ load_dotenv(override=True)
 
 DATA_DIR = "data"
 FAISS_FILE = os.path.join(DATA_DIR, "faiss_index.bin")
-TEXTS_FILE = os.path.join(DATA_DIR, "schema_texts.pkl")
+TEXTS_FILE = os.path.join(DATA_DIR, "schema_texts.dat")
+LEGACY_TEXTS_FILE = os.path.join(DATA_DIR, "schema_texts.pkl")
 EMBED_FILE = os.path.join(DATA_DIR, "embeddings.npy")
+# {"dim": int, "tables": {table_key: {"id": row id, "hash": sha1 of the schema text}}}
+MANIFEST_FILE = os.path.join(DATA_DIR, "schema_manifest.pkl")
+
+# flat (exact), ivf (IVF-Flat), hnsw, ivfpq (IVF + product quantisation); see bench_faiss.py
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat").lower()
+HNSW_M = 32
+PQ_BITS = 8
 
 # 3. Convert schema to text
+def build_table_text(table, info):
+    cols = ", ".join(info["columns"])
+    idxs = ", ".join(info["indexes"]) if info["indexes"] else "None"
+    return f"{table} ({cols}) Indexes: {idxs}"
+
 def build_text_from_schema(schema_dict):
-    texts = []
-    for table, info in schema_dict.items():
-        cols = ", ".join(info["columns"])
-        idxs = ", ".join(info["indexes"]) if info["indexes"] else "None"
-        text = f"{table} ({cols}) Indexes: {idxs}"
-        texts.append(text)
-    return texts
+    return [build_table_text(table, info) for table, info in schema_dict.items()]
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _ivf_nlist(n):
+    # ~4*sqrt(n) lists, with enough points per list to train the centroids
+    return max(1, min(int(4 * np.sqrt(n)), n // 39))
+
+
+def _pq_subquantizers(dim):
+    # largest divisor of dim giving >= 8 dims per sub-vector (384 -> 48)
+    return max(m for m in range(1, dim + 1) if dim % m == 0 and dim // m >= 8)
+
+
+def build_ann_index(embeddings, index_type=FAISS_INDEX_TYPE):
+    """Empty (but trained) ID-mapped index of the requested type for these vectors."""
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    n, dim = embeddings.shape
+
+    if index_type == "ivfpq" and n < (1 << PQ_BITS) * 39:
+        print(f"⚠️ {n} vectors is too few to train IVF-PQ, using IVF-Flat")
+        index_type = "ivf"
+
+    # sub-indexes stay owned by the Python wrappers (faiss keeps a reference on the outer
+    # index); setting own_fields as well would free them twice
+    if index_type == "flat":
+        base = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        base = faiss.IndexHNSWFlat(dim, HNSW_M)
+        base.hnsw.efConstruction = 80
+    elif index_type == "ivf":
+        base = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, _ivf_nlist(n))
+    elif index_type == "ivfpq":
+        base = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, _ivf_nlist(n), _pq_subquantizers(dim), PQ_BITS)
+    else:
+        raise ValueError(f"Unknown FAISS index type '{index_type}', expected one of {INDEX_TYPES}")
+
+    if not base.is_trained:
+        base.train(embeddings)
+    if isinstance(base, faiss.IndexIVF):
+        return base, index_type  # IVF lists store ids themselves and support remove_ids
+
+    # ID-mapped so later runs can remove/add single tables in place
+    index = faiss.IndexIDMap2(base)
+    return index, index_type
+
 
 # 4. Index ke FAISS
-def create_faiss_index(texts):
-    model = SentenceTransformer("all-MiniLM-L6-v2")
+def create_faiss_index(texts, model=None, index_type=FAISS_INDEX_TYPE):
+    model = model or get_embedder()
     embeddings = model.encode(texts, convert_to_numpy=True)
 
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dim)
-    index.add(embeddings)
+    index, index_type = build_ann_index(embeddings, index_type)
+    index.add_with_ids(embeddings, np.arange(len(texts), dtype=np.int64))
+
+    return index, embeddings, index_type
+
+
+def full_build(schema_dict, model=None, index_type=FAISS_INDEX_TYPE):
+    table_texts = {table: build_table_text(table, info) for table, info in schema_dict.items()}
+    texts = list(table_texts.values())
+    index, embeddings, index_type = create_faiss_index(texts, model, index_type)
+    manifest = {
+        "dim": embeddings.shape[1],
+        "index_type": index_type,
+        "tables": {
+            table: {"id": row_id, "hash": content_hash(text)}
+            for row_id, (table, text) in enumerate(table_texts.items())
+        },
+    }
+    return index, texts, embeddings, manifest
+
+
+def load_previous_build(index_type=FAISS_INDEX_TYPE):
+    """Previous index, texts, embeddings and manifest, or None if there is nothing incremental to start from."""
+    if index_type == "hnsw":
+        return None  # HNSW graphs do not support remove_ids
+    if not all(os.path.exists(p) for p in (FAISS_FILE, EMBED_FILE, MANIFEST_FILE)):
+        return None
+
+    index = faiss.read_index(FAISS_FILE)
+    if not isinstance(index, (faiss.IndexIDMap2, faiss.IndexIVF)):
+        return None  # built before the ID-mapped format
+
+    if text_store.exists(TEXTS_FILE):
+        store = text_store.TextStore(TEXTS_FILE)
+        texts = list(store)
+        store.close()
+    elif os.path.exists(LEGACY_TEXTS_FILE):
+        with open(LEGACY_TEXTS_FILE, "rb") as f:
+            texts = pickle.load(f)
+    else:
+        return None
+    with open(MANIFEST_FILE, "rb") as f:
+        manifest = pickle.load(f)
+    embeddings = np.load(EMBED_FILE)
+
+    if len(texts) != embeddings.shape[0] or manifest.get("dim") != index.d:
+        return None
+    if manifest.get("index_type", "flat") != index_type:
+        return None  # switching index type needs a full (re)train
+    return index, texts, embeddings, manifest
+
+
+def incremental_build(schema_dict, previous, model=None):
+    """
+    Re-embed only tables whose schema text changed; removed tables are dropped from the index.
+    Row ids stay stable, so texts[i] / embeddings[i] keep matching FAISS id i.
+    Freed rows are left as None / zero vectors and reused by new tables.
+    """
+    index, texts, embeddings, manifest = previous
+    known = manifest["tables"]
+
+    table_texts = {table: build_table_text(table, info) for table, info in schema_dict.items()}
+    changed = [t for t, text in table_texts.items() if t not in known or known[t]["hash"] != content_hash(text)]
+    removed = [t for t in known if t not in table_texts]
+
+    stale_ids = [known[t]["id"] for t in changed if t in known] + [known[t]["id"] for t in removed]
+    if stale_ids:
+        index.remove_ids(np.array(stale_ids, dtype=np.int64))
+
+    for t in removed:
+        row_id = known.pop(t)["id"]
+        texts[row_id] = None
+        embeddings[row_id] = 0
+
+    print(f"Tables: {len(table_texts)} total, {len(changed)} new/changed, {len(removed)} removed")
+    if not changed:
+        return index, texts, embeddings, manifest
+
+    free_ids = [i for i, text in enumerate(texts) if text is None]
+    ids = []
+    for t in changed:
+        if t in known:
+            ids.append(known[t]["id"])
+        elif free_ids:
+            ids.append(free_ids.pop(0))
+        else:
+            ids.append(len(texts))
+            texts.append(None)
+
+    model = model or get_embedder()
+    new_embeddings = model.encode([table_texts[t] for t in changed], convert_to_numpy=True)
+    index.add_with_ids(new_embeddings, np.array(ids, dtype=np.int64))
+
+    if len(texts) > embeddings.shape[0]:
+        grown = np.zeros((len(texts), embeddings.shape[1]), dtype=embeddings.dtype)
+        grown[:embeddings.shape[0]] = embeddings
+        embeddings = grown
+
+    for t, row_id, emb in zip(changed, ids, new_embeddings):
+        texts[row_id] = table_texts[t]
+        embeddings[row_id] = emb
+        known[t] = {"id": row_id, "hash": content_hash(table_texts[t])}
+
+    return index, texts, embeddings, manifest
 
-    return index, embeddings
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh the FAISS schema index")
+    parser.add_argument("--full", action="store_true", help="re-embed every table instead of only changed ones")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=FAISS_INDEX_TYPE,
+                        help="FAISS index type (default: FAISS_INDEX_TYPE or flat)")
+    args = parser.parse_args()
+
     os.makedirs(DATA_DIR, exist_ok=True)
 
     with get_connection() as connection:
         schema_dict = get_db_schema_with_indexes_all_databases(connection)
-        print(schema_dict)
-        texts = build_text_from_schema(schema_dict)
 
-        index, embeddings = create_faiss_index(texts)
+    previous = None if args.full else load_previous_build(args.index_type)
+    if previous is None:
+        print(f"Full build ({args.index_type})")
+        index, texts, embeddings, manifest = full_build(schema_dict, index_type=args.index_type)
+    else:
+        print("Incremental build")
+        index, texts, embeddings, manifest = incremental_build(schema_dict, previous)
 
-        # save FAISS index
-        faiss.write_index(index, FAISS_FILE)
+    # Web workers map these files, so each one is written to .tmp and swapped in with os.replace
+    # (overwriting a mapped file in place can SIGBUS a reader); the manifest goes last.
+    faiss.write_index(index, FAISS_FILE + ".tmp")
+    # embeddings: row i <-> FAISS id i (file object, so np.save does not append ".npy")
+    with open(EMBED_FILE + ".tmp", "wb") as f:
+        np.save(f, embeddings)
+    with open(MANIFEST_FILE + ".tmp", "wb") as f:
+        pickle.dump(manifest, f)
 
-        # save schema texts
-        with open(TEXTS_FILE, "wb") as f:
-            pickle.dump(texts, f)
+    # schema texts (memory-mapped by the web app), swapped in by write_texts itself
+    text_store.write_texts(TEXTS_FILE, texts)
+    if os.path.exists(LEGACY_TEXTS_FILE):
+        os.remove(LEGACY_TEXTS_FILE)
 
-        # save embeddings (optional)
-        np.save(EMBED_FILE, embeddings)
+    os.replace(EMBED_FILE + ".tmp", EMBED_FILE)
+    os.replace(FAISS_FILE + ".tmp", FAISS_FILE)
+    os.replace(MANIFEST_FILE + ".tmp", MANIFEST_FILE)
 
-        print("Schema stored in FAISS")
-        print("Contoh schema text:", texts[0])
-        print("FAISS entries:", index.ntotal)
+    print("Schema stored in FAISS")
+    print("FAISS entries:", index.ntotal)
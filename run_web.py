@@ -1,22 +1,33 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response, stream_with_context
 
-from app.db_connector import get_connection
-from app.optimization.sp_loader import get_stored_procedures, get_sp_definition, get_tables, get_table_columns, get_table_indexes, get_slow_sp, get_stored_procedures_all_databases
-from app.optimization.sp_optimizer import optimize_stored_procedure, sanitize_sql
+from app.db_connector import get_connection, get_pool_stats
+from app.optimization.sp_loader import get_stored_procedures, get_tables, get_stored_procedures_all_databases
 from app.optimization.sp_saver import rename_sp_name, save_optimized_sp, save_sql_to_file
-from app.indexing.fragmentation_analyzer import generate_maintenance_sql, analyze_index_fragmentation_all
-from app.indexing.index_ai import get_index_recommendation
+from app.indexing.fragmentation_analyzer import generate_maintenance_sql, scan_index_fragmentation, iter_index_fragmentation_parallel
+from app.indexing.fragmentation_store import invalidate_snapshots, get_fragmentation_history
+from app.catalog_collector import list_user_databases
 from app.indexing.sql_executor import execute_sql_statements
 from app.indexing.system_index_recommendations import get_missing_indexes_all_databases, get_unused_indexes_all_databases
-from app.utils.utils import is_similar_sql, log_result, log_to_sql, get_existing_index_info, extract_table_names_from_sql_new, search_schema
+from app.utils.utils import log_result, log_to_sql, get_existing_index_info, search_schema
 from app.utils.logger import log_action
-
-from app.gemini_client import call_ai
+from app.optimization.metadata_cache import metadata_cache
+from app.optimization.sp_benchmark import benchmark_sp, format_report
+from app.optimization.sp_verifier import verify_equivalence
+from app.optimization.query_stats import DEFAULT_SORT, MAX_PAGE_SIZE, SORT_OPTIONS, get_slow_sp, get_slow_sp_text
+from app.optimization.stats_sampler import start_sampler
+from app.optimization.stats_store import get_procedure_trend, get_top_procedures
+from app.response_cache import response_cache
+from app.optimization.prompt_budget import prompt_metrics
+from app.jobs import JobQueueFull, get_job, get_job_stats, submit as submit_job
+from app.optimization.sp_workflow import run_index_recommendation, run_optimize_sp, split_sp_name, stream_optimize_sp
+
+from app.gemini_client import call_ai, call_ai_stream, get_gemini_stats
 
 from datetime import datetime
 from dotenv import load_dotenv
 import os
 
+import json
 import uuid
 import datetime
 import markdown
@@ -30,6 +41,9 @@ load_dotenv(override=True)
 
 app = Flask(__name__)
 
+# per-interval DMV samples for /slow-sp?window=..., only when STATS_SAMPLER_ENABLED=true
+stats_sampler = start_sampler()
+
 @app.route("/")
 def index():
     # db_name = os.getenv("SQL_DATABASE")
@@ -41,7 +55,7 @@ def index():
 def analyze_index():
     with get_connection() as connection:
         db_name = os.getenv("SQL_DATABASE")
-        results = analyze_index_fragmentation_all(connection)
+        results = scan_index_fragmentation(connection)
         results = [r for r in results if r["recommendation"] in ("REBUILD", "REORGANIZE")]
         
         maintenance_sql = generate_maintenance_sql(results)
@@ -65,83 +79,45 @@ def analyze_index():
             ai_ready=False
         )
 
-@app.route("/analyze_ai", methods=["POST"])
-def analyze_ai():
+@app.route("/analyze/stream", methods=["GET"])
+def analyze_index_stream():
+    # One JSON line per database as soon as its scan finishes (parallel mode)
     with get_connection() as connection:
-        try:
-            db_name = os.getenv("SQL_DATABASE")
-            data = request.get_json()
-            selected_sp = data.get("selected_sp")  # Contoh: "Production.uspGetBillOfMaterials"
+        databases = list_user_databases(connection)
 
-            if not selected_sp or "." not in selected_sp:
-                return jsonify({"ai_suggestions": "-- SP is invalid or not selected."})
+    def generate():
+        for db, results, error in iter_index_fragmentation_parallel(None, databases):
+            yield json.dumps({"database": db, "results": results, "error": error}, default=str) + "\n"
 
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
-            database_name, schema, name = selected_sp.split(".")
+@app.route("/fragmentation/history", methods=["GET"])
+def fragmentation_history():
+    history = get_fragmentation_history(
+        request.args.get("database"),
+        request.args.get("schema"),
+        request.args.get("table"),
+        request.args.get("index"),
+    )
+    return jsonify(history)
 
-            # Ambil isi SP
-            try:
-                sp_text = get_sp_definition(connection, database_name, schema, name)
-            except Exception as e:
-                print(f"[ERROR] Failed to retrieve SP contents {selected_sp}: {e}")
-                return jsonify({"ai_suggestions": f"-- Failed to read SP: {selected_sp}"})
-
-            table_names = extract_table_names_from_sql_new(sp_text, database_name)
-            print("Extracted table names:", table_names)
-            # table_names could look like ["Sales.dbo.Orders", "Inventory.dbo.Products"]
-
-            table_info_lines = []
-            for table in table_names:
-                try:
-                    parts = table.split(".")
-                    if len(parts) == 3:
-                        db, sch, tbl = parts
-                    elif len(parts) == 2:
-                        # assume current database if DB not specified
-                        db = database_name
-                        sch, tbl = parts
-                    else:
-                        continue  # skip if can't parse
-
-                    cols = get_table_columns(connection, db, sch, tbl, sp_text)
-                    
-                    # Get indexes for this table
-                    indexes = get_table_indexes(connection, db, sch, tbl)
-                    # print(indexes)
-
-                    # Format index info
-                    if indexes:
-                        index_info = []
-                        for idx in indexes:
-                            col_type = "included" if idx.is_included_column else "key"
-                            index_info.append(f"{idx.index_name} ({col_type}: {idx.column_name})")
-                        index_str = " | Indexes: " + ", ".join(index_info)
-                    else:
-                        index_str = ""
-
-                    # table_info_lines.append(f"{db}.{sch}.{tbl} ({', '.join(cols)})")
-                    # Append final line with columns and indexes
-                    table_info_lines.append(f"{db}.{sch}.{tbl} ({', '.join(cols)}){index_str}")
-                except Exception as e:
-                    print(f"[WARN] Could not load columns for {table}: {e}")
-
-            table_info = "\n".join(table_info_lines)
-
-            # Kirim ke AI
-            ai_suggestions = get_index_recommendation(sp_text, table_info)
-
-            if not ai_suggestions:
-                ai_suggestions = "-- (No AI recommendations)"
-            else:
-                save_sql_to_file(ai_suggestions, "index_ai_recommendations.sql")
-
-            return jsonify({"ai_suggestions": ai_suggestions})
+@app.route("/analyze_ai", methods=["POST"])
+def analyze_ai():
+    data = request.get_json()
+    selected_sp = data.get("selected_sp")  # Contoh: "AdventureWorks.Production.uspGetBillOfMaterials"
 
-        except Exception as e:
-            print("❌ ERROR WHILE RUNNING /analyze_ai:")
-            import traceback
-            traceback.print_exc()
-            return jsonify({"ai_suggestions": f"❌ Internal error: {str(e)}"}), 500
+    try:
+        split_sp_name(selected_sp)
+    except ValueError:
+        return jsonify({"ai_suggestions": "-- SP is invalid or not selected."})
+
+    # Metadata + LLM call run on a job worker; the page polls /jobs/<id>
+    try:
+        job_id = submit_job("index_recommendation", run_index_recommendation, sp_name=selected_sp)
+    except JobQueueFull as e:
+        return jsonify({"ai_suggestions": f"❌ {e}"}), 503
+
+    return jsonify({"job_id": job_id, "status_url": url_for("job_status", job_id=job_id)}), 202
 
 
 @app.route("/build_index_proc", methods=["POST"])
@@ -150,7 +126,7 @@ def build_index_proc():
         db_name = "TestDB"
 
         # Analisis fragmentasi terbaru
-        frag_results = analyze_index_fragmentation_all(connection)
+        frag_results = scan_index_fragmentation(connection)
         frag_results = [r for r in frag_results if r["recommendation"] in ("REBUILD", "REORGANIZE")]
         frag_sql = generate_maintenance_sql(frag_results)
 
@@ -190,10 +166,10 @@ def build_index_proc():
 
         if final_sql == "":
             db_name = os.getenv("SQL_DATABASE")
-            results = analyze_index_fragmentation_all(connection)
-            results = [r for r in results if r["recommendation"] in ("REBUILD", "REORGANIZE")]
+            # Reuse the scan above instead of rescanning every index again
+            results = frag_results
             
-            maintenance_sql = generate_maintenance_sql(results)
+            maintenance_sql = frag_sql
             # execute_sql_statements(connection, maintenance_sql)
             
             filename = f"index_recommendations_{datetime.now().strftime('%Y%m%d_%H%M%S')}.sql"
@@ -249,6 +225,8 @@ def execute_recommendation_index():
             cursor = connection.cursor()
             cursor.execute(f"USE [{db_name}]; EXEC dbo.recommendation_index;")
             connection.commit()
+            # REBUILD/REORGANIZE do not move last_user_update, so force a full rescan next time
+            invalidate_snapshots()
 
             result_message = "✅ Stored Procedure executed successfully."
             return render_template("execution_result.html", result=result_message)
@@ -270,77 +248,44 @@ def optimize_page():
 
 @app.route("/optimize_sp", methods=["POST"])
 def optimize():
-    with get_connection() as connection:
-        # db_name = os.getenv("SQL_DATABASE")
-        sp_full = request.form.get("sp_name")
-
-        if not sp_full or "." not in sp_full:
-            return "❌ Invalid SP data. Please select SP from the list."
-
-        database_name, schema, name = sp_full.split(".")
-
-        sp_text = get_sp_definition(connection, database_name, schema, name)
-        if not sp_text:
-            return f"Failed to retrieve SP definition {schema}.{name}"
-
-        # Extract table names used in the SP
-        table_names = extract_table_names_from_sql_new(sp_text, database_name)
-        # table_names could look like ["Sales.dbo.Orders", "Inventory.dbo.Products"]
-
-        print(table_names)
-
-        table_info_lines = []
-        for table in table_names:
-            try:
-                parts = table.split(".")
-                if len(parts) == 3:
-                    db, sch, tbl = parts
-                elif len(parts) == 2:
-                    # assume current database if DB not specified
-                    db = database_name
-                    sch, tbl = parts
-                else:
-                    continue  # skip if can't parse
-
-                cols = get_table_columns(connection, db, sch, tbl, sp_text)
-                
-                # Get indexes for this table
-                indexes = get_table_indexes(connection, db, sch, tbl)
-                # print(indexes)
-
-                # Format index info
-                if indexes:
-                    index_info = []
-                    for idx in indexes:
-                        col_type = "included" if idx.is_included_column else "key"
-                        index_info.append(f"{idx.index_name} ({col_type}: {idx.column_name})")
-                    index_str = " | Indexes: " + ", ".join(index_info)
-                else:
-                    index_str = ""
-
-                # table_info_lines.append(f"{db}.{sch}.{tbl} ({', '.join(cols)})")
-                # Append final line with columns and indexes
-                table_info_lines.append(f"{db}.{sch}.{tbl} ({', '.join(cols)}){index_str}")
-                
-            except Exception as e:
-                print(f"[WARN] Could not load columns for {table}: {e}")
-
-        table_info = "\n".join(table_info_lines)
-        
-        optimized_sql = optimize_stored_procedure(sp_text, table_info)
-        if not optimized_sql:
-            return "❌ Optimization failed (AI did not respond)."
-
-        optimized_sql = sanitize_sql(optimized_sql)
-        optimized_sql = optimized_sql.replace("=== END SP_OPTIMIZED ===", "")
-        # print("Optimized SQL:", optimized_sql)
-        optimized_sql = optimized_sql.replace("=== SP_OPTIMIZED ===", "")
-
-        similar, ratio = is_similar_sql(sp_text, optimized_sql)
+    sp_full = request.form.get("sp_name")
+    try:
+        split_sp_name(sp_full)
+    except ValueError as e:
+        return f"❌ {e}"
+
+    try:
+        # chunked=None: run_optimize_sp decides by SP size
+        chunked = True if request.form.get("chunked") else None
+        job_id = submit_job("optimize_sp", run_optimize_sp, sp_name=sp_full, chunked=chunked)
+    except JobQueueFull as e:
+        return f"❌ {e}", 503
+
+    return redirect(url_for("job_page", job_id=job_id))
+
+@app.route("/optimize_sp/live", methods=["POST"])
+def optimize_live():
+    # Page that shows the optimized SQL while it is generated (see /optimize_sp/stream)
+    sp_full = request.form.get("sp_name")
+    try:
+        split_sp_name(sp_full)
+    except ValueError as e:
+        return f"❌ {e}"
+    return render_template("optimize_stream.html", sp_name=sp_full)
+
+@app.route("/optimize_sp/stream", methods=["POST"])
+def optimize_stream():
+    sp_full = (request.get_json(silent=True) or {}).get("sp_name") or request.form.get("sp_name")
+
+    def generate():
+        try:
+            for event in stream_optimize_sp(sp_full):
+                yield json.dumps(event, default=str) + "\n"
+        except Exception as e:
+            yield json.dumps({"type": "error", "message": str(e)}) + "\n"
 
-        return render_template("result.html", original=sp_text, optimized=optimized_sql,
-                            database_name = database_name,schema=schema, name=name, similarity=round(ratio * 100, 2),
-                            similar=similar)
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"})
 
 @app.route("/save", methods=["POST"])
 def save():
@@ -369,14 +314,123 @@ def save():
             status=status,
             original_name=f"{schema}.{name}",
             new_sp_name=f"{schema}.{new_name}",
+            sp_full_name=f"{db_name}.{schema}.{name}",
+            optimized_name=new_name,
             db_name=db_name
         )
 
+def run_benchmark(**kwargs):
+    result = benchmark_sp(**kwargs)
+    result["report"] = format_report(result)
+    return result
+
+@app.route("/benchmark_sp", methods=["POST"])
+def benchmark():
+    # JSON body {"sp_name", "params": {"@p": value}, "optimized_name", "runs", "cold"} or the save page form
+    data = request.get_json(silent=True)
+    from_form = data is None
+    if from_form:
+        data = dict(request.form)
+        try:
+            data["params"] = json.loads(data.get("params") or "{}")
+        except ValueError:
+            return "❌ Parameters must be a JSON object, e.g. {\"@CustomerID\": 42}", 400
+
+    try:
+        split_sp_name(data.get("sp_name"))
+    except ValueError as e:
+        return f"❌ {e}", 400
+    if not isinstance(data.get("params") or {}, dict):
+        return "❌ Parameters must be a JSON object.", 400
+    try:
+        runs = min(max(int(data.get("runs") or 10), 1), 100)
+    except (TypeError, ValueError):
+        return "❌ Runs must be a number between 1 and 100.", 400
+
+    try:
+        job_id = submit_job(
+            "benchmark_sp", run_benchmark,
+            sp_name=data["sp_name"],
+            params=data.get("params") or {},
+            optimized_name=data.get("optimized_name") or None,
+            runs=runs,
+            cold=str(data.get("cold", "")).lower() in ("1", "true", "on"),
+        )
+    except JobQueueFull as e:
+        return f"❌ {e}", 503
+
+    if from_form:
+        return redirect(url_for("job_page", job_id=job_id))
+    return jsonify({"job_id": job_id, "status_url": url_for("job_status", job_id=job_id)}), 202
+
+@app.route("/verify_equivalence", methods=["POST"])
+def verify():
+    # JSON body {"sp_name", "params": {"@p": value}, "optimized_name" or "optimized_sql"}; result page polls the job
+    data = request.get_json(silent=True) or dict(request.form)
+    if isinstance(data.get("params"), str):
+        try:
+            data["params"] = json.loads(data["params"] or "{}")
+        except ValueError:
+            return jsonify({"error": "Parameters must be a JSON object, e.g. {\"@CustomerID\": 42}"}), 400
+
+    try:
+        split_sp_name(data.get("sp_name"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not isinstance(data.get("params") or {}, dict):
+        return jsonify({"error": "Parameters must be a JSON object."}), 400
+
+    try:
+        job_id = submit_job(
+            "verify_equivalence", verify_equivalence,
+            sp_name=data["sp_name"],
+            params=data.get("params") or {},
+            optimized_name=data.get("optimized_name") or None,
+            optimized_sql=data.get("optimized_sql") or None,
+        )
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"job_id": job_id, "status_url": url_for("job_status", job_id=job_id)}), 202
+
 @app.route("/slow-sp")
 def slow_sp():
+    sort = request.args.get("sort", DEFAULT_SORT)
+    if sort not in SORT_OPTIONS:
+        sort = DEFAULT_SORT
+    limit = min(max(request.args.get("limit", 50, type=int), 1), MAX_PAGE_SIZE)
+    after = request.args.get("after")
+    window = request.args.get("window", type=int)
+
+    if window:
+        # work done in the last <window> minutes, from the sampler's store
+        data, next_cursor = get_top_procedures(window, sort=sort, limit=limit), None
+    else:
+        with get_connection() as connection:
+            try:
+                data, next_cursor = get_slow_sp(connection, sort=sort, limit=limit, after=after)
+            except ValueError:
+                return "❌ Invalid page cursor.", 400
+    return render_template("slow_sp.html", rows=data, sort=sort, sort_options=SORT_OPTIONS,
+                           limit=limit, after=after, next_cursor=next_cursor, window=window,
+                           sampler=stats_sampler.stats())
+
+@app.route("/slow-sp/trend")
+def slow_sp_trend():
+    try:
+        database_name, schema, name = split_sp_name(request.args.get("sp"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    hours = request.args.get("hours", 24, type=float)
+    return jsonify(get_procedure_trend(database_name, schema, name, hours))
+
+@app.route("/slow-sp/<int:database_id>/<int:object_id>/sql")
+def slow_sp_text(database_id, object_id):
+    # SQL text is only fetched when a row is expanded
     with get_connection() as connection:
-        data = get_slow_sp(connection)
-        return render_template("slow_sp.html", rows=data)
+        sql_text = get_slow_sp_text(connection, database_id, object_id)
+    if sql_text is None:
+        return jsonify({"error": "Procedure is no longer in the plan cache."}), 404
+    return jsonify({"sql_text": sql_text})
 
 @app.route("/system-index-recommendations", methods=["GET"])
 def system_index_recommendations():
@@ -402,6 +456,52 @@ def system_index_remove():
             unused_indexes=unused_indexes,
         )
 
+@app.route("/pool-stats", methods=["GET"])
+def pool_stats():
+    return jsonify(get_pool_stats())
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/view", methods=["GET"])
+def job_page(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return "❌ Job not found.", 404
+    if job["status"] == "done":
+        return redirect(url_for("job_result", job_id=job_id))
+    return render_template("job_status.html", job=job)
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return "❌ Job not found.", 404
+    if job["status"] != "done":
+        return redirect(url_for("job_page", job_id=job_id))
+
+    if job["kind"] == "optimize_sp":
+        return render_template("result.html", **job["result"])
+    if job["kind"] == "benchmark_sp":
+        return Response(job["result"]["report"], mimetype="text/plain; charset=utf-8")
+    return jsonify(job["result"])
+
+@app.route("/llm-stats", methods=["GET"])
+def llm_stats():
+    return jsonify({**get_gemini_stats(), "prompts": prompt_metrics.stats()})
+
+@app.route("/job-stats", methods=["GET"])
+def job_stats():
+    return jsonify(get_job_stats())
+
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    return jsonify({"metadata": metadata_cache.stats(), "gemini": response_cache.stats()})
+
 # @app.route("/chat", methods=["GET", "POST"])
 # def chat():
 #     if request.method == "POST":
@@ -468,30 +568,82 @@ def chat_detail(chat_id):
             # m.Content = Markup(markdown.markdown(m.Content))
             m.Content = Markup(markdown.markdown(m.Content, extensions=['fenced_code']))
 
-        return render_template("chat_detail.html", session=title, messages=messages, chat_id=chat_id)
+        return render_template("chat_detail.html", session=title, messages=messages, chat_id=chat_id,
+                               pending_job=request.args.get("job"))
 
 # ---- POST MESSAGE ----
-@app.route("/chat/<chat_id>/send", methods=["POST"])
-def send_message(chat_id):
+def generate_chat_reply(chat_id, content):
+    """Job body for /chat/<id>/send: schema search + LLM call, then store the AI message."""
+    related_schema = search_schema(content)   # fungsi kamu
+    ai_reply = call_ai(content, related_schema)  # bisa pakai OpenAI/Gemini
+    if not ai_reply:
+        ai_reply = "❌ AI did not respond, please try again."
+
     with get_connection() as conn:
-        content = request.form["message"]
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO TestDB.dbo.ChatMessages (ChatID, Role, Content, CreatedAt) VALUES (?, ?, ?, ?)",
-                    chat_id, "user", content, datetime.datetime.now())
-        conn.commit()
-        
-        # --- proses AI ---
-        related_schema = search_schema(content)   # fungsi kamu
-        ai_reply = call_ai(content, related_schema)  # bisa pakai OpenAI/Gemini
-        
-        # --- simpan jawaban AI ---
         cursor.execute("""
             INSERT INTO TestDB.dbo.ChatMessages (ChatID, Role, Content, CreatedAt)
             VALUES (?, ?, ?, ?)
         """, (chat_id, "ai", ai_reply, datetime.datetime.now()))
         conn.commit()
+    return {"chat_id": chat_id}
 
-        return redirect(url_for("chat_detail", chat_id=chat_id))
+@app.route("/chat/<chat_id>/send/stream", methods=["POST"])
+def send_message_stream(chat_id):
+    # Chat reply streamed as NDJSON {"delta": ...} lines; stored once complete
+    content = (request.get_json(silent=True) or {}).get("message") or request.form.get("message", "")
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO TestDB.dbo.ChatMessages (ChatID, Role, Content, CreatedAt) VALUES (?, ?, ?, ?)",
+                    chat_id, "user", content, datetime.datetime.now())
+        conn.commit()
+
+    def generate():
+        parts = []
+        error = None
+        try:
+            related_schema = search_schema(content)
+            for chunk in call_ai_stream(content, related_schema):
+                parts.append(chunk)
+                yield json.dumps({"delta": chunk}) + "\n"
+        except Exception as e:
+            print("❌ Chat stream error:", e)
+            error = str(e)
+
+        ai_reply = "".join(parts) or "❌ AI did not respond, please try again."
+        if error and parts:
+            # a cut-off answer must not be stored as if it were complete
+            ai_reply += "\n\n⚠️ Reply was interrupted, please try again."
+        if error:
+            yield json.dumps({"error": error}) + "\n"
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO TestDB.dbo.ChatMessages (ChatID, Role, Content, CreatedAt)
+                VALUES (?, ?, ?, ?)
+            """, (chat_id, "ai", ai_reply, datetime.datetime.now()))
+            conn.commit()
+        yield json.dumps({"done": True}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"})
+
+@app.route("/chat/<chat_id>/send", methods=["POST"])
+def send_message(chat_id):
+    content = request.form["message"]
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO TestDB.dbo.ChatMessages (ChatID, Role, Content, CreatedAt) VALUES (?, ?, ?, ?)",
+                    chat_id, "user", content, datetime.datetime.now())
+        conn.commit()
+
+    # --- proses AI di background, halaman chat polling status job ---
+    try:
+        job_id = submit_job("chat_reply", generate_chat_reply, chat_id=chat_id, content=content)
+    except JobQueueFull as e:
+        return f"❌ {e}", 503
+
+    return redirect(url_for("chat_detail", chat_id=chat_id, job=job_id))
 
 
 if __name__ == "__main__":